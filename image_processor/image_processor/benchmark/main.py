@@ -0,0 +1,117 @@
+from .runner import run_scenario
+from .standins import StandInHttpServer
+from datetime import datetime
+import itertools
+import argparse
+import platform
+import json
+import os
+
+
+def _csv_of(cast):
+    return lambda value: [cast(item) for item in value.split(",")]
+
+
+def _env_matrix(env_args: list[str]) -> list[dict]:
+    """ ["A=1,2", "B=x"] -> [{A: 1, B: x}, {A: 2, B: x}] """
+    options = []
+    for env_arg in env_args:
+        name, _, values = env_arg.partition("=")
+        options.append([(name, value) for value in values.split(",")])
+
+    return [dict(combination) for combination in itertools.product(*options)]
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmark.main",
+        description="End to end throughput benchmark of image processor & webhooks, against local stand-ins",
+    )
+    parser.add_argument("--rows", type=_csv_of(int), default=[100, 1000], help="csv sizes (rows), comma separated")
+    parser.add_argument("--dup-ratios", type=_csv_of(float), default=[0.0, 0.5], help="fraction of repeated image urls, comma separated")
+    parser.add_argument("--images-per-row", type=int, default=3)
+    parser.add_argument("--engines", type=_csv_of(str), default=["thread"], help="IMAGE_ENGINE values, comma separated")
+    parser.add_argument("--image-size", default="1024x768", help="WIDTHxHEIGHT of the served images")
+    parser.add_argument("--image-latency-ms", type=float, default=20, help="latency of the image server per request")
+    parser.add_argument("--storage-latency-ms", type=float, default=10, help="latency of the storage per image upload")
+    parser.add_argument("--webhooks", type=int, default=1000, help="no. of webhooks to deliver, 0 to skip")
+    parser.add_argument("--webhook-latency-ms", type=float, default=50, help="latency of the webhook endpoint")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=V1,V2",
+                        help="env to set for the run, multiple values are benchmarked one by one (e.g. IMAGE_DOWNLOAD_WORKER_COUNT=16,32)")
+    parser.add_argument("--small-uploads", type=int, default=0,
+                        help="small uploads processed next to each upload (e.g. to compare IMAGE_FAIR_SCHEDULER=enable,disable)")
+    parser.add_argument("--small-rows", type=int, default=5, help="csv size (rows) of the small uploads")
+    parser.add_argument("--repeat", type=int, default=1, help="runs of each scenario")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default=f"benchmark-{datetime.now():%Y%m%d-%H%M%S}.json", help="json file for the results")
+    return parser.parse_args()
+
+
+def build_scenarios(args: argparse.Namespace, base_url: str) -> list[dict]:
+    scenarios = []
+
+    for env in _env_matrix(args.env):
+        for engine, rows, dup_ratio in itertools.product(args.engines, args.rows, args.dup_ratios):
+            scenarios.append({
+                "kind": "upload",
+                "rows": rows,
+                "dupRatio": dup_ratio,
+                "imagesPerRow": args.images_per_row,
+                "storageLatencyMs": args.storage_latency_ms,
+                "smallUploads": args.small_uploads,
+                "smallRows": args.small_rows,
+                "seed": args.seed,
+                "baseUrl": base_url,
+                # image cache is off unless enabled via --env IMAGE_CACHE=enable, so repeated runs measure the same work
+                "env": {"IMAGE_CACHE": "disable", **env, "IMAGE_ENGINE": engine},
+            })
+
+        if args.webhooks:
+            scenarios.append({"kind": "webhook", "webhooks": args.webhooks, "baseUrl": base_url, "env": env})
+
+    return scenarios
+
+
+def _summary(scenario: dict, result: dict) -> str:
+    env = "".join(f" {name}={value}" for name, value in scenario["env"].items())
+    if scenario["kind"] == "webhook":
+        return (f"webhooks={scenario['webhooks']}{env}: {result['webhooksPerSec']} webhooks/sec "
+                f"({result['errors']} errors) delivery p50/p99 {result['stages']['delivery']['p50Ms']}/{result['stages']['delivery']['p99Ms']}ms")
+
+    stages = ", ".join(f"{stage} p50/p99 {stats['p50Ms']}/{stats['p99Ms']}ms" for stage, stats in result["stages"].items())
+    small = result.get("smallUploads")
+    small = f", {small['count']} small uploads p50/max {small['p50Sec']}/{small['maxSec']}s" if small else ""
+    return (f"rows={scenario['rows']} dup={scenario['dupRatio']}{env}: {result['imagesPerSec']} images/sec "
+            f"({result['errors']} errors, peak rss {result['peakRssMb']}MB{small}) {stages}")
+
+
+def main():
+    args = parse_args()
+    width, height = (int(value) for value in args.image_size.lower().split("x"))
+
+    server = StandInHttpServer(width, height, args.image_latency_ms, args.webhook_latency_ms).start()
+    try:
+        results = []
+        for scenario in build_scenarios(args, server.base_url):
+            for run in range(args.repeat):
+                result = run_scenario(scenario)
+                print(_summary(scenario, result), flush=True)
+                results.append({"scenario": {key: value for key, value in scenario.items() if key != "baseUrl"}, "run": run, **result})
+    finally:
+        server.stop()
+
+    report = {
+        "createdAt": datetime.now().isoformat(),
+        "host": {"platform": platform.platform(), "python": platform.python_version(), "cpuCount": os.cpu_count()},
+        "imageBytes": server.image_bytes,
+        "args": {key: value for key, value in vars(args).items() if key != "output"},
+        "results": results,
+    }
+    with open(args.output, "w") as output:
+        json.dump(report, output, indent=2)
+
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from threading import Lock, Thread
+from functools import wraps
+from io import BytesIO
+import resource
+import inspect
+import logging
+import random
+import time
+import os
+
+import fakeredis
+import mongomock
+import numpy
+import pandas
+
+from core.http_client import get_http_client
+from upload.processor import ProcessUploadId
+from upload.transcoder import initialize_transcode_pool, prewarm_transcode_pool
+from upload.limiter import get_host_limiters
+from upload.breaker import get_host_breakers
+from upload.scheduler import get_image_scheduler
+from upload.pipeline import get_download_worker_count
+from webhook.dispatcher import WebhookDispatcher, get_webhook_worker_count
+from .standins import InMemoryStorageManager
+
+BENCHMARK_CSV = "benchmark.csv"
+
+# processor stage methods (thread & async engine) -> stage name in report
+PROCESSOR_STAGES = {
+    "_download_stage": "download",
+    "_download_stage_async": "download",
+    "_transcode_stage": "transcode",
+    "_upload_stage": "upload",
+    "_upload_stage_async": "upload",
+}
+
+
+class StageTimer:
+    """ collects the duration of each call of the wrapped stage functions """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.durations: dict[str, list[float]] = {}
+
+    def record(self, stage: str, duration: float):
+        with self.lock:
+            self.durations.setdefault(stage, []).append(duration)
+
+    def wrap(self, stage: str, fn):
+        """ returns fn (sync or async) which records its duration under the stage """
+        if inspect.iscoroutinefunction(fn):
+            @wraps(fn)
+            async def timed_async(*args, **kwargs):
+                started_at = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    self.record(stage, time.perf_counter() - started_at)
+            return timed_async
+
+        @wraps(fn)
+        def timed(*args, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - started_at)
+        return timed
+
+    def report(self) -> dict:
+        """ count & p50/p95/p99/mean latency (ms) of each stage """
+        report = {}
+        for stage, durations in self.durations.items():
+            durations_ms = numpy.array(durations) * 1000
+            p50, p95, p99 = numpy.percentile(durations_ms, [50, 95, 99])
+            report[stage] = {
+                "count": len(durations),
+                "p50Ms": round(float(p50), 3),
+                "p95Ms": round(float(p95), 3),
+                "p99Ms": round(float(p99), 3),
+                "meanMs": round(float(durations_ms.mean()), 3),
+            }
+        return report
+
+
+def build_csv(base_url: str, rows: int, images_per_row: int, dup_ratio: float, seed: int) -> tuple[bytes, int]:
+    """
+    csv of given rows, each with images_per_row urls of the stand-in image server
+    dup_ratio of the urls repeat an url used elsewhere in the csv
+    returns the csv along with the no. of unique urls in it
+    """
+    total = rows * images_per_row
+    unique = max(1, min(total, round(total * (1 - dup_ratio))))
+
+    rng = random.Random(seed)
+    image_ids = list(range(unique)) + [rng.randrange(unique) for _ in range(total - unique)]
+    rng.shuffle(image_ids)
+
+    csv = BytesIO()
+    csv.write(b"Serial Number,Product Name,Input Image Urls\n")
+    for row in range(rows):
+        urls = ",".join(f"{base_url}/images/{image_id}.jpg" for image_id in image_ids[row * images_per_row:(row + 1) * images_per_row])
+        csv.write(f'{row + 1},Product {row + 1},"{urls}"\n'.encode())
+
+    return csv.getvalue(), unique
+
+
+def _peak_rss_mb() -> dict:
+    """ peak rss of this process & of the largest (already exited) child process, i.e. transcode workers """
+    # ru_maxrss is in KB on linux
+    return {
+        "peakRssMb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "peakChildRssMb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+    }
+
+
+def _get_logger() -> logging.Logger:
+    logr = logging.getLogger("pixelriver-benchmark")
+    logr.setLevel(logging.WARNING)
+    if not logr.handlers:
+        logr.addHandler(logging.StreamHandler())
+    return logr
+
+
+def _run_upload(scenario: dict) -> dict:
+    """ processes one upload end to end (csv read, images, csv write, status) against the stand-ins """
+    os.environ.update(scenario["env"])
+    logr = _get_logger()
+
+    storage = InMemoryStorageManager(logr, latency_ms=scenario["storageLatencyMs"])
+    csv, unique = build_csv(scenario["baseUrl"], scenario["rows"], scenario["imagesPerRow"], scenario["dupRatio"], scenario["seed"])
+    storage.blobs[f"{storage.csv_download_path}/{BENCHMARK_CSV}"] = csv
+
+    mongo_db = mongomock.MongoClient().get_database("benchmark")
+    upload_id = mongo_db.get_collection("uploads").insert_one({"fileName": BENCHMARK_CSV, "webhookUrl": None}).inserted_id
+    redis_client = fakeredis.FakeRedis()
+
+    # start the transcode workers before the clock
+    transcode_pool = initialize_transcode_pool(logr)
+    if transcode_pool is not None:
+        for warm_up in prewarm_transcode_pool(transcode_pool):
+            warm_up.result()
+
+    host_limiters = get_host_limiters(logr)
+    host_breakers = get_host_breakers(logr)
+    image_scheduler = get_image_scheduler(logr, host_limiters.max_limit if host_limiters is not None else get_download_worker_count())
+    processor = ProcessUploadId(logr, mongo_db, redis_client, storage, transcode_pool, host_limiters=host_limiters,
+                                host_breakers=host_breakers, image_scheduler=image_scheduler)
+
+    timer = StageTimer()
+    for method, stage in PROCESSOR_STAGES.items():
+        setattr(processor, method, timer.wrap(stage, getattr(processor, method)))
+
+    # small uploads processed next to the measured one (same worker), their duration is reported
+    small_uploads = []
+    for small_no in range(scenario.get("smallUploads", 0)):
+        small_csv = f"small-{small_no}-{BENCHMARK_CSV}"
+        storage.blobs[f"{storage.csv_download_path}/{small_csv}"] = build_csv(
+            scenario["baseUrl"], scenario["smallRows"], scenario["imagesPerRow"], 0, scenario["seed"] + small_no + 1)[0]
+        small_id = mongo_db.get_collection("uploads").insert_one({"fileName": small_csv, "webhookUrl": None}).inserted_id
+        small_processor = ProcessUploadId(logr, mongo_db, redis_client, storage, transcode_pool, host_limiters=host_limiters,
+                                          host_breakers=host_breakers, image_scheduler=image_scheduler)
+        small_uploads.append((small_processor, small_id))
+
+    small_durations = []
+
+    def run_small(small_processor: ProcessUploadId, small_id):
+        # starts once the measured upload is busy with its images
+        time.sleep(scenario.get("smallDelaySec", 1))
+        small_started_at = time.perf_counter()
+        small_processor.start_processing(str(small_id))
+        small_durations.append(time.perf_counter() - small_started_at)
+        small_processor.http_client.close()
+
+    small_threads = [Thread(target=run_small, args=small_upload) for small_upload in small_uploads]
+
+    started_at = time.perf_counter()
+    for small_thread in small_threads:
+        small_thread.start()
+    processor.start_processing(str(upload_id))
+    elapsed = time.perf_counter() - started_at
+
+    for small_thread in small_threads:
+        small_thread.join()
+
+    if transcode_pool is not None:
+        transcode_pool.shutdown()
+    processor.http_client.close()
+
+    upload_doc = mongo_db.get_collection("uploads").find_one({"_id": upload_id})
+    if upload_doc.get("status") != "completed":
+        raise Exception(f"Upload did not complete, status: {upload_doc.get('status')}")
+
+    output = pandas.read_csv(BytesIO(storage.blobs[f"{storage.csv_upload_path}/{BENCHMARK_CSV}"]))
+    output_urls = output["Output Image Urls"].astype(str).str.split(",").explode()
+    errors = int((~output_urls.str.startswith(storage.public_file_path)).sum())
+
+    images = scenario["rows"] * scenario["imagesPerRow"]
+    return {
+        "images": images,
+        "uniqueImages": unique,
+        "errors": errors,
+        "elapsedSec": round(elapsed, 3),
+        "imagesPerSec": round(images / elapsed, 2),
+        "uniqueImagesPerSec": round(unique / elapsed, 2),
+        "rowsPerSec": round(scenario["rows"] / elapsed, 2),
+        "stages": timer.report(),
+        **({"hostConcurrencyLimits": host_limiters.limits()} if host_limiters is not None else {}),
+        **({"smallUploads": _small_upload_report(small_durations)} if small_durations else {}),
+        **_peak_rss_mb(),
+    }
+
+
+def _small_upload_report(durations: list[float]) -> dict:
+    """ count & p50/max duration (sec) of the small uploads processed next to the measured one """
+    return {
+        "count": len(durations),
+        "p50Sec": round(float(numpy.percentile(durations, 50)), 3),
+        "maxSec": round(max(durations), 3),
+    }
+
+
+def _run_webhooks(scenario: dict) -> dict:
+    """ delivers the webhooks via dispatcher to the stand-in endpoint, responses are saved in mongomock """
+    os.environ.update(scenario["env"])
+    logr = _get_logger()
+
+    mongo_db = mongomock.MongoClient().get_database("benchmark")
+    uploads = mongo_db.get_collection("uploads")
+    upload_ids = uploads.insert_many([{"fileName": BENCHMARK_CSV} for _ in range(scenario["webhooks"])]).inserted_ids
+
+    timer = StageTimer()
+    http_client = get_http_client(logr, pool_size=get_webhook_worker_count(), max_retries=0)
+    http_client.get = timer.wrap("request", http_client.get)
+    dispatcher = WebhookDispatcher(logr, mongo_db, http_client).start()
+
+    def on_done(submitted_at: float):
+        timer.record("delivery", time.perf_counter() - submitted_at)
+
+    started_at = time.perf_counter()
+    for upload_id in upload_ids:
+        submitted_at = time.perf_counter()
+        dispatcher.submit(f"{upload_id}|||{scenario['baseUrl']}/webhook/{upload_id}", on_done=lambda s=submitted_at: on_done(s))
+    dispatcher.shutdown()
+    elapsed = time.perf_counter() - started_at
+
+    http_client.close()
+
+    errors = uploads.count_documents({"whkResponse": {"$ne": "Respone Status Code:200"}})
+    return {
+        "webhooks": scenario["webhooks"],
+        "errors": errors,
+        "elapsedSec": round(elapsed, 3),
+        "webhooksPerSec": round(scenario["webhooks"] / elapsed, 2),
+        "stages": timer.report(),
+        **_peak_rss_mb(),
+    }
+
+
+def run_scenario(scenario: dict) -> dict:
+    """
+    runs the scenario (kind upload or webhook) in a fresh process
+    so the envs, peak rss & warm caches of one scenario do not leak into the next
+    """
+    runner = _run_upload if scenario["kind"] == "upload" else _run_webhooks
+
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+        return executor.submit(runner, scenario).result()
@@ -0,0 +1,196 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from core.gcp import GCPStorageManager
+from multiprocessing import get_context
+from PIL import Image
+from io import BytesIO
+import logging
+import asyncio
+import time
+import os
+
+# envs required by GCPStorageManager, in-memory storage does not use most of them
+STORAGE_ENVS = {
+    "GCP_PROJECT_ID": "pixelriver-benchmark",
+    "GCP_ENDPOINT": "http://127.0.0.1:0",
+    "GCP_IMAGE_DATA_CSV_BUCKET_NAME": "pixelriver-benchmark",
+    "GCP_IMAGE_DATA_FILE_PUBLIC_URL": "http://storage.benchmark/",
+    "GCP_IMAGE_DATA_CSV_DOWNLOAD_PATH": "unprocessed",
+    "GCP_IMAGE_DATA_CSV_UPLOAD_PATH": "processed",
+    "GCP_IMAGE_DATA_IMG_UPLOAD_PATH": "images",
+}
+
+
+def make_synthetic_image(width: int, height: int, quality: int = 90) -> bytes:
+    """
+    jpeg of given size, made of upscaled noise
+    so it compresses roughly like a photo (pure noise would be much larger, flat color much smaller)
+    """
+    small_size = (max(width // 8, 1), max(height // 8, 1))
+    noise = Image.frombytes("RGB", small_size, os.urandom(small_size[0] * small_size[1] * 3))
+    image = noise.resize((width, height), Image.Resampling.BICUBIC)
+
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    """
+    GET /images/<anything> - the synthetic image, with the path appended after jpeg end marker
+                             so every url has distinct content (Pillow ignores the trailing bytes)
+    GET /webhook/<anything> - empty 200, as webhook endpoint
+    HEAD - empty 200, as the http client prewarm only opens the connection
+    """
+
+    # keep-alive, as the real image hosts & our http clients do
+    protocol_version = "HTTP/1.1"
+    # headers & body are separate writes, with Nagle (& delayed ack) each reused connection stalls ~40ms per response
+    disable_nagle_algorithm = True
+
+    image = b""
+    image_latency = 0.0
+    webhook_latency = 0.0
+
+    def do_GET(self):
+        if self.path.startswith("/images/"):
+            latency, body, content_type = self.image_latency, self.image + self.path.encode(), "image/jpeg"
+        elif self.path.startswith("/webhook/"):
+            latency, body, content_type = self.webhook_latency, b"", "text/plain"
+        else:
+            self.send_error(404)
+            return
+
+        if latency:
+            time.sleep(latency)
+
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # benchmark opens hundreds of connections at once
+    request_queue_size = 1024
+
+
+def _serve(width: int, height: int, image_latency_ms: float, webhook_latency_ms: float, ready):
+    _StandInHandler.image = make_synthetic_image(width, height)
+    _StandInHandler.image_latency = image_latency_ms / 1000
+    _StandInHandler.webhook_latency = webhook_latency_ms / 1000
+
+    server = _StandInServer(("127.0.0.1", 0), _StandInHandler)
+    ready.send((server.server_address[1], len(_StandInHandler.image)))
+    server.serve_forever()
+
+
+class StandInHttpServer:
+    """
+    local http server standing in for the image hosts & webhook endpoints
+    it runs in its own process, so serving the images does not compete with the benchmarked code for the GIL
+    """
+
+    def __init__(self, width: int, height: int, image_latency_ms: float = 0, webhook_latency_ms: float = 0):
+        self.width = width
+        self.height = height
+        self.image_latency_ms = image_latency_ms
+        self.webhook_latency_ms = webhook_latency_ms
+        self.process = None
+        self.base_url = None
+        self.image_bytes = 0
+
+    def start(self) -> "StandInHttpServer":
+        context = get_context("spawn")
+        receiver, sender = context.Pipe(duplex=False)
+        self.process = context.Process(
+            target=_serve,
+            args=(self.width, self.height, self.image_latency_ms, self.webhook_latency_ms, sender),
+            daemon=True,
+        )
+        self.process.start()
+
+        port, self.image_bytes = receiver.recv()
+        self.base_url = f"http://127.0.0.1:{port}"
+        return self
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+
+
+class _InMemoryUploadStream(BytesIO):
+    """ writable stream to the in-memory storage, blob is saved once closed (not when closed due to error) """
+
+    def __init__(self, blobs: dict[str, bytes], path: str):
+        super().__init__()
+        self.blobs = blobs
+        self.path = path
+
+    def close(self):
+        if not self.closed:
+            self.blobs[self.path] = self.getvalue()
+        super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            super().close()
+        else:
+            self.close()
+
+
+class InMemoryStorageManager(GCPStorageManager):
+    """
+    GCPStorageManager keeping the blobs in a dict, with an optional latency per image upload
+    only the methods used by the image processor are backed by memory
+    """
+
+    def __init__(self, logger: logging.Logger, latency_ms: float = 0):
+        for env, value in STORAGE_ENVS.items():
+            os.environ.setdefault(env, value)
+
+        self.blobs: dict[str, bytes] = {}
+        self.latency = latency_ms / 1000
+        super().__init__(logger)
+
+    def _initialize_storage(self):
+        self.logger.info("In-memory storage initialized")
+
+    def prewarm(self):
+        # no client & connection to warm up
+        pass
+
+    def _upload_file_by_buffer(self, source_file_buffer: BytesIO, dest_file_path: str, content_type=f"image/img") -> str:
+        if self.latency:
+            time.sleep(self.latency)
+
+        self.blobs[dest_file_path] = source_file_buffer.getvalue()
+        return f"{self.public_file_path}{dest_file_path}"
+
+    async def _upload_file_by_buffer_async(self, session, source_file_buffer: BytesIO,
+                                           dest_file_path: str, content_type=f"image/img") -> str:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        self.blobs[dest_file_path] = source_file_buffer.getvalue()
+        return f"{self.public_file_path}{dest_file_path}"
+
+    def _open_download_stream(self, source_file_path: str) -> tuple[BytesIO, int]:
+        if source_file_path not in self.blobs:
+            raise Exception(f"File not found: {source_file_path}")
+
+        data = self.blobs[source_file_path]
+        return BytesIO(data), len(data)
+
+    def _open_upload_stream(self, dest_file_path: str, content_type: str) -> _InMemoryUploadStream:
+        return _InMemoryUploadStream(self.blobs, dest_file_path)
@@ -0,0 +1,207 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from threading import Lock
+from datetime import datetime
+import subprocess
+import statistics
+import argparse
+import platform
+import logging
+import json
+import time
+import sys
+import os
+
+# only light imports here: the startup runs in a fresh process & imports what it measures (upload.consumer & the stand-ins) itself
+
+IMPORT_MODULES = "upload.consumer,upload.processor,pandas,numpy,PIL.Image,aiohttp,google.cloud.storage,pymongo,kafka,redis"
+STARTUP_CSV = "startup.csv"
+
+
+def _import_seconds(module: str) -> float:
+    """ time to import the module in a fresh interpreter (own imports included, interpreter startup excluded) """
+    code = f"import time; started_at = time.perf_counter(); import {module}; print(time.perf_counter() - started_at)"
+    result = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            capture_output=True, text=True, check=True)
+    return float(result.stdout.strip())
+
+
+class _LazyClient:
+    """
+    stand-in client which connects lazily, as the mongo & gcs clients do:
+    its first use (any attribute) pays the connect latency, once, be it from the prewarm or from the first upload
+    """
+
+    def __init__(self, client, latency: float):
+        self._client = client
+        self._latency = latency
+        self._lock = Lock()
+        self._connected = False
+
+    def __getattr__(self, name: str):
+        with self._lock:
+            if not self._connected:
+                time.sleep(self._latency)
+                self._connected = True
+
+        return getattr(self._client, name)
+
+
+def _get_logger() -> logging.Logger:
+    logr = logging.getLogger("pixelriver-benchmark")
+    logr.setLevel(logging.WARNING)
+    if not logr.handlers:
+        logr.addHandler(logging.StreamHandler())
+    return logr
+
+
+def _run_startup(scenario: dict) -> dict:
+    """
+    starts the image processor services against the stand-ins & processes one small upload, as the consumer does
+    every backend pays `backendLatencyMs` to connect: redis & kafka when the client is created, mongo & gcs on first use
+    """
+    started_at = time.perf_counter()
+    os.environ.update(scenario["env"])
+    latency = scenario["backendLatencyMs"] / 1000
+
+    from core.startup import Startup, IMPORT_LOCK
+    import upload.consumer as consumer
+
+    logr = _get_logger()
+    backends = {}
+
+    # stand-in modules are imported under the import lock too, as the modules of the real clients are
+    def connect_mongo(logr: logging.Logger, prewarm: bool):
+        with IMPORT_LOCK:
+            import mongomock
+
+        backends["mongo"] = mongomock.MongoClient().get_database("benchmark")
+        mongoDbClient = _LazyClient(backends["mongo"], latency)
+        if prewarm:
+            mongoDbClient.command("ping")
+
+        # mongomock does not support the bulk writes of the write buffer, state is written directly
+        return mongoDbClient, None
+
+    def connect_redis(logr: logging.Logger):
+        with IMPORT_LOCK:
+            import fakeredis
+
+        time.sleep(latency)
+        return fakeredis.FakeRedis()
+
+    def connect_storage(logr: logging.Logger, prewarm: bool):
+        with IMPORT_LOCK:
+            from .standins import InMemoryStorageManager
+
+        backends["gcs"] = InMemoryStorageManager(logr)
+        storageManager = _LazyClient(backends["gcs"], latency)
+        if prewarm:
+            storageManager.prewarm()
+
+        return storageManager
+
+    def connect_kafka(logr: logging.Logger):
+        from core.kafka import UPLOAD_PROCESSING_TOPIC
+
+        time.sleep(latency)
+        return None, None, [UPLOAD_PROCESSING_TOPIC]
+
+    consumer._connect_mongo = connect_mongo
+    consumer._connect_redis = connect_redis
+    consumer._connect_storage = connect_storage
+    consumer._connect_kafka = connect_kafka
+
+    startup = Startup(logr, "image-processor", started_at)
+    services = consumer.initialize_image_processor_services(logr, startup)
+    startup.ready()
+    ready_at = startup.elapsed()
+
+    # first message: one small upload, put in the stand-ins directly (no connect latency for the test data)
+    storage = backends["gcs"]
+    storage.blobs[f"{storage.csv_download_path}/{STARTUP_CSV}"] = scenario["csv"].encode()
+    upload_id = backends["mongo"].get_collection("uploads").insert_one({"fileName": STARTUP_CSV, "webhookUrl": None}).inserted_id
+    services.new_processor().start_processing(str(upload_id))
+    first_message_at = startup.elapsed()
+
+    upload = backends["mongo"].get_collection("uploads").find_one({"_id": upload_id})
+    services.close()
+
+    return {
+        "readySec": round(ready_at, 3),
+        "firstMessageSec": round(first_message_at, 3),
+        "tasks": {name: round(seconds, 3) for name, seconds in sorted(startup.finished_at.items(), key=lambda item: item[1])},
+        "status": upload.get("status"),
+    }
+
+
+def run_startup(scenario: dict) -> dict:
+    """ runs the startup in a fresh (spawned) process, so nothing is imported or connected yet """
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+        return executor.submit(_run_startup, scenario).result()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmark.startup",
+        description="Benchmark of the image processor cold start: import time of its modules, "
+                    "time to ready & to the first handled message, with & without FAST_STARTUP",
+    )
+    parser.add_argument("--modules", default=IMPORT_MODULES, help="modules to time the import of, comma separated")
+    parser.add_argument("--modes", default="disable,enable", help="FAST_STARTUP values, comma separated")
+    parser.add_argument("--backend-latency-ms", type=float, default=200, help="connect latency of each backend (mongo, redis, gcs, kafka)")
+    parser.add_argument("--rows", type=int, default=5, help="csv size (rows) of the first upload")
+    parser.add_argument("--image-latency-ms", type=float, default=20, help="latency of the image server per request")
+    parser.add_argument("--repeat", type=int, default=5, help="runs of each import & startup, medians are reported")
+    parser.add_argument("--output", default=f"benchmark-startup-{datetime.now():%Y%m%d-%H%M%S}.json", help="json file for the results")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    imports = {}
+    for module in args.modules.split(","):
+        imports[module] = round(statistics.median(_import_seconds(module) * 1000 for _ in range(args.repeat)), 1)
+        print(f"import {module}: {imports[module]}ms", flush=True)
+
+    from .standins import StandInHttpServer
+    from .runner import build_csv
+
+    server = StandInHttpServer(640, 480, image_latency_ms=args.image_latency_ms).start()
+    try:
+        csv, _ = build_csv(server.base_url, args.rows, 1, 0, seed=42)
+        startups = []
+        for mode in args.modes.split(","):
+            scenario = {
+                "env": {"FAST_STARTUP": mode, "HTTP_PREWARM_URLS": server.base_url},
+                "backendLatencyMs": args.backend_latency_ms,
+                "csv": csv.decode(),
+            }
+            runs = [run_startup(scenario) for _ in range(args.repeat)]
+            result = {
+                "fastStartup": mode,
+                "readySec": round(statistics.median(run["readySec"] for run in runs), 3),
+                "firstMessageSec": round(statistics.median(run["firstMessageSec"] for run in runs), 3),
+                "runs": runs,
+            }
+            print(f"FAST_STARTUP={mode}: ready {result['readySec']}s, first message {result['firstMessageSec']}s", flush=True)
+            startups.append(result)
+    finally:
+        server.stop()
+
+    report = {
+        "createdAt": datetime.now().isoformat(),
+        "host": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "args": {key: value for key, value in vars(args).items() if key != "output"},
+        "importMs": imports,
+        "startups": startups,
+    }
+    with open(args.output, "w") as output:
+        json.dump(report, output, indent=2)
+
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
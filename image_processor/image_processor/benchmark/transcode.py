@@ -0,0 +1,124 @@
+from upload.transcoder import transcode_image, LOSSY_FORMATS
+from upload.profiles import BUILTIN_PROFILES, EncodingProfile, SOURCE_FORMAT
+from .standins import make_synthetic_image
+from datetime import datetime
+from PIL import Image
+from io import BytesIO
+import tracemalloc
+import argparse
+import platform
+import json
+import time
+
+
+def _baseline_transcode(image_data: bytes, profile: EncodingProfile) -> bytes:
+    """
+    the decode path as it was before the fast path: source bytes copied into the stream, full size decode,
+    conversion every time, a new output stream per encode (& its bytes copied out every time)
+    encoder options are the same as the fast path, so only the decode & buffer handling differ
+    """
+    img = Image.open(BytesIO(bytearray(image_data)))
+    img_format = img.format if profile.format == SOURCE_FORMAT else profile.format
+    if img_format not in LOSSY_FORMATS and not profile.max_size:
+        return image_data
+
+    img.load()
+    if profile.max_size and max(img.size) > profile.max_size:
+        scale = profile.max_size / max(img.size)
+        img = img.resize((round(img.width * scale), round(img.height * scale)), Image.Resampling.LANCZOS)
+    img = img.convert("RGBA" if img_format == "WEBP" and "A" in img.getbands() else "RGB")
+
+    options = {"progressive": profile.progressive, "optimize": profile.optimize} if img_format == "JPEG" else \
+        {"method": 6 if profile.optimize else 4} if img_format == "WEBP" else {}
+
+    def encode(quality: int) -> bytes:
+        output_buffer = BytesIO()
+        img.save(output_buffer, format=img_format, quality=quality, **options)
+        return output_buffer.getvalue()
+
+    if not profile.target_bytes:
+        return encode(profile.quality)
+
+    low, high, best = profile.min_quality, profile.quality, profile.min_quality
+    while low <= high:
+        quality = (low + high) // 2
+        if len(encode(quality)) <= profile.target_bytes:
+            best, low = quality, quality + 1
+        else:
+            high = quality - 1
+    return encode(best)
+
+
+def _fast_transcode(image_data: bytes, profile: EncodingProfile) -> bytes:
+    return transcode_image(image_data, profile).data
+
+
+def _measure(transcode, images: list[bytes], profile: EncodingProfile) -> dict:
+    """ images/sec of a timed pass, then allocations of a second pass (pillow blocks & python peak, per image) """
+    # warm up, so lazily loaded codecs & per-thread buffers are not counted
+    transcode(images[0], profile)
+
+    started_at = time.perf_counter()
+    for image_data in images:
+        transcode(image_data, profile)
+    elapsed = time.perf_counter() - started_at
+
+    stats_before = Image.core.get_stats()
+    tracemalloc.start()
+    peak = 0
+    for image_data in images:
+        tracemalloc.reset_peak()
+        transcode(image_data, profile)
+        peak += tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    stats_after = Image.core.get_stats()
+
+    count = len(images)
+    return {
+        "imagesPerSec": round(count / elapsed, 2),
+        "pillowImagesPerImage": round((stats_after["new_count"] - stats_before["new_count"]) / count, 2),
+        "pillowBlocksPerImage": round((stats_after["allocated_blocks"] - stats_before["allocated_blocks"]) / count, 2),
+        "pythonPeakKbPerImage": round(peak / count / 1024, 1),
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmark.transcode",
+        description="Micro benchmark of the transcode (decode & re-encode) of one image, fast path vs the earlier path",
+    )
+    parser.add_argument("--images", type=int, default=20, help="no. of distinct images transcoded per profile")
+    parser.add_argument("--image-size", default="3000x2000", help="WIDTHxHEIGHT of the synthetic jpeg images")
+    parser.add_argument("--profiles", default="default,jpeg-2048,webp-1024", help="encoding profiles, comma separated")
+    parser.add_argument("--output", default=f"benchmark-transcode-{datetime.now():%Y%m%d-%H%M%S}.json", help="json file for the results")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    width, height = (int(value) for value in args.image_size.lower().split("x"))
+    images = [make_synthetic_image(width, height) for _ in range(args.images)]
+
+    results = []
+    for name in args.profiles.split(","):
+        profile = BUILTIN_PROFILES[name]
+        result = {"profile": name}
+        for path, transcode in (("baseline", _baseline_transcode), ("fast", _fast_transcode)):
+            result[path] = _measure(transcode, images, profile)
+            print(f"{name} {path}: {result[path]}", flush=True)
+        results.append(result)
+
+    report = {
+        "createdAt": datetime.now().isoformat(),
+        "host": {"platform": platform.platform(), "python": platform.python_version()},
+        "args": {key: value for key, value in vars(args).items() if key != "output"},
+        "results": results,
+    }
+    with open(args.output, "w") as output:
+        json.dump(report, output, indent=2)
+
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,87 @@
 from google.cloud import storage
 from google.api_core.client_options import ClientOptions
 from google.auth.credentials import AnonymousCredentials  # Bypass auth
+from google.cloud.storage.fileio import BlobReader, BlobWriter
 from pathlib import Path
-from io import BytesIO
+from io import BytesIO, BufferedIOBase
+from typing import TYPE_CHECKING
 import logging
+import shutil
 import os
 
+if TYPE_CHECKING:
+    import aiohttp
+
+
+class UploadStream(BufferedIOBase):
+    """
+    writable stream to a GCP bucket blob
+    data is kept in memory until it crosses resumable_threshold, after that a resumable upload is started
+    and rest of the data is streamed in chunk_size parts, so large files are never fully held in memory.
+    Blob is created only when the stream is closed; if closed via `with` block due to error, nothing is uploaded.
+    """
+
+    def __init__(self, blob: storage.Blob, content_type: str, chunk_size: int, resumable_threshold: int):
+        super().__init__()
+        self.blob = blob
+        self.content_type = content_type
+        self.chunk_size = chunk_size
+        self.resumable_threshold = resumable_threshold
+        self.buffer = BytesIO()
+        self.writer: BlobWriter | None = None
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        if self.writer is not None:
+            return self.writer.write(data)
+
+        written = self.buffer.write(data)
+
+        # switch to resumable upload, once data is too big to keep in memory
+        if self.buffer.tell() > self.resumable_threshold:
+            self.writer = BlobWriter(self.blob, chunk_size=self.chunk_size, content_type=self.content_type)
+            self.writer.write(self.buffer.getvalue())
+            self.buffer = BytesIO()
+
+        return written
+
+    def close(self):
+        """ this will finish the upload """
+        if self.closed:
+            return
+
+        if self.writer is not None:
+            self.writer.close()
+        else:
+            self.buffer.seek(0)
+            self.blob.upload_from_file(self.buffer, content_type=self.content_type)
+
+        super().close()
+
+    def terminate(self):
+        """ this will cancel the upload, nothing is written to the bucket """
+        if self.writer is not None:
+            self.writer.terminate()
+        self.buffer = BytesIO()
+        super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            try:
+                self.terminate()
+            except Exception:
+                # do not hide the original error
+                pass
+        else:
+            self.close()
+
 
 class GCPStorageManager:
     def __init__(self, logger: logging.Logger):
         self.logger = logger
         self.client = None
-        self.base_path = os.path.join(os.getcwd())
 
         self.project_id = os.getenv("GCP_PROJECT_ID")
         self.endpoint = os.getenv("GCP_ENDPOINT")
@@ -23,6 +93,10 @@ class GCPStorageManager:
         self.csv_upload_path = os.getenv("GCP_IMAGE_DATA_CSV_UPLOAD_PATH")
         self.image_upload_path = os.getenv("GCP_IMAGE_DATA_IMG_UPLOAD_PATH")
 
+        # streaming reads/writes are done in these many bytes (must be multiple of 256KB for resumable upload)
+        self.stream_chunk_size = int(os.getenv("GCP_STREAM_CHUNK_SIZE", 8 * 1024 * 1024))
+        self.resumable_upload_threshold = int(os.getenv("GCP_RESUMABLE_UPLOAD_THRESHOLD", 8 * 1024 * 1024))
+
         self._validate_envs()
         self._initialize_storage()
 
@@ -44,6 +118,16 @@ class GCPStorageManager:
             self.logger.error(f"Failed to initialize GCP storage: {e}")
             raise
 
+    def prewarm(self):
+        """
+        makes a cheap request (lists one csv), so the client has its credentials & a pooled connection before the first upload
+        this will not raise exception even in case of error
+        """
+        try:
+            list(self.client.list_blobs(self.bucket_name, prefix=self.csv_download_path, max_results=1))
+        except Exception as e:
+            self.logger.warning(f"Failed to prewarm GCP storage: {e}")
+
     def _upload_file_by_path(self, source_file_path: str, dest_file_path: str, delete_file: bool = True) -> str:
         """ 
         this will take the path of source file and upload it to dest_file_path in GCP bucket
@@ -84,43 +168,92 @@ class GCPStorageManager:
             self.logger.error(f"Error uploading file to GCP: {e}")
             raise
 
-    def _download_from_filename(self, source_file_path: str, dest_file_path: str) -> str:
-        """ this will download the file from source_file_path in GCP bucket and store it in dest_file_path """
+    async def _upload_file_by_buffer_async(self, session: "aiohttp.ClientSession", source_file_buffer: BytesIO,
+                                           dest_file_path: str, content_type=f"image/img") -> str:
+        """
+        async version of _upload_file_by_buffer
+        this uses the JSON API (simple media upload) of the GCP_ENDPOINT directly via given aiohttp session
+        """
+        try:
+            async with session.post(
+                f"{self.endpoint}/upload/storage/v1/b/{self.bucket_name}/o",
+                params={"uploadType": "media", "name": dest_file_path},
+                data=source_file_buffer.getvalue(),
+                headers={"Content-Type": content_type},
+            ) as response:
+                if response.status != 200:
+                    raise Exception(f"Upload failed with status {response.status}: {await response.text()}")
 
+            return f"{self.public_file_path}{dest_file_path}"
+        except Exception as e:
+            self.logger.error(f"Error uploading file to GCP: {e}")
+            raise
+
+    def _open_download_stream(self, source_file_path: str) -> tuple[BlobReader, int]:
+        """
+        this will open the file at source_file_path in GCP bucket as readable stream
+        file is fetched in ranged requests of stream_chunk_size, as the stream is read
+        returns the stream along with the size of file
+        """
         try:
             bucket = self.client.bucket(self.bucket_name)
-            blob = bucket.blob(source_file_path)
-            blob.download_to_filename(dest_file_path)
+            blob = bucket.get_blob(source_file_path)
+            if blob is None:
+                raise Exception(f"File not found: {source_file_path}")
 
-            return dest_file_path
+            return blob.open("rb", chunk_size=self.stream_chunk_size), blob.size
         except Exception as e:
             self.logger.error(
-                f"Error downloading file from path: {source_file_path}. Error: {e}")
+                f"Error opening file from path: {source_file_path}. Error: {e}")
             raise e
 
+    def _open_upload_stream(self, dest_file_path: str, content_type: str) -> UploadStream:
+        """ this will open the writable stream to dest_file_path in GCP bucket """
+        bucket = self.client.bucket(self.bucket_name)
+        blob = bucket.blob(dest_file_path)
+
+        return UploadStream(blob, content_type, self.stream_chunk_size, self.resumable_upload_threshold)
+
     def upload_csv(self, file_buffer: BytesIO, filename: str) -> str:
-        """ this will upload the csv file to GCP bucket """
+        """ this will upload the csv file to GCP bucket, via the upload stream """
 
-        return self._upload_file_by_buffer(
-            source_file_buffer=file_buffer,
-            dest_file_path=f"{self.csv_upload_path}/{filename}",
-            content_type="text/csv"
-        )
+        try:
+            with self.open_csv_upload_stream(filename) as upload_stream:
+                shutil.copyfileobj(file_buffer, upload_stream, self.stream_chunk_size)
 
-    def upload_image(self, file_buffer: BytesIO, filename: str) -> str:
+            return f"{self.public_file_path}{self.csv_upload_path}/{filename}"
+        except Exception as e:
+            self.logger.error(f"Error uploading file to GCP: {e}")
+            raise
+
+    def upload_image(self, file_buffer: BytesIO, filename: str, content_type: str = "image/img") -> str:
         """ this will upload the image file to GCP bucket """
 
         return self._upload_file_by_buffer(
             source_file_buffer=file_buffer,
             dest_file_path=f"{self.image_upload_path}/{filename}",
-            content_type="image/img"
+            content_type=content_type
         )
 
-    def download_csv(self, filename: str) -> str:
-        """ this will download the csv file from GCP bucket and save to to tmp directory """
+    async def upload_image_async(self, session: "aiohttp.ClientSession", file_buffer: BytesIO, filename: str,
+                                 content_type: str = "image/img") -> str:
+        """ this will upload the image file to GCP bucket, via the given aiohttp session """
 
-        return self._download_from_filename(
-            source_file_path=f"{self.csv_download_path}/{filename}",
-            dest_file_path=os.path.join(
-                self.base_path, "tmp", "unprocessed", filename)
+        return await self._upload_file_by_buffer_async(
+            session=session,
+            source_file_buffer=file_buffer,
+            dest_file_path=f"{self.image_upload_path}/{filename}",
+            content_type=content_type
         )
+
+    def open_csv_upload_stream(self, filename: str) -> UploadStream:
+        """
+        this will open the writable stream for the csv file in GCP bucket
+        small files are uploaded in one go, large files via resumable upload
+        """
+        return self._open_upload_stream(f"{self.csv_upload_path}/{filename}", content_type="text/csv")
+
+    def open_csv_download_stream(self, filename: str) -> tuple[BlobReader, int]:
+        """ this will open the csv file in GCP bucket as readable stream, returns the stream & file size """
+
+        return self._open_download_stream(f"{self.csv_download_path}/{filename}")
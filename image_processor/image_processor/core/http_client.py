@@ -0,0 +1,92 @@
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import requests
+import logging
+import os
+
+RETRY_STATUS_CODES = [500, 502, 503, 504]
+
+
+class HttpClient(requests.Session):
+    """
+    requests.Session with pooled keep-alive connections, default timeouts and retries
+    one instance is meant to be shared by all the threads of a service
+    """
+
+    def __init__(self, pool_size: int, connect_timeout: float, read_timeout: float, max_retries: int, retry_backoff: float):
+        super().__init__()
+        self.timeout = (connect_timeout, read_timeout)
+
+        # retry on connection errors/resets & 5xx with exponential backoff
+        # raise_on_status=False returns the last response, so caller can handle the status code
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=retry_backoff,
+            status_forcelist=RETRY_STATUS_CODES,
+            raise_on_status=False,
+        )
+
+        # pool_maxsize is per host, so all workers hitting the same CDN can keep their connections alive
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+    def request(self, method, url, **kwargs):
+        """ same as requests.Session.request, but applies the default timeout if not given """
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
+
+    def prewarm(self, urls: list[str], connections: int) -> int:
+        """
+        opens upto `connections` keep-alive connections to the host of each url (via concurrent HEAD requests),
+        so the first requests to these hosts do not pay for the connect & tls handshake. returns the no. of successful requests
+        """
+        def head(url: str) -> bool:
+            try:
+                self.head(url, allow_redirects=False).close()
+                return True
+            except requests.RequestException:
+                return False
+
+        targets = [url for url in urls for _ in range(connections)]
+        if not targets:
+            return 0
+
+        with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+            return sum(executor.map(head, targets))
+
+
+def initialize_http_client(logr: logging.Logger, pool_size: int, connect_timeout: float, read_timeout: float,
+                           max_retries: int, retry_backoff: float) -> HttpClient:
+    """ This will initialize the shared http client and return it """
+    try:
+        client = HttpClient(pool_size, connect_timeout, read_timeout, max_retries, retry_backoff)
+
+        logr.info(f"Http client initialized with pool size {pool_size}")
+
+        return client
+    except Exception as error:
+        logr.error(f"Failed to initialize http client: {error}")
+        raise error
+
+
+def get_http_prewarm_urls() -> list[str]:
+    """ urls (e.g. one per main image cdn) whose hosts get pooled connections before the service is ready """
+    return [url.strip() for url in os.getenv("HTTP_PREWARM_URLS", "").split(",") if url.strip()]
+
+
+def get_http_client(logr: logging.Logger, pool_size: int = 10, max_retries: int | None = None) -> HttpClient:
+    """
+    This will return the http client configured via envs
+    max_retries overrides HTTP_MAX_RETRIES, e.g. 0 when caller does its own retries
+    """
+
+    return initialize_http_client(
+        logr,
+        pool_size=pool_size,
+        connect_timeout=float(os.getenv("HTTP_CONNECT_TIMEOUT", 5)),
+        read_timeout=float(os.getenv("HTTP_READ_TIMEOUT", 30)),
+        max_retries=max_retries if max_retries is not None else int(os.getenv("HTTP_MAX_RETRIES", 3)),
+        retry_backoff=float(os.getenv("HTTP_RETRY_BACKOFF", 0.5)),
+    )
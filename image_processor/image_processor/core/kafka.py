@@ -1,27 +1,49 @@
-from kafka import KafkaConsumer
+from kafka import KafkaConsumer, KafkaProducer, ConsumerRebalanceListener, TopicPartition
+from kafka.consumer.fetcher import ConsumerRecord
+from kafka.structs import OffsetAndMetadata
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from threading import Event
+from queue import Queue, Empty
+from typing import Callable
 import logging
+import time
 import os
 
 UPLOAD_PROCESSING_TOPIC = "pixelriver-new-upload"
 
+# image batches of the uploads split across image processors (fan-out mode)
+IMAGE_BATCH_TOPIC = "pixelriver-image-batch"
+
+
+class RedeliverMessage(Exception):
+    """ raised by the handler of ConcurrentConsumer, when the message is to be processed again (e.g. backing service is down) """
+
+
+def _get_kafka_brokers(logr: logging.Logger) -> list[str]:
+    # ensure kafka brokers are there
+    kafka_brokers = os.getenv("KAFKA_BROKERS")
+    if not kafka_brokers:
+        logr.error("KAFKA_BROKERS is not defined")
+        raise ValueError("KAFKA_BROKERS is not defined")
+
+    return kafka_brokers.split(",")
+
 
 def initialize_kafka_consumer(logr: logging.Logger) -> KafkaConsumer:
-    """ This will initialize kafka consumer and return the consumer instance """
+    """
+    This will initialize kafka consumer and return the consumer instance
+    offsets are not auto committed, consumer has to commit them once the message is processed
+    """
     try:
-        # ensure kafka brokers are there
-        kafka_brokers = os.getenv("KAFKA_BROKERS")
-        if not kafka_brokers:
-            logr.error("KAFKA_BROKERS is not defined")
-            raise ValueError("KAFKA_BROKERS is not defined")
+        kafka_brokers = _get_kafka_brokers(logr)
 
-        kafka_brokers = kafka_brokers.split(",")
-
-        # create kafka consumer for topic
+        # create kafka consumer, it is subscribed to topics by the ConcurrentConsumer
         consumer = KafkaConsumer(
-            UPLOAD_PROCESSING_TOPIC,
             bootstrap_servers=kafka_brokers,
+            group_id=os.getenv("KAFKA_CONSUMER_GROUP", "pixelriver-image-processor"),
             auto_offset_reset="earliest",
-            enable_auto_commit=True,
+            enable_auto_commit=False,
         )
 
         logr.info("Kafka consumer connected")
@@ -30,3 +52,185 @@ def initialize_kafka_consumer(logr: logging.Logger) -> KafkaConsumer:
     except Exception as error:
         logr.error(error)
         raise error
+
+
+def initialize_kafka_producer(logr: logging.Logger) -> KafkaProducer:
+    """ This will initialize kafka producer and return the producer instance """
+    try:
+        producer = KafkaProducer(bootstrap_servers=_get_kafka_brokers(logr), acks="all")
+
+        logr.info("Kafka producer connected")
+
+        return producer
+    except Exception as error:
+        logr.error(error)
+        raise error
+
+
+class ConcurrentConsumer(ConsumerRebalanceListener):
+    """
+    This class consumes the topics and runs the handler for upto `concurrency` messages at once.
+
+    Delivery is at-least-once:
+        - offset of a partition is committed only after all the messages before it are handled
+        - so if worker dies in between, uncommitted messages are redelivered
+    When all the handler slots are busy, assigned partitions are paused (poll still keeps the group membership alive)
+    and they are resumed once a slot frees up.
+
+    If the handler raises RedeliverMessage, its partition is rewound to the message & paused for `retry_delay_ms`,
+    so the message (& the ones after it, which are not committed either) is fetched & handled again.
+    Any other error of the handler is logged & the message is done.
+
+    KafkaConsumer is not thread safe, so only the run() thread touches it.
+    Handler threads report the completion back via queue.
+    """
+
+    def __init__(self, logr: logging.Logger, consumer: KafkaConsumer, topics: list[str],
+                 handler: Callable[[ConsumerRecord], None], concurrency: int, poll_timeout_ms: int = 500,
+                 retry_delay_ms: int = 5000):
+        self.logr = logr
+        self.consumer = consumer
+        self.topics = topics
+        self.handler = handler
+        self.concurrency = max(concurrency, 1)
+        self.poll_timeout_ms = poll_timeout_ms
+        self.retry_delay_ms = retry_delay_ms
+
+        self.stop_event = Event()
+        self.completed: Queue[tuple[TopicPartition, int, list[bool], bool]] = Queue()
+
+        # per partition in-flight offsets in fetch order, offset -> [done]
+        # (entry is compared by identity, so completion of a message which was rewound meanwhile is ignored)
+        self.pending: dict[TopicPartition, OrderedDict[int, list[bool]]] = {}
+        self.in_flight = 0
+
+        # partitions rewound for redelivery, paused until this time (monotonic)
+        self.retry_at: dict[TopicPartition, float] = {}
+
+    def stop(self, *args):
+        """ this will stop fetching new messages, in-flight messages are drained by run() before it returns """
+        self.logr.info("Stopping kafka consumer, draining in-flight messages...")
+        self.stop_event.set()
+
+    def run(self):
+        """ this will consume the messages until stop() is called, then drains in-flight messages & closes consumer """
+        self.consumer.subscribe(self.topics, listener=self)
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while not self.stop_event.is_set():
+                self._update_paused()
+
+                records = self.consumer.poll(
+                    timeout_ms=self.poll_timeout_ms,
+                    max_records=max(self.concurrency - self.in_flight, 1)
+                )
+                for tp, messages in records.items():
+                    for message in messages:
+                        self._submit(executor, tp, message)
+
+                self._commit_completed()
+
+            # stop fetching, keep polling (for group heartbeat) until in-flight messages are done
+            self.consumer.pause(*self.consumer.assignment())
+            while self.in_flight > 0:
+                self.consumer.poll(timeout_ms=self.poll_timeout_ms)
+                self._commit_completed(block=True)
+
+        self.consumer.close()
+        self.logr.info("Kafka consumer closed")
+
+    def _submit(self, executor: ThreadPoolExecutor, tp: TopicPartition, message: ConsumerRecord):
+        entry = [False]
+        self.pending.setdefault(tp, OrderedDict())[message.offset] = entry
+        self.in_flight += 1
+        executor.submit(self._handle, tp, message, entry)
+
+    def _handle(self, tp: TopicPartition, message: ConsumerRecord, entry: list[bool]):
+        """ runs in handler thread """
+        redeliver = False
+        try:
+            self.handler(message)
+        except RedeliverMessage as e:
+            self.logr.warning(f"Message {tp.topic}:{tp.partition}:{message.offset} will be redelivered: {e}")
+            redeliver = True
+        except Exception as e:
+            # do not raise error, message is still marked as done (same as processing it synchronously)
+            self.logr.exception(e)
+        finally:
+            self.completed.put((tp, message.offset, entry, redeliver))
+
+    def _update_paused(self):
+        """ pause the partitions when all handler slots are busy, resume otherwise (except the ones waiting to redeliver) """
+        now = time.monotonic()
+        self.retry_at = {tp: retry_at for tp, retry_at in self.retry_at.items() if retry_at > now}
+
+        if self.in_flight >= self.concurrency:
+            self.consumer.pause(*self.consumer.assignment())
+            return
+
+        resumable = [tp for tp in self.consumer.paused() if tp not in self.retry_at]
+        if resumable:
+            self.consumer.resume(*resumable)
+
+    def _commit_completed(self, block: bool = False):
+        """ this will mark the completed messages as done and commit the contiguous done offsets per partition """
+        try:
+            item = self.completed.get(timeout=self.poll_timeout_ms / 1000) if block else self.completed.get_nowait()
+        except Empty:
+            return
+
+        done_partitions = set()
+        while item is not None:
+            tp, offset, entry, redeliver = item
+            self.in_flight -= 1
+            # partition can be revoked (or rewound) while message was in-flight, its offset is not ours to commit anymore
+            if self.pending.get(tp, {}).get(offset) is entry:
+                if redeliver:
+                    self._rewind(tp, offset)
+                else:
+                    entry[0] = True
+                done_partitions.add(tp)
+            try:
+                item = self.completed.get_nowait()
+            except Empty:
+                item = None
+
+        offsets = {}
+        for tp in done_partitions:
+            pending = self.pending[tp]
+            last_done = None
+            while pending and next(iter(pending.values()))[0]:
+                last_done, _ = pending.popitem(last=False)
+            if last_done is not None:
+                offsets[tp] = OffsetAndMetadata(last_done + 1, None, -1)
+
+        self._commit(offsets)
+
+    def _rewind(self, tp: TopicPartition, offset: int):
+        """ fetch the partition again from the offset (after retry delay), messages from there on are forgotten till then """
+        pending = self.pending[tp]
+        for later_offset in [pending_offset for pending_offset in pending if pending_offset >= offset]:
+            del pending[later_offset]
+
+        self.consumer.seek(tp, offset)
+        self.consumer.pause(tp)
+        self.retry_at[tp] = time.monotonic() + self.retry_delay_ms / 1000
+
+    def _commit(self, offsets: dict[TopicPartition, OffsetAndMetadata]):
+        if not offsets:
+            return
+        try:
+            self.consumer.commit(offsets)
+        except Exception as e:
+            # do not raise error, uncommitted messages will be redelivered
+            self.logr.error(f"Error while committing kafka offsets: {e}")
+
+    def on_partitions_revoked(self, revoked):
+        """ commit whatever is done for the revoked partitions and forget them """
+        self._commit_completed()
+        for tp in revoked:
+            self.pending.pop(tp, None)
+            self.retry_at.pop(tp, None)
+
+    def on_partitions_assigned(self, assigned):
+        self.logr.info(f"Kafka partitions assigned: {assigned}")
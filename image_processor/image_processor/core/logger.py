@@ -1,6 +1,95 @@
+from logging.handlers import QueueHandler, QueueListener
+from datetime import datetime, timezone
+from threading import Lock
+from logging import Logger
+from queue import Queue, Full
 import logging
+import random
+import atexit
+import json
 import os
-from logging import Logger
+
+from .metrics import METRICS
+
+LOG_RECORDS_DROPPED = METRICS.counter("pixelriver_log_records_dropped_total", "Log records dropped as the log queue was full")
+
+# attributes every LogRecord has, anything else on the record came via `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "taskName"}
+
+# loggers initialized so far (service name -> logger), so handlers are attached only once
+_loggers: dict[str, Logger] = {}
+_loggers_lock = Lock()
+
+
+class JsonFormatter(logging.Formatter):
+    """ formats the record as one line of json: time, level, logger, service, message, thread, exception & the `extra` fields """
+
+    def __init__(self, service_name: str):
+        super().__init__()
+        self.service_name = service_name
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "service": self.service_name,
+            "message": record.getMessage(),
+            "thread": record.threadName,
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES})
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+
+        return json.dumps(entry, default=str)
+
+
+class _NonBlockingQueueHandler(QueueHandler):
+    """
+    QueueHandler which never blocks the logging thread, record is dropped (& counted) if the queue is full
+    record is prepared here (message merged, exception formatted) as args/exc_info may not be picklable or may change later,
+    but it is formatted to json/text only in the listener thread
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            LOG_RECORDS_DROPPED.inc()
+
+
+def get_image_log_sample_rate() -> float:
+    """ fraction of the per image debug events which are logged (only when LOG_LEVEL is DEBUG) """
+    return float(os.getenv("LOG_IMAGE_SAMPLE_RATE", 0.01))
+
+
+def log_image_event(logr: Logger, message: str, **fields):
+    """
+    logs a per image debug event, sampled by LOG_IMAGE_SAMPLE_RATE
+    so log volume does not grow with the no. of images, fields become the keys of json record
+    """
+    if logr.isEnabledFor(logging.DEBUG) and random.random() < get_image_log_sample_rate():
+        logr.debug(message, extra=fields)
+
+
+def _get_formatter(service_name: str) -> logging.Formatter:
+    """ json records (default), or the plain text ones if LOG_FORMAT is text """
+    if os.getenv("LOG_FORMAT") == "text":
+        return logging.Formatter("%(asctime)s %(name)s %(levelname)s: %(message)s")
+
+    return JsonFormatter(service_name)
 
 
 def initialize_logger(service_name: str) -> Logger:
@@ -8,40 +97,55 @@ def initialize_logger(service_name: str) -> Logger:
     This function will initialize the Python logger
     Logs will be stored in logs/error.log & logs/combined.log files
     It also checks if console logging is enabled or not. If enabled, it will log to the console as well.
+
+    Logging call only puts the record in a queue, a listener thread writes it to the files (& console),
+    so worker threads never wait on the disk. Calling it again for the same service returns the same logger.
     """
 
-    logs_path = os.path.join(os.getcwd(), "logs", service_name)
+    with _loggers_lock:
+        if service_name in _loggers:
+            return _loggers[service_name]
+
+        logs_path = os.path.join(os.getcwd(), "logs", service_name)
+
+        # Ensure the logs directory exists
+        os.makedirs(logs_path, exist_ok=True)
+
+        # Create logger instance, records are not passed to the root logger (it has handlers of its own, if any)
+        logger = logging.getLogger(f"pixelriver.{service_name}")
+        logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+        logger.propagate = False
+
+        # Create log format
+        formatter = _get_formatter(service_name)
 
-    # Ensure the logs directory exists
-    os.makedirs(logs_path, exist_ok=True)
+        # File handler for error logs
+        error_handler = logging.FileHandler(f"{logs_path}/error.log")
+        error_handler.setLevel(logging.ERROR)
+        error_handler.setFormatter(formatter)
 
-    # Create logger instance
-    logger = logging.getLogger("pixelriver")
-    logger.setLevel(logging.INFO)
+        # File handler for combined logs
+        combined_handler = logging.FileHandler(f"{logs_path}/combined.log")
+        combined_handler.setFormatter(formatter)
 
-    # Create log format
-    formatter = logging.Formatter("%(asctime)s %(name)s %(levelname)s: %(message)s")
+        handlers: list[logging.Handler] = [error_handler, combined_handler]
 
-    # File handler for error logs
-    error_handler = logging.FileHandler(f"{logs_path}/error.log")
-    error_handler.setLevel(logging.ERROR)
-    error_handler.setFormatter(formatter)
+        # Log to console if enabled
+        if os.getenv("CONSOLE_LOGGING") == "enable":
+            console_handler = logging.StreamHandler()
+            console_handler.setFormatter(formatter)
+            handlers.append(console_handler)
 
-    # File handler for combined logs
-    combined_handler = logging.FileHandler(f"{logs_path}/combined.log")
-    combined_handler.setLevel(logging.INFO)
-    combined_handler.setFormatter(formatter)
+        # handlers run in the listener thread, logger only enqueues
+        log_queue = Queue(maxsize=int(os.getenv("LOG_QUEUE_SIZE", 10000)))
+        listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        listener.start()
 
-    # Add handlers to logger
-    logger.addHandler(error_handler)
-    logger.addHandler(combined_handler)
+        # write the queued records before exit
+        atexit.register(listener.stop)
 
-    # Log to console if enabled
-    if os.getenv("CONSOLE_LOGGING") == "enable":
-        console_handler = logging.StreamHandler()
-        console_handler.setLevel(logging.INFO)
-        console_handler.setFormatter(formatter)
-        logger.addHandler(console_handler)
+        logger.addHandler(_NonBlockingQueueHandler(log_queue))
+        _loggers[service_name] = logger
 
     logger.info(
         "Logger initialized. Please check the logs dir for further logging info.")
@@ -50,5 +154,5 @@ def initialize_logger(service_name: str) -> Logger:
 
 
 def get_logger(service_name: str) -> Logger:
-    """ Initialize and return the new logger instance """
+    """ Initialize (once per service) and return the logger instance """
     return initialize_logger(service_name)
@@ -0,0 +1,206 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from contextlib import contextmanager
+from threading import Thread, Lock, Event
+from bisect import bisect_left
+import logging
+import time
+import os
+
+# seconds, suits everything from a redis call to a whole upload
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+
+
+def _format_labels(labelnames: tuple[str, ...], labelvalues: tuple[str, ...], extra: str = "") -> str:
+    labels = [f'{name}="{value}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = Lock()
+
+    def _key(self, labels: dict) -> tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+
+
+class Counter(_Metric):
+    """ value which only goes up, e.g. no. of images processed """
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        with self.lock:
+            values = dict(self.values)
+        return super().render() + [f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in values.items()]
+
+
+class Gauge(Counter):
+    """ value which goes up & down, e.g. no. of webhooks pending """
+    type = "gauge"
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(_Metric):
+    """ distribution of observed values (e.g. durations) in cumulative buckets, along with their sum & count """
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [count per bucket (last one is +Inf), sum]
+        self.values: dict[tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts, _ = state = self.values.setdefault(key, [[0] * (len(self.buckets) + 1), 0.0])
+            counts[bisect_left(self.buckets, value)] += 1
+            state[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """ observes the duration (seconds) of the with block """
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def render(self) -> list[str]:
+        with self.lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self.values.items()}
+
+        lines = super().render()
+        for key, (counts, total) in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                labels = _format_labels(self.labelnames, key, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """ all the metrics of the process, rendered in prometheus text format """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.metrics: dict[str, _Metric] = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        # same metric can be declared by multiple modules, first declaration wins
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple[str, ...] = (),
+                  buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+
+# process wide registry
+METRICS = MetricsRegistry()
+
+# set once the service is warmed up & can process messages, /ready of the metrics server reports it
+_ready = Event()
+
+
+def set_ready(ready: bool = True):
+    """ marks the service (un)ready, e.g. ready once started & unready on shutdown """
+    if ready:
+        _ready.set()
+    else:
+        _ready.clear()
+
+
+def is_ready() -> bool:
+    return _ready.is_set()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/ready":
+            # readiness probe, 503 till the service is warmed up (& after it starts shutting down)
+            ready = is_ready()
+            self._send_text(200 if ready else 503, "ready" if ready else "not ready")
+            return
+
+        if path != "/metrics":
+            self.send_error(404)
+            return
+
+        self._send_text(200, METRICS.render(), "text/plain; version=0.0.4; charset=utf-8")
+
+    def _send_text(self, status: int, text: str, content_type: str = "text/plain; charset=utf-8"):
+        body = text.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def initialize_metrics_server(logr: logging.Logger, port: int) -> ThreadingHTTPServer:
+    """ this will start the http server exposing the metrics on /metrics (& readiness on /ready), in a background thread """
+    try:
+        server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+        server.daemon_threads = True
+        Thread(target=server.serve_forever, daemon=True).start()
+
+        logr.info(f"Metrics server started on port {port}")
+
+        return server
+    except Exception as error:
+        logr.error(f"Failed to start metrics server: {error}")
+        raise error
+
+
+def get_metrics_server(logr: logging.Logger) -> ThreadingHTTPServer | None:
+    """ starts the metrics server on METRICS_PORT, metrics are not exposed if it is not set """
+    port = int(os.getenv("METRICS_PORT", 0))
+    if not port:
+        return None
+
+    return initialize_metrics_server(logr, port)
@@ -1,20 +1,40 @@
-from pymongo import MongoClient
-import os
-import logging
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
 from pymongo.database import Database
+from pymongo.write_concern import WriteConcern
+from concurrent.futures import Future
+from threading import Thread, Lock, Event
+import logging
 import os
 
+# one client (& connection pool) per process, keyed by db url
+_mongo_clients: dict[str, MongoClient] = {}
+_mongo_clients_lock = Lock()
+
+
+def _get_write_concern() -> WriteConcern:
+    """ write concern as per MONGO_WRITE_CONCERN (e.g. 1, majority) & MONGO_WRITE_CONCERN_JOURNAL """
+    w = os.getenv("MONGO_WRITE_CONCERN", "1")
+    return WriteConcern(
+        w=int(w) if w.isdigit() else w,
+        j=True if os.getenv("MONGO_WRITE_CONCERN_JOURNAL") == "enable" else None
+    )
+
 
 def initialize_mongo_db(logr: logging.Logger, db_url: str, db_name: str) -> Database:
-    """ This function initializes the MongoDB client and returns the database instance """
+    """
+    This function initializes the MongoDB client and returns the database instance
+    client is created once per process, later calls share the same client
+    """
     try:
-        client = MongoClient(db_url)
-        db = client.get_database(db_name)
-
-        logr.info("Connected successfully to MongoDB server")
+        with _mongo_clients_lock:
+            client = _mongo_clients.get(db_url)
+            if client is None:
+                client = MongoClient(db_url, maxPoolSize=int(os.getenv("MONGO_MAX_POOL_SIZE", 100)))
+                _mongo_clients[db_url] = client
+                logr.info("Connected successfully to MongoDB server")
 
-        return db
+        return client.get_database(db_name, write_concern=_get_write_concern())
     except Exception as error:
         logr.error(f"MongoDB Connection Failure: {error}")
         raise error
@@ -29,8 +49,138 @@ def get_mongo_db(logr: logging.Logger) -> Database:
         raise ValueError("MONGO_DB_URI is not defined")
 
     db_name = os.getenv("MONGO_DB_NAME")
-    if not db_url:
+    if not db_name:
         logr.error("MONGO_DB_NAME is not defined")
         raise ValueError("MONGO_DB_NAME is not defined")
 
     return initialize_mongo_db(logr, db_url, db_name)
+
+
+def get_mongo_write_timeout() -> float:
+    """ seconds to wait for a buffered write, before giving up on it """
+    return float(os.getenv("MONGO_WRITE_TIMEOUT", 30))
+
+
+class MongoWriteBuffer:
+    """
+    This class buffers the update operations & writes them in batches via bulk_write(ordered=False).
+    Buffer is flushed when it has batch_size operations or every flush_interval_ms, whichever comes first,
+    and on close().
+
+    Each update_one() returns a Future, which is resolved once the operation is written,
+    so caller can wait for it (or attach a callback) when it needs the write to be durable.
+    $set updates on the same document are merged while buffered, as unordered bulk writes can apply in any order.
+    """
+
+    def __init__(self, logr: logging.Logger, db: Database, batch_size: int | None = None, flush_interval_ms: int | None = None):
+        self.logr = logr
+        self.db = db
+        self.batch_size = batch_size or int(os.getenv("MONGO_WRITE_BATCH_SIZE", 500))
+        self.flush_interval = (flush_interval_ms or int(os.getenv("MONGO_WRITE_FLUSH_INTERVAL_MS", 200))) / 1000
+
+        self.lock = Lock()
+        self.flush_lock = Lock()
+        # (collection, filter) -> [update, filter, futures]
+        self.buffer: dict[tuple[str, str], list] = {}
+
+        self.closed = Event()
+        self.flusher = Thread(target=self._flush_periodically, daemon=True)
+        self.flusher.start()
+
+    def update_one(self, collection_name: str, filter: dict, update: dict) -> Future:
+        """ buffer the update of one document, returns the future resolved once it is written """
+        future = Future()
+        key = (collection_name, repr(sorted(filter.items())))
+        operation = [{op: dict(value) for op, value in update.items()}, filter, [future]]
+
+        # lookup, merge & insert happen under one lock, so concurrent updates of a document do not overwrite each other
+        with self.lock:
+            pending = self.buffer.get(key)
+            if pending is not None and self._can_merge(pending, update):
+                pending[0]["$set"].update(update["$set"])
+                pending[2].append(future)
+                return future
+
+            if pending is None:
+                self.buffer[key] = operation
+                is_full = len(self.buffer) >= self.batch_size
+
+        if pending is not None:
+            # can not merge, so the pending one is written first to keep the order,
+            # this one is buffered in the same step (under flush lock, so no other flush writes it before)
+            with self.flush_lock:
+                with self.lock:
+                    pending = self.buffer.get(key)
+                    if pending is not None and self._can_merge(pending, update):
+                        pending[0]["$set"].update(update["$set"])
+                        pending[2].append(future)
+                        return future
+
+                    buffer = {}
+                    if pending is not None:
+                        buffer, self.buffer = self.buffer, {}
+                    self.buffer[key] = operation
+                    is_full = len(self.buffer) >= self.batch_size
+
+                self._write(buffer)
+
+        if is_full:
+            self.flush()
+
+        return future
+
+    @staticmethod
+    def _can_merge(pending: list, update: dict) -> bool:
+        return set(pending[0]) == set(update) == {"$set"}
+
+    def flush(self):
+        """ write all the buffered operations """
+        with self.flush_lock:
+            with self.lock:
+                buffer, self.buffer = self.buffer, {}
+
+            self._write(buffer)
+
+    def _write(self, buffer: dict[tuple[str, str], list]):
+        """ writes the operations (caller holds flush lock) & resolves their futures, each as per its own result """
+        if not buffer:
+            return
+
+        by_collection: dict[str, list] = {}
+        for (collection_name, _), operation in buffer.items():
+            by_collection.setdefault(collection_name, []).append(operation)
+
+        for collection_name, operations in by_collection.items():
+            errors: dict[int, Exception] = {}
+            try:
+                self.db.get_collection(collection_name).bulk_write(
+                    [UpdateOne(filter, update) for update, filter, _ in operations],
+                    ordered=False
+                )
+            except BulkWriteError as e:
+                # unordered bulk write, operations not in writeErrors are written (unless the write concern failed)
+                failed = len(e.details.get("writeErrors", []))
+                self.logr.error(f"Error while writing {failed} of {len(operations)} buffered updates to {collection_name}: {e}")
+                if e.details.get("writeConcernErrors"):
+                    errors = {index: e for index in range(len(operations))}
+                else:
+                    errors = {error["index"]: Exception(error.get("errmsg", "write error")) for error in e.details.get("writeErrors", [])}
+            except Exception as e:
+                # do not raise error, callers get it via their futures
+                self.logr.error(f"Error while writing {len(operations)} buffered updates to {collection_name}: {e}")
+                errors = {index: e for index in range(len(operations))}
+
+            for index, (_, _, futures) in enumerate(operations):
+                error = errors.get(index)
+                for future in futures:
+                    future.set_exception(error) if error is not None else future.set_result(True)
+
+    def close(self):
+        """ flush whatever is buffered and stop the periodic flush """
+        self.closed.set()
+        self.flusher.join()
+        self.flush()
+
+    def _flush_periodically(self):
+        while not self.closed.wait(self.flush_interval):
+            self.flush()
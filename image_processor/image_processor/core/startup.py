@@ -0,0 +1,141 @@
+from concurrent.futures import ThreadPoolExecutor, Future
+from threading import Lock, RLock, Event
+from logging import Logger
+import importlib
+import time
+import os
+
+from .metrics import METRICS, set_ready
+
+STARTUP_SECONDS = METRICS.gauge(
+    "pixelriver_startup_seconds",
+    "Seconds since process start at which each startup task finished, the service got ready & handled its first message",
+    ("service", "stage"),
+)
+
+# imports of the startup tasks are done one at a time: concurrent imports of packages with import cycles (pymongo, google)
+# can see a partially initialized module, and imports hold the GIL anyway, only the waits on the network run in parallel
+IMPORT_LOCK = RLock()
+
+
+def is_fast_startup_enabled() -> bool:
+    """ if enabled, backend clients are initialized in parallel & connection pools are prewarmed before the service is ready """
+    return os.getenv("FAST_STARTUP") == "enable"
+
+
+class Startup:
+    """
+    This class runs the init tasks of a service & records when each of them finished (since the process started):
+        - fast startup: every task runs in its own thread right away, so waiting on one backend (connect, handshake)
+          overlaps with the others & with the imports done by the tasks
+        - otherwise tasks run one after another, in the order they are submitted
+    Modules a task needs are imported (under IMPORT_LOCK) before it runs, in the order the tasks are submitted,
+    so the tasks submitted first start waiting on their backends early, while the next ones import.
+    Tasks can wait for the tasks they depend on via the future returned by submit.
+    Once all are done, the service is marked ready (/ready of the metrics server & READINESS_FILE, if set).
+    """
+
+    def __init__(self, logr: Logger, service_name: str, started_at: float, parallel: bool | None = None):
+        self.logr = logr
+        self.service_name = service_name
+        # perf_counter at process start (taken before the imports)
+        self.started_at = started_at
+        self.parallel = is_fast_startup_enabled() if parallel is None else parallel
+
+        self.lock = Lock()
+        self.tasks: dict[str, Future] = {}
+        self.finished_at: dict[str, float] = {}
+        self.first_message_seen = False
+        # set once the imports of the last submitted task are done
+        self.last_imports: Event | None = None
+        # tasks mostly wait (network, imports of the previous tasks), so a thread for each, not as per the cpus
+        self.executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="startup") if self.parallel else None
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started_at
+
+    def submit(self, name: str, fn, *args, imports: tuple[str, ...] = (), **kwargs) -> Future:
+        """
+        runs the task (in a thread if parallel, right away otherwise) & returns the future of its result
+        imports are the (absolute) names of the modules the task needs, imported before it runs
+        """
+        previous_imports, self.last_imports = self.last_imports, Event()
+        if self.executor is not None:
+            future = self.executor.submit(self._run, name, imports, previous_imports, self.last_imports, fn, *args, **kwargs)
+        else:
+            future = Future()
+            try:
+                future.set_result(self._run(name, imports, previous_imports, self.last_imports, fn, *args, **kwargs))
+            except Exception as error:
+                future.set_exception(error)
+
+        self.tasks[name] = future
+        return future
+
+    def preload(self, name: str, *modules: str) -> Future:
+        """ task importing the modules only, e.g. the ones needed by the first message """
+        return self.submit(name, lambda: None, imports=modules)
+
+    def _run(self, name: str, imports: tuple[str, ...], previous_imports: Event | None, imports_done: Event, fn, *args, **kwargs):
+        try:
+            try:
+                if previous_imports is not None:
+                    previous_imports.wait()
+                for module in imports:
+                    with IMPORT_LOCK:
+                        importlib.import_module(module)
+            finally:
+                imports_done.set()
+
+            return fn(*args, **kwargs)
+        finally:
+            finished_at = self.elapsed()
+            with self.lock:
+                self.finished_at[name] = finished_at
+            STARTUP_SECONDS.set(round(finished_at, 3), service=self.service_name, stage=name)
+
+    def wait(self) -> dict[str, float]:
+        """ waits for all the tasks, raises the error of the first failed one. returns when each task finished """
+        try:
+            for future in list(self.tasks.values()):
+                future.result()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False)
+
+        return dict(self.finished_at)
+
+    def ready(self):
+        """ marks the service ready once all the tasks are done """
+        finished_at = self.wait()
+        ready_at = self.elapsed()
+
+        readiness_file = os.getenv("READINESS_FILE")
+        if readiness_file:
+            with open(readiness_file, "w") as ready:
+                ready.write(f"{ready_at:.3f}\n")
+        set_ready()
+
+        STARTUP_SECONDS.set(round(ready_at, 3), service=self.service_name, stage="ready")
+        tasks = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in sorted(finished_at.items(), key=lambda item: item[1]))
+        mode = "parallel" if self.parallel else "sequential"
+        self.logr.info(f"{self.service_name} ready in {ready_at:.2f}s ({mode} startup, tasks done at: {tasks})")
+
+    def first_message(self):
+        """ records the time to the first handled message, once """
+        with self.lock:
+            if self.first_message_seen:
+                return
+            self.first_message_seen = True
+
+        first_message_at = self.elapsed()
+        STARTUP_SECONDS.set(round(first_message_at, 3), service=self.service_name, stage="first_message")
+        self.logr.info(f"{self.service_name} handled its first message {first_message_at:.2f}s after start")
+
+    def stop(self):
+        """ marks the service not ready, as it is shutting down """
+        set_ready(False)
+
+        readiness_file = os.getenv("READINESS_FILE")
+        if readiness_file and os.path.exists(readiness_file):
+            os.remove(readiness_file)
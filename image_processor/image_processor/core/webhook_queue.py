@@ -0,0 +1,139 @@
+from redis import Redis
+from threading import Lock
+import logging
+import time
+import os
+
+# pub/sub channel, used when WEBHOOK_TRANSPORT is pubsub
+WEBHOOK_CHANNEL = "webhook"
+
+# stream & its consumer group, used when WEBHOOK_TRANSPORT is stream
+WEBHOOK_STREAM = "pixelriver-webhooks"
+WEBHOOK_CONSUMER_GROUP = "pixelriver-webhook-subscribers"
+
+
+def get_webhook_transport() -> str:
+    """
+    transport of webhook msgs from image processor to webhook subscriber
+    pubsub (default): fire & forget, every subscriber gets every msg
+    stream: durable, msgs are shared between the subscribers of consumer group & acked after delivery
+    """
+    return os.getenv("WEBHOOK_TRANSPORT", "pubsub")
+
+
+def publish_webhook(redis_client: Redis, msg: str):
+    """ this will publish the webhook msg (<upload_id>|||<webhook_url>) on the configured transport """
+    if get_webhook_transport() == "stream":
+        redis_client.xadd(
+            WEBHOOK_STREAM,
+            {"msg": msg},
+            maxlen=int(os.getenv("WEBHOOK_STREAM_MAXLEN", 100000)),
+            approximate=True
+        )
+    else:
+        redis_client.publish(WEBHOOK_CHANNEL, msg)
+
+
+class WebhookStreamConsumer:
+    """
+    This class reads the webhook msgs from redis stream, as one of the consumers of the consumer group.
+    Multiple subscriber processes can share the load, each msg is delivered to only one of them.
+
+    - msgs are read in batches via XREADGROUP, and stay pending until ack() is called
+    - release() gives up a msg which failed (not acked), so it is delivered again once re-claimed
+    - every claim_interval, msgs pending for more than claim_idle_ms with other (dead) consumers
+      are taken over via XAUTOCLAIM, so no msg is lost if a subscriber dies
+    """
+
+    def __init__(self, logr: logging.Logger, redis_client: Redis, consumer_name: str,
+                 batch_size: int | None = None, block_ms: int | None = None,
+                 claim_idle_ms: int | None = None, claim_interval: float | None = None):
+        self.logr = logr
+        self.redis_client = redis_client
+        self.consumer_name = consumer_name
+        self.batch_size = batch_size or int(os.getenv("WEBHOOK_STREAM_BATCH_SIZE", 100))
+        self.block_ms = block_ms or int(os.getenv("WEBHOOK_STREAM_BLOCK_MS", 5000))
+        self.claim_idle_ms = claim_idle_ms or int(os.getenv("WEBHOOK_STREAM_CLAIM_IDLE_MS", 300000))
+        self.claim_interval = claim_interval or float(os.getenv("WEBHOOK_STREAM_CLAIM_INTERVAL", 30))
+
+        # ids read by this consumer & not yet acked, these are never re-claimed by us
+        self.in_flight: set[str] = set()
+        self.in_flight_lock = Lock()
+        self.claim_cursor = "0-0"
+        self.claimed_at = 0.0
+
+        self._ensure_group()
+
+    def _ensure_group(self):
+        """ create the consumer group (and stream) if not already there """
+        try:
+            self.redis_client.xgroup_create(WEBHOOK_STREAM, WEBHOOK_CONSUMER_GROUP, id="0", mkstream=True)
+            self.logr.info(f"Created consumer group {WEBHOOK_CONSUMER_GROUP} on {WEBHOOK_STREAM}")
+        except Exception as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def read(self) -> list[tuple[str, str]]:
+        """ returns the next batch of (entry_id, msg), blocks for upto block_ms if nothing is there """
+        entries = []
+
+        if time.monotonic() - self.claimed_at >= self.claim_interval:
+            entries.extend(self._claim_stale())
+
+        if not entries:
+            response = self.redis_client.xreadgroup(
+                WEBHOOK_CONSUMER_GROUP, self.consumer_name, {WEBHOOK_STREAM: ">"},
+                count=self.batch_size, block=self.block_ms
+            )
+            for _, stream_entries in response or []:
+                entries.extend(stream_entries)
+
+        batch = []
+        with self.in_flight_lock:
+            for entry_id, fields in entries:
+                entry_id = entry_id.decode() if isinstance(entry_id, bytes) else entry_id
+                if entry_id in self.in_flight:
+                    continue
+                self.in_flight.add(entry_id)
+                batch.append((entry_id, fields[b"msg"].decode()))
+
+        return batch
+
+    def _claim_stale(self) -> list:
+        """ take over the msgs which are pending for too long (consumer probably died) """
+        self.claimed_at = time.monotonic()
+        try:
+            self.claim_cursor, entries, *_ = self.redis_client.xautoclaim(
+                WEBHOOK_STREAM, WEBHOOK_CONSUMER_GROUP, self.consumer_name,
+                min_idle_time=self.claim_idle_ms, start_id=self.claim_cursor, count=self.batch_size
+            )
+        except Exception as e:
+            # do not raise error, will be tried again in next interval
+            self.logr.error(f"Error while claiming stale webhook msgs: {e}")
+            return []
+
+        # deleted entries come back as None
+        entries = [entry for entry in entries if entry and entry[1]]
+        if entries:
+            self.logr.info(f"Claimed {len(entries)} stale webhook msgs")
+
+        return entries
+
+    def ack(self, entry_id: str):
+        """ mark the msg as processed, it will not be delivered again """
+        try:
+            self.redis_client.xack(WEBHOOK_STREAM, WEBHOOK_CONSUMER_GROUP, entry_id)
+        except Exception as e:
+            # do not raise error, msg will be re-claimed & delivered again
+            self.logr.error(f"Error while acking webhook msg {entry_id}: {e}")
+        finally:
+            with self.in_flight_lock:
+                self.in_flight.discard(entry_id)
+
+    def release(self, entry_id: str):
+        """
+        give up the msg without acking it (e.g. its outcome could not be saved), it stays pending
+        & is delivered again once re-claimed after claim_idle_ms (by this or another consumer)
+        """
+        with self.in_flight_lock:
+            self.in_flight.discard(entry_id)
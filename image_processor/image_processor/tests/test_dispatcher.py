@@ -0,0 +1,66 @@
+import logging
+import threading
+
+import mongomock
+from bson import ObjectId
+
+from webhook.dispatcher import WebhookDispatcher
+
+logr = logging.getLogger("test")
+
+
+class _OkResponse:
+    status_code = 200
+    ok = True
+    reason = "OK"
+
+
+class _BlockingHttpClient:
+    """ http client whose requests wait till released, records the requests in flight """
+
+    def __init__(self):
+        self.released = threading.Event()
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.urls = []
+
+    def get(self, url, timeout=None):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            self.urls.append(url)
+        self.released.wait()
+        with self.lock:
+            self.in_flight -= 1
+        return _OkResponse()
+
+
+def test_jobs_of_busy_host_wait_without_filling_the_queue():
+    http_client = _BlockingHttpClient()
+    dispatcher = WebhookDispatcher(logr, mongomock.MongoClient().db, http_client, worker_count=4, per_host_limit=1,
+                                   queue_size=1).start()
+    # jobs are scheduled only for their retries, not put back while their host is busy
+    scheduled = []
+    dispatcher._schedule = lambda job, delay: scheduled.append(job)
+    done = []
+    urls = [f"http://hook.test/{no}" for no in range(5)]
+
+    def submit_all():
+        for url in urls:
+            dispatcher.submit(f"{ObjectId()}|||{url}", on_done=lambda url=url: done.append(url))
+
+    # first request holds the only slot of the host, rest of the jobs are submitted & wait for it
+    submitter = threading.Thread(target=submit_all)
+    submitter.start()
+    submitter.join(timeout=2)
+    assert not submitter.is_alive()
+    assert http_client.urls == urls[:1]
+
+    http_client.released.set()
+    dispatcher.shutdown()
+
+    assert scheduled == []
+    assert http_client.max_in_flight == 1
+    assert http_client.urls == urls
+    assert done == urls
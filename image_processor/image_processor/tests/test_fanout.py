@@ -0,0 +1,55 @@
+import logging
+import time
+
+import fakeredis
+
+from upload.fanout import FanoutTracker, new_plan_id
+
+UPLOAD_ID = "6ad4cf2ef85929eba8ccba8b"
+
+logr = logging.getLogger("test")
+
+
+def _tracker(redis_client, monkeypatch, lock_ttl: int = 60) -> FanoutTracker:
+    monkeypatch.setenv("UPLOAD_AGGREGATION_LOCK_TTL", str(lock_ttl))
+    return FanoutTracker(logr, redis_client, UPLOAD_ID, new_plan_id())
+
+
+def test_held_aggregation_lock_is_not_acquired(monkeypatch):
+    redis_client = fakeredis.FakeRedis()
+    holder = _tracker(redis_client, monkeypatch)
+    other = _tracker(redis_client, monkeypatch)
+
+    assert holder.acquire_aggregation()
+    assert not other.acquire_aggregation()
+
+    holder.release_aggregation()
+    assert other.acquire_aggregation()
+    other.release_aggregation()
+
+
+def test_expired_aggregation_lock_is_not_released_by_old_holder(monkeypatch):
+    redis_client = fakeredis.FakeRedis()
+    holder = _tracker(redis_client, monkeypatch)
+    other = _tracker(redis_client, monkeypatch)
+
+    assert holder.acquire_aggregation()
+    # lock expired (holder was stalled) & the other worker took it over
+    redis_client.delete(f"{holder.upload_key}:aggregating")
+    assert other.acquire_aggregation()
+
+    holder.release_aggregation()
+    assert redis_client.exists(f"{other.upload_key}:aggregating")
+    other.release_aggregation()
+
+
+def test_aggregation_lock_is_renewed_while_held(monkeypatch):
+    redis_client = fakeredis.FakeRedis()
+    holder = _tracker(redis_client, monkeypatch, lock_ttl=1)
+
+    assert holder.acquire_aggregation()
+    time.sleep(1.5)
+    assert redis_client.exists(f"{holder.upload_key}:aggregating")
+
+    holder.release_aggregation()
+    assert not redis_client.exists(f"{holder.upload_key}:aggregating")
@@ -0,0 +1,99 @@
+import logging
+import threading
+import time
+from collections import namedtuple
+
+from kafka import TopicPartition
+
+from core.kafka import ConcurrentConsumer, RedeliverMessage
+
+Record = namedtuple("Record", "offset value")
+
+TP = TopicPartition("topic", 0)
+
+logr = logging.getLogger("test")
+
+
+class _FakeConsumer:
+    """ one partition of `count` messages, fetched from the position (which seek moves) """
+
+    def __init__(self, count: int):
+        self.records = [Record(offset, b"") for offset in range(count)]
+        self.position = 0
+        self.paused_partitions = set()
+        self.committed = 0
+
+    def subscribe(self, topics, listener):
+        pass
+
+    def assignment(self):
+        return {TP}
+
+    def pause(self, *partitions):
+        self.paused_partitions |= set(partitions)
+
+    def resume(self, *partitions):
+        self.paused_partitions -= set(partitions)
+
+    def paused(self):
+        return set(self.paused_partitions)
+
+    def seek(self, partition, offset):
+        self.position = offset
+
+    def poll(self, timeout_ms, max_records=None):
+        time.sleep(0.001)
+        if TP in self.paused_partitions:
+            return {}
+        records = self.records[self.position:self.position + (max_records or len(self.records))]
+        self.position += len(records)
+        return {TP: records} if records else {}
+
+    def commit(self, offsets):
+        self.committed = max(self.committed, offsets[TP].offset)
+
+    def close(self):
+        pass
+
+
+def _run(consumer: ConcurrentConsumer, until):
+    thread = threading.Thread(target=consumer.run)
+    thread.start()
+    deadline = time.monotonic() + 5
+    while not until() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    consumer.stop()
+    thread.join()
+
+
+def test_message_is_redelivered_until_handled():
+    fake = _FakeConsumer(3)
+    handled = []
+
+    def handler(message):
+        handled.append(message.offset)
+        if handled.count(1) == 1 and message.offset == 1:
+            raise RedeliverMessage("backing service is down")
+
+    consumer = ConcurrentConsumer(logr, fake, ["topic"], handler, 1, poll_timeout_ms=10, retry_delay_ms=10)
+    _run(consumer, lambda: fake.committed == 3)
+
+    assert fake.committed == 3
+    # rewound to the failed message, it & the ones after it are handled again
+    assert handled == [0, 1, 1, 2]
+
+
+def test_failed_message_is_not_redelivered():
+    fake = _FakeConsumer(3)
+    handled = []
+
+    def handler(message):
+        handled.append(message.offset)
+        if message.offset == 1:
+            raise Exception("bad message")
+
+    consumer = ConcurrentConsumer(logr, fake, ["topic"], handler, 1, poll_timeout_ms=10, retry_delay_ms=10)
+    _run(consumer, lambda: fake.committed == 3)
+
+    assert fake.committed == 3
+    assert handled == [0, 1, 2]
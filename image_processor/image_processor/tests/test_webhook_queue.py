@@ -0,0 +1,96 @@
+import logging
+import time
+
+import fakeredis
+import pytest
+from pymongo.errors import PyMongoError
+
+from core.webhook_queue import WebhookStreamConsumer, publish_webhook, WEBHOOK_STREAM, WEBHOOK_CONSUMER_GROUP
+from webhook.dispatcher import WebhookDispatcher
+
+UPLOAD_ID = "6ad4cf2ef85929eba8ccba8b"
+
+logr = logging.getLogger("test")
+
+
+def _consumer(redis_client, name: str = "c1") -> WebhookStreamConsumer:
+    # claims right away, so the re-delivery does not wait for claim_idle_ms
+    return WebhookStreamConsumer(logr, redis_client, name, block_ms=1, claim_idle_ms=1, claim_interval=0.001)
+
+
+def test_released_msg_is_delivered_again(monkeypatch):
+    monkeypatch.setenv("WEBHOOK_TRANSPORT", "stream")
+    redis_client = fakeredis.FakeRedis()
+    consumer = _consumer(redis_client)
+    publish_webhook(redis_client, f"{UPLOAD_ID}|||http://hook.test/")
+
+    [(entry_id, msg)] = consumer.read()
+    consumer.release(entry_id)
+    time.sleep(0.01)
+
+    # not acked, so it is re-claimed & delivered again
+    assert consumer.read() == [(entry_id, msg)]
+
+
+def test_in_flight_msg_is_not_delivered_twice(monkeypatch):
+    monkeypatch.setenv("WEBHOOK_TRANSPORT", "stream")
+    redis_client = fakeredis.FakeRedis()
+    consumer = _consumer(redis_client)
+    publish_webhook(redis_client, f"{UPLOAD_ID}|||http://hook.test/")
+
+    assert len(consumer.read()) == 1
+    assert consumer.read() == []
+
+
+class _OkResponse:
+    status_code = 200
+    ok = True
+    reason = "OK"
+
+
+class _HttpClient:
+    def get(self, url, timeout=None):
+        return _OkResponse()
+
+
+class _FailingMongo:
+    """ mongo db whose writes fail """
+
+    def get_collection(self, name):
+        return self
+
+    def update_one(self, *args, **kwargs):
+        raise PyMongoError("mongo is down")
+
+
+def test_failed_save_releases_the_msg(monkeypatch):
+    monkeypatch.setenv("WEBHOOK_TRANSPORT", "stream")
+    redis_client = fakeredis.FakeRedis()
+    consumer = _consumer(redis_client)
+    publish_webhook(redis_client, f"{UPLOAD_ID}|||http://hook.test/")
+    [(entry_id, msg)] = consumer.read()
+
+    dispatcher = WebhookDispatcher(logr, _FailingMongo(), _HttpClient(), worker_count=1).start()
+    dispatcher.submit(msg, on_done=lambda: consumer.ack(entry_id), on_failed=lambda: consumer.release(entry_id))
+    dispatcher.shutdown()
+    time.sleep(0.01)
+
+    # still pending & delivered again
+    assert redis_client.xpending(WEBHOOK_STREAM, WEBHOOK_CONSUMER_GROUP)["pending"] == 1
+    assert consumer.read() == [(entry_id, msg)]
+
+
+def test_invalid_msg_is_acked_without_request(monkeypatch):
+    monkeypatch.setenv("WEBHOOK_TRANSPORT", "stream")
+    redis_client = fakeredis.FakeRedis()
+    consumer = _consumer(redis_client)
+    publish_webhook(redis_client, "not-an-upload-id|||http://hook.test/")
+    [(entry_id, msg)] = consumer.read()
+
+    http_client = _HttpClient()
+    http_client.get = lambda *args, **kwargs: pytest.fail("webhook of invalid msg is fired")
+    dispatcher = WebhookDispatcher(logr, _FailingMongo(), http_client, worker_count=1).start()
+    dispatcher.submit(msg, on_done=lambda: consumer.ack(entry_id), on_failed=lambda: consumer.release(entry_id))
+    dispatcher.shutdown()
+
+    assert redis_client.xpending(WEBHOOK_STREAM, WEBHOOK_CONSUMER_GROUP)["pending"] == 0
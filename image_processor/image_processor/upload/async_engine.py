@@ -0,0 +1,111 @@
+from concurrent.futures import ThreadPoolExecutor
+from logging import Logger
+from typing import Any, Awaitable, Callable, Iterable
+import asyncio
+import aiohttp
+import os
+
+from .pipeline import Completed
+
+
+def get_image_engine() -> str:
+    """ engine used for processing the images of an upload: thread (default) or async """
+    return os.getenv("IMAGE_ENGINE", "thread")
+
+
+def get_async_concurrency() -> int:
+    """ max no. of images in-flight at once in async engine """
+    return int(os.getenv("IMAGE_ASYNC_CONCURRENCY", 1000))
+
+
+def get_async_concurrency_per_host() -> int:
+    """ max no. of open connections to a single host in async engine, 0 means no per host limit """
+    return int(os.getenv("IMAGE_ASYNC_CONCURRENCY_PER_HOST", 100))
+
+
+class AsyncImageEngine:
+    """
+    This class processes the images of an upload on an asyncio event loop:
+        download (async http) -> transcode (executor) -> upload (async gcs json api)
+    Network waits do not hold a thread, so thousands of images can be in-flight in a single process.
+    CPU bound transcode step is sync, it runs in the default executor (which uses the transcode process pool, if any).
+    on_complete (checkpoint & progress writes to redis) runs in one worker thread, in the order the images complete,
+    so its blocking calls do not stall the other images on the event loop.
+
+    It is a drop in replacement of ImagePipeline.run(), so results are returned in the same order as items
+    and a stage can return Completed(result) to skip the remaining stages.
+    """
+
+    def __init__(self, logr: Logger,
+                 download: Callable[[aiohttp.ClientSession, Any], Awaitable[Any]],
+                 transcode: Callable[[Any], Any],
+                 upload: Callable[[aiohttp.ClientSession, Any], Awaitable[str]],
+                 concurrency: int | None = None, concurrency_per_host: int | None = None):
+        self.logr = logr
+        self.download = download
+        self.transcode = transcode
+        self.upload = upload
+        self.concurrency = concurrency or get_async_concurrency()
+        self.concurrency_per_host = concurrency_per_host if concurrency_per_host is not None else get_async_concurrency_per_host()
+        self.timeout = aiohttp.ClientTimeout(
+            sock_connect=float(os.getenv("HTTP_CONNECT_TIMEOUT", 5)),
+            sock_read=float(os.getenv("HTTP_READ_TIMEOUT", 30)),
+        )
+
+    def run(self, items: Iterable[Any], total: int, on_complete: Callable[[int, str], None] | None = None) -> list[str]:
+        """
+        This will process every item on a new event loop and return the results in the same order as items
+        on_complete(index, result) is called after each image is done
+        """
+        return asyncio.run(self._run(items, total, on_complete))
+
+    async def _run(self, items: Iterable[Any], total: int, on_complete: Callable[[int, str], None] | None) -> list[str]:
+        results: list[str] = [None] * total
+        pending = enumerate(items)
+        completions = ThreadPoolExecutor(max_workers=1, thread_name_prefix="async-complete") if on_complete is not None else None
+        # first error raised by on_complete, raised once all the images are done
+        errors: list[Exception] = []
+
+        def complete(index: int, result: str):
+            try:
+                on_complete(index, result)
+            except Exception as e:
+                errors.append(e)
+
+        try:
+            connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.concurrency_per_host)
+            async with aiohttp.ClientSession(connector=connector, timeout=self.timeout) as session:
+
+                # fixed no. of workers pull from the shared iterator, so tasks are not created upfront for every image
+                async def worker():
+                    for index, item in pending:
+                        results[index] = await self._process(session, item)
+                        if completions is not None:
+                            completions.submit(complete, index, results[index])
+
+                await asyncio.gather(*(worker() for _ in range(min(self.concurrency, total))))
+        finally:
+            if completions is not None:
+                # waits for the queued on_complete calls, so caller sees all of them done
+                await asyncio.to_thread(completions.shutdown)
+
+        if errors:
+            raise errors[0]
+
+        return results
+
+    async def _process(self, session: aiohttp.ClientSession, item: Any) -> str:
+        """ runs all the stages for a single image, returns str(error) if any stage fails """
+        try:
+            payload = await self.download(session, item)
+            if isinstance(payload, Completed):
+                return payload.result
+
+            payload = await asyncio.to_thread(self.transcode, payload)
+            if isinstance(payload, Completed):
+                return payload.result
+
+            return await self.upload(session, payload)
+        except Exception as e:
+            # timeout errors of aiohttp have empty message
+            return str(e) or e.__class__.__name__
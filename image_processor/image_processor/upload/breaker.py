@@ -0,0 +1,192 @@
+from contextlib import contextmanager
+from collections import deque
+from urllib.parse import urlsplit
+from threading import Lock
+from logging import Logger
+import time
+import os
+
+from .metrics import HOST_CIRCUIT_STATE, IMAGE_FAST_FAILURES
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+
+# value of the state gauge
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+def is_circuit_breaker_enabled() -> bool:
+    """ if enabled, image downloads from a host fail fast once too many of its recent downloads failed """
+    return os.getenv("IMAGE_CIRCUIT_BREAKER") == "enable"
+
+
+class CircuitOpen(Exception):
+    def __init__(self, host: str):
+        # no comma in message, as the output column is comma separated
+        super().__init__(f"Host {host} is failing so image is skipped (circuit open)")
+
+
+class CircuitBreaker:
+    """
+    This class tracks the outcome of the recent downloads (last `window`) from one host:
+        - closed: downloads go through. Once there are min_requests outcomes & error_threshold of them failed, it opens
+        - open: downloads fail right away with CircuitOpen, for open_seconds
+        - half open: upto probes downloads go through at once, if that many succeed in a row it closes
+          (window starts afresh), if any of them fails it opens again
+    Outcomes of downloads started before the circuit opened are ignored.
+    """
+
+    def __init__(self, logr: Logger, host: str, window: int, min_requests: int, error_threshold: float,
+                 open_seconds: float, probes: int):
+        self.logr = logr
+        self.host = host
+        self.min_requests = min_requests
+        self.error_threshold = error_threshold
+        self.open_seconds = open_seconds
+        self.probes = max(probes, 1)
+
+        self.lock = Lock()
+        self.state = CLOSED
+        self.outcomes: deque[bool] = deque(maxlen=window)
+        self.opened_at = 0.0
+        self.probes_in_flight = 0
+        self.probe_successes = 0
+
+        self._report()
+
+    def allow(self) -> bool:
+        """ raises CircuitOpen if the download can not go through, returns True if it is a probe """
+        with self.lock:
+            if self.state == OPEN:
+                if time.monotonic() - self.opened_at < self.open_seconds:
+                    self._reject()
+                self._set_state(HALF_OPEN)
+                self.probes_in_flight = 0
+                self.probe_successes = 0
+
+            if self.state == HALF_OPEN:
+                if self.probes_in_flight >= self.probes:
+                    self._reject()
+                self.probes_in_flight += 1
+                return True
+
+            return False
+
+    def record(self, failed: bool, probe: bool):
+        """ this will record the outcome of the download allowed earlier """
+        with self.lock:
+            if probe:
+                if self.state != HALF_OPEN:
+                    return
+                self.probes_in_flight -= 1
+                if failed:
+                    self._open()
+                    return
+
+                self.probe_successes += 1
+                if self.probe_successes >= self.probes:
+                    self.outcomes.clear()
+                    self._set_state(CLOSED)
+                return
+
+            if self.state != CLOSED:
+                return
+
+            self.outcomes.append(failed)
+            if len(self.outcomes) >= self.min_requests and sum(self.outcomes) / len(self.outcomes) >= self.error_threshold:
+                self._open()
+
+    @contextmanager
+    def guard(self):
+        """
+        runs the download in the with block, if allowed (raises CircuitOpen otherwise)
+        any exception raised in the block is taken as failure, unless outcome["failed"] is set by the block
+        """
+        probe = self.allow()
+
+        outcome = {"failed": None}
+        try:
+            yield outcome
+        except BaseException:
+            if outcome["failed"] is None:
+                outcome["failed"] = True
+            raise
+        finally:
+            self.record(bool(outcome["failed"]), probe)
+
+    def _reject(self):
+        IMAGE_FAST_FAILURES.inc(reason="circuit_open")
+        raise CircuitOpen(self.host)
+
+    def _open(self):
+        self.opened_at = time.monotonic()
+        self._set_state(OPEN)
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            self.logr.warning(f"Circuit of host {self.host} is {state}")
+        self.state = state
+        self._report()
+
+    def _report(self):
+        HOST_CIRCUIT_STATE.set(STATE_VALUES[self.state], host=self.host)
+
+
+class HostBreakers:
+    """
+    This class keeps one CircuitBreaker per image host.
+    One instance is meant to be shared by all the uploads of the process, so a dead host is skipped by every upload.
+    """
+
+    def __init__(self, logr: Logger, window: int, min_requests: int, error_threshold: float, open_seconds: float, probes: int):
+        self.logr = logr
+        self.window = window
+        self.min_requests = min_requests
+        self.error_threshold = error_threshold
+        self.open_seconds = open_seconds
+        self.probes = probes
+
+        self.lock = Lock()
+        self.breakers: dict[str, CircuitBreaker] = {}
+
+    def for_url(self, url: str) -> CircuitBreaker:
+        host = urlsplit(url).netloc.lower()
+        breaker = self.breakers.get(host)
+        if breaker is not None:
+            return breaker
+
+        with self.lock:
+            if host not in self.breakers:
+                self.breakers[host] = CircuitBreaker(self.logr, host, self.window, self.min_requests, self.error_threshold,
+                                                     self.open_seconds, self.probes)
+            return self.breakers[host]
+
+    def guard(self, url: str):
+        """ same as CircuitBreaker.guard, for the host of url """
+        return self.for_url(url).guard()
+
+
+def initialize_host_breakers(logr: Logger, window: int, min_requests: int, error_threshold: float,
+                             open_seconds: float, probes: int) -> HostBreakers:
+    """ This will initialize the per host circuit breakers and return them """
+    breakers = HostBreakers(logr, window, min_requests, error_threshold, open_seconds, probes)
+
+    logr.info(f"Image host circuit breaker enabled, opens at {error_threshold:.0%} failures of last {window} downloads")
+
+    return breakers
+
+
+def get_host_breakers(logr: Logger) -> HostBreakers | None:
+    """ returns the per host circuit breakers configured via envs, None if circuit breaker is not enabled """
+    if not is_circuit_breaker_enabled():
+        return None
+
+    return initialize_host_breakers(
+        logr,
+        window=int(os.getenv("IMAGE_BREAKER_WINDOW", 50)),
+        min_requests=int(os.getenv("IMAGE_BREAKER_MIN_REQUESTS", 20)),
+        error_threshold=float(os.getenv("IMAGE_BREAKER_ERROR_THRESHOLD", 0.5)),
+        open_seconds=float(os.getenv("IMAGE_BREAKER_OPEN_SECONDS", 30)),
+        probes=int(os.getenv("IMAGE_BREAKER_PROBES", 3)),
+    )
@@ -0,0 +1,122 @@
+from logging import Logger
+from threading import Lock
+from redis import Redis
+import hashlib
+import time
+import os
+
+CHECKPOINT_KEY_PREFIX = "pixelriver-checkpoint"
+
+# no. of urls looked up in one HMGET
+LOAD_BATCH_SIZE = 1000
+
+
+def url_digest(url: str) -> str:
+    """ stable id of an image url, used as checkpoint field & in the processed image name """
+    return hashlib.sha256(url.encode()).hexdigest()
+
+
+class UploadCheckpoint:
+    """
+    This class records the images of an upload which are already processed (source url -> processed url),
+    so if the worker dies & the upload is redelivered, the processor skips them & reuses their output.
+
+    Checkpoints are kept in one redis hash per upload. Images are processed once per distinct url,
+    so the url (not the row index) identifies the work; every row with that url resolves to the same output.
+
+    Failed images are checkpointed only when asked for (record_failure, used by fan-out batches)
+    in a separate hash, so the normal resume still retries them, while the aggregator can pick their error.
+
+    Records are buffered & written every flush_interval_ms or flush_size records, whichever comes first,
+    and on flush(). Losing the unwritten ones only costs re-processing them, as the output names are deterministic.
+    Redis errors are never raised, they are logged (lookup is then treated as nothing checkpointed).
+    """
+
+    def __init__(self, logr: Logger, redis_client: Redis, upload_id: str,
+                 flush_interval_ms: int | None = None, flush_size: int | None = None, ttl: int | None = None):
+        self.logr = logr
+        self.redis_client = redis_client
+        self.key = f"{CHECKPOINT_KEY_PREFIX}:{upload_id}"
+        self.failed_key = f"{CHECKPOINT_KEY_PREFIX}:{upload_id}:failed"
+        self.flush_interval = (flush_interval_ms or int(os.getenv("CHECKPOINT_FLUSH_INTERVAL_MS", 1000))) / 1000
+        self.flush_size = flush_size or int(os.getenv("CHECKPOINT_FLUSH_SIZE", 100))
+        self.ttl = ttl or int(os.getenv("CHECKPOINT_TTL", 7 * 86400))
+
+        self.lock = Lock()
+        self.flush_lock = Lock()
+        self.pending: dict[str, str] = {}
+        self.pending_failed: dict[str, str] = {}
+        self.flushed_at = time.monotonic()
+
+    def load(self, urls: list[str], include_failed: bool = False) -> dict[str, str]:
+        """ returns the processed url (or error, if include_failed) of the given urls, which are checkpointed """
+        checkpointed = {}
+        keys = [self.failed_key, self.key] if include_failed else [self.key]
+        try:
+            for start in range(0, len(urls), LOAD_BATCH_SIZE):
+                batch = urls[start:start + LOAD_BATCH_SIZE]
+                digests = [url_digest(url) for url in batch]
+                # processed url wins over the error, so it is loaded last
+                for key in keys:
+                    values = self.redis_client.hmget(key, digests)
+                    checkpointed.update({url: value.decode() for url, value in zip(batch, values) if value is not None})
+        except Exception as e:
+            # do not raise error, images are processed again
+            self.logr.error(f"Error while loading checkpoints of {self.key}: {e}")
+
+        return checkpointed
+
+    def record(self, url: str, processed_url: str):
+        """ buffer the checkpoint of processed image, written to redis if due """
+        with self.lock:
+            self.pending[url_digest(url)] = processed_url
+            due = len(self.pending) >= self.flush_size or time.monotonic() - self.flushed_at >= self.flush_interval
+
+        if due:
+            self.flush(block=False)
+
+    def record_failure(self, url: str, error: str):
+        """ buffer the error of failed image, written along with the processed ones """
+        with self.lock:
+            self.pending_failed[url_digest(url)] = error
+
+    def flush(self, block: bool = True):
+        """
+        write the buffered checkpoints to redis
+        this will not raise exception even in case of error
+        """
+        if not self.flush_lock.acquire(blocking=block):
+            return
+
+        try:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+                pending_failed, self.pending_failed = self.pending_failed, {}
+                self.flushed_at = time.monotonic()
+
+            if not pending and not pending_failed:
+                return
+
+            pipe = self.redis_client.pipeline(transaction=False)
+            for key, mapping in [(self.key, pending), (self.failed_key, pending_failed)]:
+                if mapping:
+                    pipe.hset(key, mapping=mapping)
+                    pipe.expire(key, self.ttl)
+            pipe.execute()
+        except Exception as e:
+            # do not raise error, images are processed again on redelivery
+            self.logr.error(f"Error while writing checkpoints of {self.key}: {e}")
+        finally:
+            self.flush_lock.release()
+
+    def clear(self):
+        """ drop the checkpoints, once the upload is completed """
+        with self.lock:
+            self.pending = {}
+            self.pending_failed = {}
+
+        try:
+            self.redis_client.delete(self.key, self.failed_key)
+        except Exception as e:
+            # do not raise error, key expires anyway
+            self.logr.error(f"Error while deleting checkpoints of {self.key}: {e}")
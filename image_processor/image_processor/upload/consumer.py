@@ -1,29 +1,201 @@
-from core.mongo import get_mongo_db
-from core.redis import get_redis
-from core.gcp import GCPStorageManager
-from core.kafka import initialize_kafka_consumer
+from core.metrics import get_metrics_server
 from core.logger import get_logger
-from .processor import ProcessUploadId
+from core.startup import Startup
+from logging import Logger
+import signal
+import time
+import os
 
+# heavy modules (pandas, numpy, aiohttp, pymongo, google-cloud-storage, kafka) are not imported here,
+# startup tasks import the ones they need, so with FAST_STARTUP they load while the other tasks wait on the network
 
-def initialize_image_processing_consumer():
-    """ This will initialize the image processing consumer and process the each msg"""
 
-    # intialze various services
-    logr = get_logger("image-processor")
+def get_upload_concurrency() -> int:
+    """ no. of uploads processed concurrently by one image processor """
+    return int(os.getenv("UPLOAD_CONCURRENCY", 1))
+
+
+class ImageProcessorServices:
+    """ backend clients & shared objects of the image processor, used by every upload it processes """
+
+    def __init__(self, logr: Logger, mongo_db_client, mongo_writer, redis_client, storage_manager, upload_consumer,
+                 kafka_producer, topics: list[str], transcode_pool, http_client, host_limiters, host_breakers, image_scheduler):
+        self.logr = logr
+        self.mongo_db_client = mongo_db_client
+        self.mongo_writer = mongo_writer
+        self.redis_client = redis_client
+        self.storage_manager = storage_manager
+        self.upload_consumer = upload_consumer
+        self.kafka_producer = kafka_producer
+        self.topics = topics
+        self.transcode_pool = transcode_pool
+        self.http_client = http_client
+        self.host_limiters = host_limiters
+        self.host_breakers = host_breakers
+        self.image_scheduler = image_scheduler
+
+    def new_processor(self):
+        """ processor of one message (upload or image batch) """
+        from .processor import ProcessUploadId
+
+        return ProcessUploadId(self.logr, self.mongo_db_client, self.redis_client, self.storage_manager, self.transcode_pool,
+                               self.http_client, self.mongo_writer, self.kafka_producer, self.host_limiters, self.host_breakers,
+                               self.image_scheduler)
+
+    def close(self):
+        if self.kafka_producer is not None:
+            self.kafka_producer.close()
+        if self.mongo_writer is not None:
+            self.mongo_writer.close()
+        self.redis_client.close()
+        self.http_client.close()
+        if self.transcode_pool is not None:
+            self.transcode_pool.shutdown()
+
+
+def _connect_mongo(logr: Logger, prewarm: bool):
+    from core.mongo import get_mongo_db, MongoWriteBuffer
+
     mongoDbClient = get_mongo_db(logr)
-    redisClient = get_redis(logr)
+    if prewarm:
+        # client connects lazily, ping opens the first pooled connection
+        mongoDbClient.command("ping")
+
+    return mongoDbClient, MongoWriteBuffer(logr, mongoDbClient)
+
+
+def _connect_redis(logr: Logger):
+    from core.redis import get_redis
+
+    return get_redis(logr)
+
+
+def _connect_storage(logr: Logger, prewarm: bool):
+    from core.gcp import GCPStorageManager
+
     storageManager = GCPStorageManager(logr)
+    if prewarm:
+        storageManager.prewarm()
+
+    return storageManager
+
+
+def _connect_kafka(logr: Logger):
+    from core.kafka import initialize_kafka_consumer, initialize_kafka_producer, UPLOAD_PROCESSING_TOPIC, IMAGE_BATCH_TOPIC
+    from .fanout import is_upload_fanout_enabled
+
     uploadConsumer = initialize_kafka_consumer(logr)
 
+    # in fan-out mode large uploads are split in image batches, which are consumed by every image processor
+    if not is_upload_fanout_enabled():
+        return uploadConsumer, None, [UPLOAD_PROCESSING_TOPIC]
+
+    return uploadConsumer, initialize_kafka_producer(logr), [UPLOAD_PROCESSING_TOPIC, IMAGE_BATCH_TOPIC]
+
+
+def _connect_http(logr: Logger, pool_size: int, prewarm: bool):
+    from core.http_client import get_http_client, get_http_prewarm_urls
+
+    httpClient = get_http_client(logr, pool_size=pool_size)
+    prewarmUrls = get_http_prewarm_urls()
+    if prewarm and prewarmUrls:
+        # as many connections per host as the downloads of one upload use
+        connected = httpClient.prewarm(prewarmUrls, connections=min(pool_size, int(os.getenv("HTTP_PREWARM_CONNECTIONS", 4))))
+        logr.info(f"Http client prewarmed, {connected} connections to {len(prewarmUrls)} hosts")
+
+    return httpClient
+
+
+def initialize_image_processor_services(logr: Logger, startup: Startup) -> ImageProcessorServices:
+    """
+    This will initialize the backend clients & shared objects of the image processor, as startup tasks
+    with FAST_STARTUP they are initialized in parallel & the connection pools (mongo, gcs, http) & transcode pool are prewarmed
+    """
+    prewarm = startup.parallel
+
+    # imported by the main thread before any startup task runs (transcoder brings in Pillow)
+    from .transcoder import initialize_transcode_pool, prewarm_transcode_pool
+    from .pipeline import get_download_worker_count
+    from .limiter import get_host_limiters
+    from .breaker import get_host_breakers
+    from .scheduler import get_image_scheduler
+
+    # pool workers are forked from a fork server, so the threads of this process (logs, metrics, startup) do not matter
+    transcodePool = initialize_transcode_pool(logr)
+    if transcodePool is not None and prewarm:
+        warmUps = prewarm_transcode_pool(transcodePool)
+        transcodeReady = startup.submit("transcode_pool", lambda: len({warmUp.result() for warmUp in warmUps}))
+
+    mongo = startup.submit("mongo", _connect_mongo, logr, prewarm, imports=("core.mongo",))
+    redisClient = startup.submit("redis", _connect_redis, logr, imports=("core.redis",))
+    storageManager = startup.submit("gcs", _connect_storage, logr, prewarm, imports=("core.gcp",))
+    kafka = startup.submit("kafka", _connect_kafka, logr, imports=("core.kafka", f"{__package__}.fanout"))
+    # modules of upload processing (pandas, numpy, aiohttp), needed by the first message
+    startup.preload("imports", f"{__package__}.processor")
+
+    hostLimiters = get_host_limiters(logr)
+    hostBreakers = get_host_breakers(logr)
+    # with adaptive concurrency, download workers go upto the max limit per host
+    downloadWorkers = hostLimiters.max_limit if hostLimiters is not None else get_download_worker_count()
+    httpClient = startup.submit("http", _connect_http, logr, downloadWorkers * get_upload_concurrency(), prewarm,
+                                imports=("core.http_client",))
+    # concurrent uploads share the download slots of one upload, fairly (weighted by priority)
+    imageScheduler = get_image_scheduler(logr, downloadWorkers)
+
+    # waits for all the tasks, raises if any of them failed
+    startup.wait()
+    if transcodePool is not None and prewarm:
+        logr.info(f"Transcode process pool prewarmed, {transcodeReady.result()} workers started")
+
+    mongoDbClient, mongoWriter = mongo.result()
+    uploadConsumer, kafkaProducer, topics = kafka.result()
+
+    return ImageProcessorServices(logr, mongoDbClient, mongoWriter, redisClient.result(), storageManager.result(), uploadConsumer,
+                                  kafkaProducer, topics, transcodePool, httpClient.result(), hostLimiters, hostBreakers, imageScheduler)
+
+
+def initialize_image_processing_consumer(started_at: float | None = None):
+    """
+    This will initialize the image processing consumer and process the each msg
+    started_at is the perf_counter at process start, startup times (ready, first message) are measured from it
+    """
+
+    # intialze various services
+    logr = get_logger("image-processor")
+    # metrics server is up first, so /ready can be probed during the startup
+    metricsServer = get_metrics_server(logr)
+    startup = Startup(logr, "image-processor", started_at if started_at is not None else time.perf_counter())
+    services = initialize_image_processor_services(logr, startup)
+
+    from core.kafka import ConcurrentConsumer, IMAGE_BATCH_TOPIC
+    from .fanout import decode_image_batch
+
+    def process_message(message):
+        processor = services.new_processor()
+        if message.topic == IMAGE_BATCH_TOPIC:
+            processor.process_image_batch(*decode_image_batch(message.value))
+        else:
+            processor.start_processing(message.value.decode())
+        startup.first_message()
+
+    concurrentConsumer = ConcurrentConsumer(logr, services.upload_consumer, services.topics, process_message, get_upload_concurrency())
+
+    # on shutdown stop fetching & let the in-flight uploads finish, it is not ready anymore
+    def stop(*args):
+        startup.stop()
+        concurrentConsumer.stop(*args)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    startup.ready()
     logr.info("Image processor started...")
     print("Image processor started...")
 
-    # start consuming messages
-    try:
-        for message in uploadConsumer:
-            ProcessUploadId(logr, mongoDbClient, redisClient, storageManager).start_processing(message.value.decode())
-    except KeyboardInterrupt:
-        uploadConsumer.close()
-        redisClient.close()
-        print("Shutting down kafka gracefully...")
+    # start consuming messages, returns once stopped & drained
+    concurrentConsumer.run()
+
+    services.close()
+    if metricsServer is not None:
+        metricsServer.shutdown()
+    print("Shutting down kafka gracefully...")
@@ -0,0 +1,177 @@
+from logging import Logger
+from redis import Redis
+from redis.lock import Lock
+from redis.exceptions import LockError
+from threading import Event, Thread
+from uuid import uuid4
+import json
+import os
+
+FANOUT_KEY_PREFIX = "pixelriver-fanout"
+
+
+def is_upload_fanout_enabled() -> bool:
+    """
+    if enabled, images of large uploads are split in batches & processed by all the image processors (via kafka)
+    instead of only the one which received the upload
+    """
+    return os.getenv("UPLOAD_FANOUT") == "enable"
+
+
+def get_fanout_min_images() -> int:
+    """ uploads with less (not yet processed) images than this are processed by the receiving worker itself """
+    return int(os.getenv("UPLOAD_FANOUT_MIN_IMAGES", 2000))
+
+
+def get_image_batch_size() -> int:
+    """ no. of images in one batch task """
+    return int(os.getenv("IMAGE_BATCH_SIZE", 500))
+
+
+def new_plan_id() -> str:
+    return uuid4().hex
+
+
+def encode_image_batch(upload_id: str, plan_id: str, batch_no: int, urls: list[str], profile: str, derivatives: list[str],
+                       weight: float) -> bytes:
+    return json.dumps({"uploadId": upload_id, "planId": plan_id, "batchNo": batch_no, "urls": urls,
+                       "profile": profile, "derivatives": derivatives, "weight": weight}).encode()
+
+
+def decode_image_batch(value: bytes) -> tuple[str, str, int, list[str], str | None, list[str] | None, float | None]:
+    """ returns upload_id, plan_id, batch_no, urls, encoding profile, derivative profiles & scheduler weight of the batch task """
+    task = json.loads(value)
+    return (task["uploadId"], task["planId"], task["batchNo"], task["urls"], task.get("profile"), task.get("derivatives"),
+            task.get("weight"))
+
+
+class FanoutTracker:
+    """
+    This class tracks the completion of the batches of one fan-out plan of an upload, in redis.
+
+    Each planning of an upload gets its own plan id & the latest one is recorded as the active plan of the upload.
+    If the planner dies in between & the upload is redelivered, it is planned again under a new plan id;
+    batches of the old plan are skipped from then on (even if all of them were already published),
+    and only the active plan aggregates. Once aggregated, the upload is marked so (SETNX), so it is never aggregated
+    (or planned) again, even by a plan which completed before the re-plan.
+
+    Once all the batches are done, one of the workers (the one which gets the aggregation lock of the upload)
+    builds the output csv & finishes the upload. Lock is held with a token of its own (only the holder can release it)
+    & renewed while aggregating, it expires after UPLOAD_AGGREGATION_LOCK_TTL in case the aggregating worker dies.
+    """
+
+    def __init__(self, logr: Logger, redis_client: Redis, upload_id: str, plan_id: str, ttl: int | None = None):
+        self.logr = logr
+        self.redis_client = redis_client
+        self.plan_id = plan_id
+        self.upload_key = f"{FANOUT_KEY_PREFIX}:{upload_id}"
+        self.key = f"{self.upload_key}:{plan_id}"
+        self.ttl = ttl or int(os.getenv("CHECKPOINT_TTL", 7 * 86400))
+        self.aggregation_lock_ttl = int(os.getenv("UPLOAD_AGGREGATION_LOCK_TTL", 60))
+        self.aggregation_lock: Lock | None = None
+        self.aggregation_renewer: Thread | None = None
+        self.aggregation_done = Event()
+
+    def start(self, total_batches: int):
+        """ record the no. of batches of the plan & make it the active plan, must be called before the batches are published """
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.set(f"{self.key}:total", total_batches, ex=self.ttl)
+        pipe.set(f"{self.upload_key}:plan", self.plan_id, ex=self.ttl)
+        pipe.execute()
+
+    def is_active(self) -> bool:
+        """ if this plan is the active plan of the upload & neither it nor the upload is aggregated yet """
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.get(f"{self.upload_key}:plan")
+        pipe.exists(f"{self.upload_key}:aggregated")
+        pipe.exists(f"{self.key}:total")
+        active_plan, aggregated, planned = pipe.execute()
+
+        return active_plan is not None and active_plan.decode() == self.plan_id and not aggregated and bool(planned)
+
+    def is_upload_aggregated(self) -> bool:
+        return bool(self.redis_client.exists(f"{self.upload_key}:aggregated"))
+
+    def mark_aggregated(self) -> bool:
+        """ marks the upload aggregated (by this plan), returns False if it already was """
+        return bool(self.redis_client.set(f"{self.upload_key}:aggregated", self.plan_id, nx=True, ex=self.ttl))
+
+    def mark_done(self, batch_no: int) -> tuple[int, int]:
+        """
+        mark the batch as done (idempotent, batch can be redelivered), returns no. of done & total batches
+        total is 0 if the plan is already aggregated
+        """
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.sadd(f"{self.key}:done", batch_no)
+        pipe.expire(f"{self.key}:done", self.ttl)
+        pipe.scard(f"{self.key}:done")
+        pipe.get(f"{self.key}:total")
+        _, _, done, total = pipe.execute()
+
+        # total is not there once the plan is aggregated (or expired)
+        return done, int(total or 0)
+
+    def add_image_bytes(self, image_bytes: dict[str, int]):
+        """ adds up the image bytes (in, out, passthrough) of the batch, so aggregator can record them for the upload """
+        pipe = self.redis_client.pipeline(transaction=False)
+        for field, value in image_bytes.items():
+            pipe.hincrby(f"{self.key}:bytes", field, value)
+        pipe.expire(f"{self.key}:bytes", self.ttl)
+        pipe.execute()
+
+    def image_bytes(self) -> dict[str, int]:
+        return {field.decode(): int(value) for field, value in self.redis_client.hgetall(f"{self.key}:bytes").items()}
+
+    def acquire_aggregation(self) -> bool:
+        """
+        only one worker (of any plan) aggregates the upload, returns False if other worker holds the lock
+        lock is renewed every third of its ttl until released, so it expires only if the holder dies
+        """
+        # token is not thread local, renewer thread holds the lock on behalf of the aggregating one
+        lock = self.redis_client.lock(f"{self.upload_key}:aggregating", timeout=self.aggregation_lock_ttl, blocking=False,
+                                      thread_local=False)
+        if not lock.acquire():
+            return False
+
+        self.aggregation_lock = lock
+        self.aggregation_done.clear()
+        self.aggregation_renewer = Thread(target=self._renew_aggregation, args=(lock,), name="aggregation-renewer", daemon=True)
+        self.aggregation_renewer.start()
+        return True
+
+    def _renew_aggregation(self, lock: Lock):
+        """ runs in renewer thread, resets the ttl of the lock while it is held """
+        while not self.aggregation_done.wait(self.aggregation_lock_ttl / 3):
+            try:
+                lock.reacquire()
+            except LockError as e:
+                # do not raise error, lock expired (& can be held by other worker by now), nothing to renew
+                self.logr.error(f"Aggregation lock of {self.upload_key} is lost: {e}")
+                return
+            except Exception as e:
+                # do not raise error, renewal is tried again, lock still has the rest of its ttl
+                self.logr.error(f"Error while renewing aggregation lock of {self.upload_key}: {e}")
+
+    def release_aggregation(self):
+        """ releases the lock only if it is still held by this worker """
+        if self.aggregation_lock is None:
+            return
+
+        self.aggregation_done.set()
+        self.aggregation_renewer.join()
+        try:
+            self.aggregation_lock.release()
+        except LockError as e:
+            # do not raise error, lock expired in between, the lock of other worker (if any) is left alone
+            self.logr.error(f"Aggregation lock of {self.upload_key} was not held anymore: {e}")
+        finally:
+            self.aggregation_lock = None
+            self.aggregation_renewer = None
+
+    def clear(self):
+        """ drop the tracking keys of the plan, once it is aggregated (active plan & aggregated marker expire with ttl) """
+        try:
+            self.redis_client.delete(f"{self.key}:total", f"{self.key}:done", f"{self.key}:bytes")
+        except Exception as e:
+            # do not raise error, keys expire anyway
+            self.logr.error(f"Error while deleting fan-out keys of {self.key}: {e}")
@@ -0,0 +1,174 @@
+from logging import Logger
+from threading import Lock
+from redis import Redis
+import hashlib
+import time
+import os
+
+CACHE_KEY_PREFIX = "pixelriver-img-cache"
+
+
+def is_image_cache_enabled() -> bool:
+    """ cross upload cache of processed images is enabled only if IMAGE_CACHE is set to enable """
+    return os.getenv("IMAGE_CACHE") == "enable"
+
+
+class ProcessedImageCache:
+    """
+    This class is the redis backed index of the already processed images.
+    It maps the source url or the hash of downloaded bytes (along with the processing params)
+    to the public url of the processed image already uploaded to gcs.
+
+    Every entry expires after ttl seconds, and the index is capped to max_entries.
+    Oldest entries are evicted once the cap is crossed.
+    Redis errors are never raised, they are logged and treated as cache miss.
+
+    It also keeps the hit/miss counts, so hit rate can be reported for each upload.
+    """
+
+    def __init__(self, logr: Logger, redis_client: Redis, params_key: str, enabled: bool | None = None,
+                 ttl: int | None = None, max_entries: int | None = None):
+        self.logr = logr
+        self.redis_client = redis_client
+        self.params_key = params_key
+        self.enabled = is_image_cache_enabled() if enabled is None else enabled
+        self.ttl = ttl or int(os.getenv("IMAGE_CACHE_TTL", 86400))
+        self.max_entries = max_entries or int(os.getenv("IMAGE_CACHE_MAX_ENTRIES", 1000000))
+        self.index_key = f"{CACHE_KEY_PREFIX}:index"
+
+        self.stats_lock = Lock()
+        self.stats = {"urlHits": 0, "contentHits": 0, "misses": 0, "duplicates": 0}
+
+    def _url_key(self, url: str) -> str:
+        return f"{CACHE_KEY_PREFIX}:url:{self.params_key}:{hashlib.sha256(url.encode()).hexdigest()}"
+
+    def _content_key(self, digest: str) -> str:
+        return f"{CACHE_KEY_PREFIX}:content:{self.params_key}:{digest}"
+
+    def _count(self, stat: str, value: int = 1):
+        with self.stats_lock:
+            self.stats[stat] += value
+
+    def _get(self, key: str) -> str | None:
+        try:
+            value = self.redis_client.get(key)
+            return value.decode() if value is not None else None
+        except Exception as e:
+            # do not raise error, treat it as cache miss
+            self.logr.error(f"Error while reading image cache: {e}")
+            return None
+
+    def get_by_url(self, url: str) -> str | None:
+        """ returns the processed image url for given source url, if present in cache """
+        if not self.enabled:
+            return None
+
+        processed_url = self._get(self._url_key(url))
+        if processed_url is not None:
+            self._count("urlHits")
+
+        return processed_url
+
+    def get_by_content(self, digest: str) -> str | None:
+        """ returns the processed image url for given content digest, if present in cache """
+        if not self.enabled:
+            return None
+
+        processed_url = self._get(self._content_key(digest))
+        if processed_url is not None:
+            self._count("contentHits")
+        else:
+            self._count("misses")
+
+        return processed_url
+
+    def put(self, url: str, digest: str | None, processed_url: str):
+        """ this will index the processed image url by its source url & content digest """
+        if not self.enabled:
+            return
+
+        keys = [self._url_key(url)]
+        if digest is not None:
+            keys.append(self._content_key(digest))
+
+        now = time.time()
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            for key in keys:
+                pipe.set(key, processed_url, ex=self.ttl)
+                pipe.zadd(self.index_key, {key: now})
+
+            # drop the expired entries from index, then evict the oldest ones above the cap
+            pipe.zremrangebyscore(self.index_key, 0, now - self.ttl)
+            pipe.zcard(self.index_key)
+            index_size = pipe.execute()[-1]
+
+            if index_size > self.max_entries:
+                evicted = self.redis_client.zpopmin(self.index_key, index_size - self.max_entries)
+                if evicted:
+                    self.redis_client.delete(*[key for key, _ in evicted])
+        except Exception as e:
+            # do not raise error for this case
+            self.logr.error(f"Error while writing image cache: {e}")
+
+    def add_duplicates(self, count: int):
+        """ no. of images skipped because same url was already present in the same upload """
+        self._count("duplicates", count)
+
+    def report(self, total_images: int) -> dict:
+        """ this will return the cache stats for the upload, including the hit rate """
+        with self.stats_lock:
+            stats = dict(self.stats)
+
+        hits = stats["urlHits"] + stats["contentHits"] + stats["duplicates"]
+        stats["hitRate"] = round(hits / total_images, 4) if total_images else 0.0
+
+        return stats
+
+
+def is_failure_cache_enabled() -> bool:
+    """ short lived cache of the failed image urls is enabled only if IMAGE_FAILURE_CACHE is set to enable """
+    return os.getenv("IMAGE_FAILURE_CACHE") == "enable"
+
+
+class FailedImageCache:
+    """
+    This class is the redis backed negative cache of the image urls which failed recently (download or decode),
+    shared by all the workers, so the same broken url is not fetched again & again (within ttl seconds).
+    It maps the source url to the error, which becomes the result of the image.
+
+    Redis errors are never raised, they are logged and treated as cache miss.
+    """
+
+    def __init__(self, logr: Logger, redis_client: Redis, enabled: bool | None = None, ttl: int | None = None):
+        self.logr = logr
+        self.redis_client = redis_client
+        self.enabled = is_failure_cache_enabled() if enabled is None else enabled
+        self.ttl = ttl or int(os.getenv("IMAGE_FAILURE_CACHE_TTL", 300))
+
+    def _key(self, url: str) -> str:
+        return f"{CACHE_KEY_PREFIX}:failed:{hashlib.sha256(url.encode()).hexdigest()}"
+
+    def get(self, url: str) -> str | None:
+        """ returns the error of url, if it failed recently """
+        if not self.enabled:
+            return None
+
+        try:
+            error = self.redis_client.get(self._key(url))
+            return error.decode() if error is not None else None
+        except Exception as e:
+            # do not raise error, treat it as cache miss
+            self.logr.error(f"Error while reading failed image cache: {e}")
+            return None
+
+    def put(self, url: str, error: str):
+        """ this will remember the failure of url for ttl seconds """
+        if not self.enabled:
+            return
+
+        try:
+            self.redis_client.set(self._key(url), error, ex=self.ttl)
+        except Exception as e:
+            # do not raise error for this case
+            self.logr.error(f"Error while writing failed image cache: {e}")
@@ -0,0 +1,241 @@
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+from threading import Lock, Condition
+from urllib.parse import urlsplit
+from logging import Logger
+import asyncio
+import time
+import os
+
+from .metrics import HOST_CONCURRENCY_LIMIT, HOST_IN_FLIGHT
+
+# key of the limiter used for the processed image uploads (all of them go to the same storage)
+STORAGE_HOST = "storage"
+
+# smoothing of the observed latency, higher reacts faster
+LATENCY_SMOOTHING = 0.2
+# how fast the baseline (best latency seen) drifts up to the current latency, so it follows a slower origin
+BASELINE_DRIFT = 0.01
+
+
+def is_adaptive_concurrency_enabled() -> bool:
+    """ if enabled, in-flight image downloads & uploads are limited per host by an adaptive (AIMD) limit """
+    return os.getenv("IMAGE_ADAPTIVE_CONCURRENCY") == "enable"
+
+
+class AdaptiveLimiter:
+    """
+    This class limits the no. of requests in-flight to one host, and adjusts that limit (AIMD):
+        - every successful request adds 1/limit, i.e. limit grows by 1 per full window of requests
+        - congestion multiplies the limit by backoff_ratio, at most once per smoothed latency
+          (requests already in-flight when it happened do not decrease it again)
+    Congestion is a failed request (throttled, 5xx, timeout, connection error)
+    or the smoothed latency going above latency_tolerance times the baseline (best latency seen, slowly drifting up).
+    Limit always stays within min_limit & max_limit.
+
+    Slots can be taken from threads (slot) and from event loops (slot_async), both share the same limit.
+    """
+
+    def __init__(self, host: str, direction: str, min_limit: int, max_limit: int, initial_limit: int,
+                 latency_tolerance: float, backoff_ratio: float):
+        self.host = host
+        self.direction = direction
+        self.min_limit = max(min_limit, 1)
+        self.max_limit = max(max_limit, self.min_limit)
+        self.limit = float(min(max(initial_limit, self.min_limit), self.max_limit))
+        self.latency_tolerance = latency_tolerance
+        self.backoff_ratio = backoff_ratio
+
+        self.lock = Lock()
+        self.condition = Condition(self.lock)
+        self.in_flight = 0
+        self.latency: float | None = None
+        self.baseline: float | None = None
+        self.decreased_at = 0.0
+        # (loop, future) of the coroutines waiting for a slot
+        self.async_waiters: deque[tuple[asyncio.AbstractEventLoop, asyncio.Future]] = deque()
+
+        self._report()
+
+    @contextmanager
+    def slot(self):
+        """
+        holds a slot for the with block, blocks till one is free
+        any exception raised in the block is taken as congestion, unless outcome["congested"] is set by the block
+        """
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+        outcome = {"congested": None}
+        started_at = time.perf_counter()
+        try:
+            yield outcome
+        except BaseException:
+            if outcome["congested"] is None:
+                outcome["congested"] = True
+            raise
+        finally:
+            self.release(time.perf_counter() - started_at, bool(outcome["congested"]))
+
+    @asynccontextmanager
+    async def slot_async(self):
+        """ same as slot, but waits for the slot without blocking the event loop """
+        await self._acquire_async()
+
+        outcome = {"congested": None}
+        started_at = time.perf_counter()
+        try:
+            yield outcome
+        except BaseException:
+            if outcome["congested"] is None:
+                outcome["congested"] = True
+            raise
+        finally:
+            self.release(time.perf_counter() - started_at, bool(outcome["congested"]))
+
+    async def _acquire_async(self):
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return
+
+            waiter = (loop, loop.create_future())
+            self.async_waiters.append(waiter)
+
+        try:
+            # slot is handed over (in_flight already counted) by release
+            await waiter[1]
+        except asyncio.CancelledError:
+            with self.lock:
+                if waiter in self.async_waiters:
+                    self.async_waiters.remove(waiter)
+                elif waiter[1].done() and not waiter[1].cancelled():
+                    # slot was handed over right before the cancellation, give it back
+                    self.in_flight -= 1
+                    self._wake()
+            raise
+
+    def release(self, latency: float, congested: bool):
+        """ frees the slot & adjusts the limit as per the outcome of the request """
+        with self.lock:
+            self.in_flight -= 1
+            self._adjust(latency, congested)
+            self._wake()
+            self._report()
+
+    def _adjust(self, latency: float, congested: bool):
+        now = time.monotonic()
+
+        if not congested:
+            self.latency = latency if self.latency is None else self.latency + (latency - self.latency) * LATENCY_SMOOTHING
+            self.baseline = latency if self.baseline is None else min(latency, self.baseline + (self.latency - self.baseline) * BASELINE_DRIFT)
+            congested = self.latency > self.baseline * self.latency_tolerance
+
+        if not congested:
+            self.limit = min(self.limit + 1 / self.limit, self.max_limit)
+            return
+
+        # requests in-flight at the time of congestion finish within about a latency, they do not decrease it again
+        if now - self.decreased_at < (self.latency or 0):
+            return
+
+        self.decreased_at = now
+        self.limit = max(self.limit * self.backoff_ratio, self.min_limit)
+
+    def _wake(self):
+        """ hands the free slots to the waiting coroutines first, then to the waiting threads """
+        while self.async_waiters and self.in_flight < int(self.limit):
+            loop, future = self.async_waiters.popleft()
+            self.in_flight += 1
+            try:
+                loop.call_soon_threadsafe(self._hand_over, future)
+            except RuntimeError:
+                # loop is closed, slot goes to the next waiter
+                self.in_flight -= 1
+
+        if self.in_flight < int(self.limit):
+            self.condition.notify(int(self.limit) - self.in_flight)
+
+    def _hand_over(self, future: asyncio.Future):
+        if future.cancelled():
+            with self.lock:
+                self.in_flight -= 1
+                self._wake()
+            return
+
+        future.set_result(None)
+
+    def _report(self):
+        HOST_CONCURRENCY_LIMIT.set(int(self.limit), host=self.host, direction=self.direction)
+        HOST_IN_FLIGHT.set(self.in_flight, host=self.host, direction=self.direction)
+
+
+class HostLimiters:
+    """
+    This class keeps one AdaptiveLimiter per host & direction (download from the image origin, upload to storage).
+    One instance is meant to be shared by all the uploads of the process, so what is learnt about a host carries over.
+    """
+
+    def __init__(self, logr: Logger, min_limit: int, max_limit: int, initial_limit: int,
+                 latency_tolerance: float, backoff_ratio: float):
+        self.logr = logr
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.initial_limit = initial_limit
+        self.latency_tolerance = latency_tolerance
+        self.backoff_ratio = backoff_ratio
+
+        self.lock = Lock()
+        self.limiters: dict[tuple[str, str], AdaptiveLimiter] = {}
+
+    def get(self, host: str, direction: str) -> AdaptiveLimiter:
+        key = (host, direction)
+        limiter = self.limiters.get(key)
+        if limiter is not None:
+            return limiter
+
+        with self.lock:
+            if key not in self.limiters:
+                self.limiters[key] = AdaptiveLimiter(host, direction, self.min_limit, self.max_limit, self.initial_limit,
+                                                     self.latency_tolerance, self.backoff_ratio)
+            return self.limiters[key]
+
+    def for_download(self, url: str) -> AdaptiveLimiter:
+        return self.get(urlsplit(url).netloc.lower(), "download")
+
+    def for_upload(self) -> AdaptiveLimiter:
+        return self.get(STORAGE_HOST, "upload")
+
+    def limits(self) -> dict[str, int]:
+        """ current limit of every host, e.g. {"download cdn.example.com": 12} """
+        with self.lock:
+            limiters = list(self.limiters.values())
+        return {f"{limiter.direction} {limiter.host}": int(limiter.limit) for limiter in limiters}
+
+
+def initialize_host_limiters(logr: Logger, min_limit: int, max_limit: int, initial_limit: int,
+                             latency_tolerance: float, backoff_ratio: float) -> HostLimiters:
+    """ This will initialize the per host limiters and return them """
+    limiters = HostLimiters(logr, min_limit, max_limit, initial_limit, latency_tolerance, backoff_ratio)
+
+    logr.info(f"Adaptive host concurrency enabled, limit {min_limit}-{max_limit} (initial {initial_limit})")
+
+    return limiters
+
+
+def get_host_limiters(logr: Logger) -> HostLimiters | None:
+    """ returns the per host limiters configured via envs, None if adaptive concurrency is not enabled """
+    if not is_adaptive_concurrency_enabled():
+        return None
+
+    return initialize_host_limiters(
+        logr,
+        min_limit=int(os.getenv("IMAGE_HOST_CONCURRENCY_MIN", 2)),
+        max_limit=int(os.getenv("IMAGE_HOST_CONCURRENCY_MAX", 64)),
+        initial_limit=int(os.getenv("IMAGE_HOST_CONCURRENCY_INITIAL", 8)),
+        latency_tolerance=float(os.getenv("IMAGE_HOST_LATENCY_TOLERANCE", 2.0)),
+        backoff_ratio=float(os.getenv("IMAGE_HOST_BACKOFF_RATIO", 0.7)),
+    )
@@ -1,8 +1,13 @@
-from .consumer import initialize_image_processing_consumer
-from dotenv import load_dotenv
+import time
+
+# taken before the other imports, so the startup times (ready, first message) include the import time
+STARTED_AT = time.perf_counter()
+
+from .consumer import initialize_image_processing_consumer  # noqa: E402
+from dotenv import load_dotenv  # noqa: E402
 
 load_dotenv()
 
 
 if __name__ == "__main__":
-    initialize_image_processing_consumer()
+    initialize_image_processing_consumer(STARTED_AT)
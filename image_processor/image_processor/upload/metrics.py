@@ -0,0 +1,87 @@
+from core.metrics import METRICS
+from contextlib import contextmanager
+from threading import Lock
+import time
+import os
+
+STAGE_DURATION = METRICS.histogram(
+    "pixelriver_upload_stage_duration_seconds",
+    "Duration of each stage of upload processing (csv, per image & redis/mongo calls)",
+    ("stage",),
+)
+UPLOAD_DURATION = METRICS.histogram("pixelriver_upload_duration_seconds", "Duration of processing an upload, end to end")
+UPLOADS = METRICS.counter("pixelriver_uploads_total", "Uploads processed, by status", ("status",))
+UPLOADS_IN_PROGRESS = METRICS.gauge("pixelriver_uploads_in_progress", "Uploads being processed right now")
+
+IMAGES = METRICS.counter("pixelriver_images_total", "Images of uploads, by result (processed, failed, duplicate)", ("result",))
+IMAGE_BYTES_IN = METRICS.counter("pixelriver_image_bytes_in_total", "Bytes of downloaded images")
+IMAGE_BYTES_OUT = METRICS.counter("pixelriver_image_bytes_out_total", "Bytes of processed images")
+IMAGE_PASSTHROUGHS = METRICS.counter(
+    "pixelriver_image_passthrough_total",
+    "Images kept as downloaded, as re-encoding them as per the encoding profile did not make them smaller",
+)
+HOST_CONCURRENCY_LIMIT = METRICS.gauge(
+    "pixelriver_image_host_concurrency_limit",
+    "Current adaptive limit of in-flight image requests, per host & direction (download, upload)",
+    ("host", "direction"),
+)
+HOST_IN_FLIGHT = METRICS.gauge("pixelriver_image_host_in_flight", "Image requests in-flight, per host & direction", ("host", "direction"))
+HOST_CIRCUIT_STATE = METRICS.gauge("pixelriver_image_host_circuit_state", "Circuit of image host: 0 closed, 1 half open, 2 open", ("host",))
+IMAGE_FAST_FAILURES = METRICS.counter(
+    "pixelriver_image_fast_failures_total",
+    "Images failed without a download, by reason (circuit_open, failure_cache)",
+    ("reason",),
+)
+IMAGE_SCHEDULER_WAIT = METRICS.histogram(
+    "pixelriver_image_scheduler_wait_seconds",
+    "Time an image download waited for its turn in the fair image scheduler",
+)
+IMAGE_SCHEDULER_UPLOADS = METRICS.gauge("pixelriver_image_scheduler_uploads", "Uploads sharing the fair image scheduler right now")
+IMAGE_COMPRESSION_RATIO = METRICS.histogram(
+    "pixelriver_image_compression_ratio",
+    "Processed size / downloaded size of each image",
+    buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1, 1.25, 1.5, 2),
+)
+
+
+def is_upload_timings_enabled() -> bool:
+    """ if enabled, the time taken by each stage is saved in the upload doc (timings) """
+    return os.getenv("UPLOAD_TIMINGS") == "enable"
+
+
+class UploadTimings:
+    """
+    This class adds up the time taken by each stage of one upload, and observes it in the stage metrics as well.
+    Image stages run in parallel, so their total is the time spent across all the workers, not the wall time.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.started_at = time.perf_counter()
+        # stage -> [count, seconds]
+        self.stages: dict[str, list] = {}
+
+    @contextmanager
+    def time(self, stage: str):
+        """ times the with block under the stage """
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - started_at)
+
+    def add(self, stage: str, seconds: float):
+        STAGE_DURATION.observe(seconds, stage=stage)
+        with self.lock:
+            totals = self.stages.setdefault(stage, [0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started_at
+
+    def summary(self) -> dict:
+        """ {totalMs, stages: {stage: {count, totalMs}}}, to be saved in upload doc """
+        with self.lock:
+            stages = {stage: {"count": count, "totalMs": round(seconds * 1000, 1)} for stage, (count, seconds) in self.stages.items()}
+        return {"totalMs": round(self.elapsed() * 1000, 1), "stages": stages}
@@ -0,0 +1,123 @@
+from logging import Logger
+from queue import Queue
+from threading import Thread
+from typing import Any, Callable, Iterable
+import os
+
+from .transcoder import get_io_worker_count, get_transcode_worker_count
+
+# marker put in the stage queue to tell the stage workers to stop
+_STOP = object()
+
+
+class Completed:
+    """ returned by a stage to finish the image early with the given result, remaining stages are skipped """
+    __slots__ = ("result",)
+
+    def __init__(self, result: str):
+        self.result = result
+
+
+def get_download_worker_count() -> int:
+    """ no. of threads used for downloading the images (default: IMAGE_IO_WORKER_COUNT) """
+    return int(os.getenv("IMAGE_DOWNLOAD_WORKER_COUNT", get_io_worker_count()))
+
+
+def get_upload_worker_count() -> int:
+    """ no. of threads used for uploading the processed images (default: IMAGE_IO_WORKER_COUNT) """
+    return int(os.getenv("IMAGE_UPLOAD_WORKER_COUNT", get_io_worker_count()))
+
+
+def get_pipeline_queue_size() -> int:
+    """ max no. of images waiting in between two stages of the pipeline """
+    return int(os.getenv("IMAGE_PIPELINE_QUEUE_SIZE", 64))
+
+
+class ImagePipeline:
+    """
+    This class runs the per image work of an upload as a staged pipeline:
+        download -> transcode -> upload
+    Each stage has its own worker threads, and stages are connected via bounded queues.
+    If a stage is slow, the queue in front of it fills up and the previous stage blocks (backpressure),
+    so the no. of images held in memory stays flat no matter how big the CSV is.
+
+    Each stage function takes the output of the previous stage. If any stage raises,
+    the remaining stages are skipped for that image and str(error) becomes its result.
+    A stage can also return Completed(result) to skip the remaining stages (e.g. cache hit).
+    """
+
+    def __init__(self, logr: Logger,
+                 download: Callable[[Any], Any], transcode: Callable[[Any], Any], upload: Callable[[Any], str],
+                 download_workers: int | None = None, transcode_workers: int | None = None, upload_workers: int | None = None,
+                 queue_size: int | None = None):
+        self.logr = logr
+        self.stages = [
+            (download, download_workers or get_download_worker_count()),
+            (transcode, transcode_workers or max(get_transcode_worker_count(), 1)),
+            (upload, upload_workers or get_upload_worker_count()),
+        ]
+        self.queue_size = queue_size or get_pipeline_queue_size()
+
+    def run(self, items: Iterable[Any], total: int, on_complete: Callable[[int, str], None] | None = None) -> list[str]:
+        """
+        This will push every item (input of download stage) through the pipeline
+        and return the results in the same order as items
+        on_complete(index, result) is called from the last stage after each image is done
+        """
+        results: list[str] = [None] * total
+
+        def complete(item: tuple[int, Any, str | None]):
+            index, payload, result = item
+            results[index] = result if result is not None else payload
+            if on_complete is not None:
+                on_complete(index, results[index])
+
+        # build the stage queues, last stage directly writes to results
+        queues = [Queue(maxsize=self.queue_size) for _ in self.stages]
+        outputs = [q.put for q in queues[1:]] + [complete]
+
+        workers: list[list[Thread]] = []
+        for (stage_fn, worker_count), in_queue, emit in zip(self.stages, queues, outputs):
+            stage_workers = [
+                Thread(target=self._stage_worker, args=(stage_fn, in_queue, emit), daemon=True)
+                for _ in range(worker_count)
+            ]
+            for worker in stage_workers:
+                worker.start()
+            workers.append(stage_workers)
+
+        # feed the first stage, this blocks when download queue is full
+        for index, item in enumerate(items):
+            queues[0].put((index, item, None))
+
+        # stop the stages one by one, so every queued image is drained before next stage is stopped
+        for in_queue, stage_workers in zip(queues, workers):
+            for _ in stage_workers:
+                in_queue.put(_STOP)
+            for worker in stage_workers:
+                worker.join()
+
+        return results
+
+    def _stage_worker(self, stage_fn: Callable[[Any], Any], in_queue: Queue, emit: Callable[[tuple], None]):
+        """ this will run the stage_fn for each item of in_queue and emit the output to next stage """
+        while True:
+            item = in_queue.get()
+            if item is _STOP:
+                return
+
+            # result is set once the image is finished (error or early completion)
+            index, payload, result = item
+            if result is None:
+                try:
+                    payload = stage_fn(payload)
+                    if isinstance(payload, Completed):
+                        payload, result = None, payload.result
+                except Exception as e:
+                    payload, result = None, str(e)
+
+            try:
+                emit((index, payload, result))
+            except Exception as e:
+                # do not kill the stage worker for this
+                self.logr.exception(e)
@@ -2,19 +2,56 @@ from logging import Logger
 from pymongo.database import Database, Collection
 from bson import ObjectId
 from redis import Redis
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+from pymongo.errors import ConnectionFailure
+from google.api_core.exceptions import ServerError, TooManyRequests
 from core.gcp import GCPStorageManager
-from typing import TypedDict
+from core.mongo import MongoWriteBuffer, get_mongo_write_timeout
+from core.http_client import HttpClient, get_http_client
+from core.webhook_queue import publish_webhook
+from core.logger import log_image_event
+from core.kafka import IMAGE_BATCH_TOPIC, RedeliverMessage
+from kafka import KafkaProducer
+from typing import TypedDict, Iterator
+from contextlib import nullcontext, contextmanager, asynccontextmanager
 from datetime import datetime
+from dataclasses import dataclass, field
+import asyncio
+import aiohttp
 import pandas
-from concurrent.futures import ThreadPoolExecutor
-from multiprocessing import Value
+import numpy
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from threading import Lock
-from uuid import uuid4
-from PIL import Image
 from io import BytesIO
 import requests
-from pathlib import Path
 import os
+from .transcoder import transcode_derivatives, TranscodedImage
+from .profiles import EncodingProfile, get_encoding_profile, get_derivative_profiles, DEFAULT_PROFILE
+from .pipeline import ImagePipeline, Completed, get_download_worker_count, get_upload_worker_count
+from .async_engine import AsyncImageEngine, get_image_engine
+from .image_cache import ProcessedImageCache, FailedImageCache
+from .spool import ImageSpool, ImageTooLarge, DOWNLOAD_CHUNK_SIZE, check_content_length, release_image_data
+from .progress import ProgressReporter
+from .checkpoint import UploadCheckpoint, url_digest
+from .limiter import HostLimiters
+from .breaker import HostBreakers, CircuitOpen
+from .scheduler import FairImageScheduler, UploadFlow, get_upload_weight, DEFAULT_WEIGHT
+from .fanout import FanoutTracker, encode_image_batch, new_plan_id, get_fanout_min_images, get_image_batch_size
+from .metrics import UploadTimings, UPLOADS, UPLOADS_IN_PROGRESS, UPLOAD_DURATION, IMAGES, \
+    IMAGE_BYTES_IN, IMAGE_BYTES_OUT, IMAGE_COMPRESSION_RATIO, IMAGE_FAST_FAILURES, IMAGE_PASSTHROUGHS, is_upload_timings_enabled
+
+
+# processed urls of an image (upload's profile first, then each derivative) are kept as one result joined by this
+DERIVATIVE_SEPARATOR = "|||"
+
+# errors of the backing services (redis, mongo, gcs), an image batch failing with them is redelivered instead of dropped
+TRANSIENT_ERRORS = (RedisConnectionError, RedisTimeoutError, ConnectionFailure, ServerError, TooManyRequests,
+                    requests.ConnectionError, requests.Timeout, TimeoutError)
+
+
+def get_csv_chunk_size() -> int:
+    """ no. of csv rows processed in one batch, 0 means whole csv is processed in one go """
+    return int(os.getenv("CSV_CHUNK_SIZE", 0))
 
 
 class UploadSchema(TypedDict):
@@ -27,25 +64,56 @@ class UploadSchema(TypedDict):
     updatedAt: datetime
 
 
+@dataclass
+class ImageTask:
+    """ state of a single image while it moves through the pipeline stages """
+    url: str
+    # image bytes, or path of the spool file for large images
+    data: bytes | str | None = None
+    digest: str | None = None
+    # downloaded size in bytes
+    size: int = 0
+    output: TranscodedImage | None = None
+    # renditions of the derivative profiles, in the same order
+    derivatives: list[TranscodedImage] = field(default_factory=list)
+
+
 class ProcessUploadId:
     """
     This class will process the upload id and do all the processing for the given upload id.
     It will do following things:
     1. Download the original csv file from gcs
     2. Transform the csv file to flatten format
-    3. Process each image in the flatten csv file(this processing will be done in parallel for multiple images)
-        a. Download the image
-        b. Process the image
-        c. Upload the processed image to gcs
+    3. Process each image in the flatten csv file(this processing will be done in parallel via staged pipeline)
+       images checkpointed by an earlier attempt of the upload are skipped, their output is reused
+        a. Download the image (download stage threads)
+        b. Process the image (transcode stage, runs in transcode process pool if provided)
+        c. Upload the processed image to gcs (upload stage threads)
+       if derivatives are selected, every image is rendered as per each of them from the same download & decode,
+       renditions are uploaded in parallel & each derivative gets its own output column
     4. Inverse transform the csv file to original format
     5. Upload the processed csv file to gcs
     6. Update the status in redis
     7. Update the status in mongo
     8. Send webhook if webhook url is present
     9. Delete the upload id from redis
+
+    If image_scheduler is provided, downloads of the images wait for their turn in it, so concurrent uploads
+    share the download slots of the worker as per their priority & a small upload is not stuck behind a large one.
+
+    If kafka_producer is provided (fan-out mode), large uploads are not processed by this worker alone:
+    - planner (start_processing) splits the not yet processed images in batches & publishes them to IMAGE_BATCH_TOPIC
+    - any worker processes a batch (process_image_batch) & checkpoints the result of its images
+    - worker completing the last batch aggregates the upload, i.e. runs the above steps with all the images
+      already checkpointed, so only the csv is rebuilt & the upload is finished
+    - batch failing on a backing service (TRANSIENT_ERRORS) raises RedeliverMessage, so it is processed again
     """
 
-    def __init__(self, logr: Logger, mongo_db_client: Database, redis_client: Redis, gcp_bucket_mgr: GCPStorageManager):
+    def __init__(self, logr: Logger, mongo_db_client: Database, redis_client: Redis, gcp_bucket_mgr: GCPStorageManager,
+                 transcode_pool: ProcessPoolExecutor | None = None, http_client: HttpClient | None = None,
+                 mongo_writer: MongoWriteBuffer | None = None, kafka_producer: KafkaProducer | None = None,
+                 host_limiters: HostLimiters | None = None, host_breakers: HostBreakers | None = None,
+                 image_scheduler: FairImageScheduler | None = None):
 
         # add services in object instance
         self.logr = logr
@@ -54,79 +122,409 @@ class ProcessUploadId:
         self.redis_client = redis_client
         self.gcp_bucket_mgr = gcp_bucket_mgr
 
+        # shared write-behind buffer, batches the upload state writes of concurrent uploads
+        self.mongo_writer = mongo_writer
+
+        # image batches of large uploads are published via this, in fan-out mode
+        self.kafka_producer = kafka_producer
+
+        # set while aggregating a fanned out upload: errors of failed images are taken from checkpoints
+        # and progress does not go back below what the batches already reported
+        self.resume_failed = False
+        self.progress_floor = 0
+
+        # flattened csv chunks read by the fan-out planner, processed from (not read again) if upload is not fanned out
+        self.planned_chunks: list[tuple[pandas.DataFrame, float]] | None = None
+
+        # cpu bound transcoding runs in this pool, if not provided then it runs in the io thread itself
+        self.transcode_pool = transcode_pool
+
+        # shared adaptive limits of in-flight downloads (per origin host) & uploads, if enabled
+        self.host_limiters = host_limiters
+
+        # shared circuit breakers of image hosts, if enabled
+        self.host_breakers = host_breakers
+
+        # shared download slots of the concurrent uploads (weighted by priority of upload doc), if enabled
+        self.image_scheduler = image_scheduler
+        self.weight = DEFAULT_WEIGHT
+        self.scheduler_flow: UploadFlow | None = None
+
+        # shared keep-alive http client for image downloads
+        self.http_client = http_client or get_http_client(logr, get_download_worker_count())
+
+        # already processed images, in this upload (url -> result) & across uploads (redis)
+        self.seen_images: dict[str, str] = {}
+        self.total_images = 0
+        self.image_cache = ProcessedImageCache(logr, redis_client, params_key=DEFAULT_PROFILE.key)
+
+        # how images are re-encoded, selected per upload
+        self.profile = DEFAULT_PROFILE
+        # extra renditions of every image (e.g. thumbnail), selected per upload
+        self.derivatives: list[EncodingProfile] = []
+        # renditions of an image are uploaded in parallel, upload stage thread uploads the main one & waits for these
+        # (threads are started only when used)
+        self.derivative_upload_pool = ThreadPoolExecutor(
+            max_workers=host_limiters.max_limit if host_limiters is not None else get_upload_worker_count(),
+            thread_name_prefix="derivative-upload",
+        )
+
+        # downloaded & processed bytes of the images of this upload
+        self.image_bytes_lock = Lock()
+        self.image_bytes = {"in": 0, "out": 0, "passthrough": 0}
+        # recently failed urls (across uploads & workers)
+        self.failed_images = FailedImageCache(logr, redis_client)
+
+    def _start(self, upload_id: str):
+        self.upload_id = upload_id
+        self.progress_reporter = ProgressReporter(self.logr, self.redis_client, upload_id)
+        self.timings = UploadTimings()
+        self.checkpoint = UploadCheckpoint(self.logr, self.redis_client, upload_id)
+
+    def _use_profile(self, name: str | None, derivatives: list[str] | None = None):
+        """ selects the encoding profile & derivative profiles (by name) for the images of the upload """
+        self.profile = get_encoding_profile(self.logr, name)
+        self.derivatives = get_derivative_profiles(self.logr, derivatives)
+        # processed images are cached per profiles, as different profiles give different output
+        self.image_cache.params_key = "|".join(profile.key for profile in [self.profile, *self.derivatives])
+
     def start_processing(self, upload_id: str):
         """ This will start processing  for the given upload id """
-        self.upload_id = upload_id
+        self._start(upload_id)
+
+        UPLOADS_IN_PROGRESS.inc()
         try:
-            self._process()
+            if self.kafka_producer is not None and self._fan_out():
+                UPLOADS.inc(status="fanned_out")
+            else:
+                self._process()
+                UPLOADS.inc(status="completed")
         except Exception as e:
             # do not raise error
             self.logr.exception(e)
+            UPLOADS.inc(status="failed")
+        finally:
+            self.derivative_upload_pool.shutdown()
+            UPLOADS_IN_PROGRESS.dec()
+            UPLOAD_DURATION.observe(self.timings.elapsed())
 
     def _process(self):
         # find the uploadId from Database
-        upload_doc = self.upload_collection.find_one({"_id": ObjectId(self.upload_id)})
+        with self.timings.time("mongo_find"):
+            upload_doc = self.upload_collection.find_one({"_id": ObjectId(self.upload_id)}, {"fileName": 1, "webhookUrl": 1, "encodingProfile": 1, "derivatives": 1, "priority": 1})
         if upload_doc is None:
             raise Exception(f"Upload with id {self.upload_id} not found")
 
+        self._use_profile(upload_doc.get("encodingProfile"), upload_doc.get("derivatives"))
+        self.weight = get_upload_weight(upload_doc.get("priority"))
+
         # update the progress in redis
         self.update_status_in_redis("in_progess", 10)
 
-        # download the original parsed data of csv file from gcs in dataframe format
-        original_data = self._get_original_data(upload_doc)
+        read_fraction_done = 0.0
 
-        # this will flatten the CSV for multiple images in single row to single image in one row
-        original_data_flatten = self._transform_csv(original_data)
+        # processed csv is streamed to gcs as each chunk is processed, it is saved once the stream is closed
+        with self.gcp_bucket_mgr.open_csv_upload_stream(filename=upload_doc["fileName"]) as processed_csv:
 
-        # update the progress in redis
-        self.update_status_in_redis("in_progess", 20)
+            # stream the original csv file from gcs & parse it in dataframe format, flattened to single image in one row
+            # in chunked mode this yields the csv in row batches, so the whole csv is never materialized
+            for chunk_no, (original_data_flatten, read_fraction) in enumerate(self._get_flattened_data(upload_doc)):
 
-        # this will do the actual processing of images in parallel via multi-threading
-        processed_data_flatten = self._process_images_async(original_data_flatten)
+                # update the progress in redis
+                if chunk_no == 0:
+                    self.update_status_in_redis("in_progess", 20)
 
-        # update the progress in redis
-        self.update_status_in_redis("in_progess", 80)
+                # this will do the actual processing of images in parallel via staged pipeline
+                # each chunk owns the part of 20-80 progress window, equal to the part of csv it was read from
+                processed_data_flatten = self._process_images_async(
+                    original_data_flatten,
+                    progress_start=20 + 60 * read_fraction_done,
+                    progress_end=20 + 60 * read_fraction,
+                )
+                read_fraction_done = read_fraction
+
+                # this will againg convert CSV struture from single image in one row to multiple images in single row
+                with self.timings.time("unflatten"):
+                    processed_data: pandas.DataFrame = self._inverse_transform_csv(processed_data_flatten)
+
+                with self.timings.time("csv_upload"):
+                    processed_data.to_csv(path_or_buf=processed_csv, index=False, header=chunk_no == 0)
 
-        # this will againg convert CSV struture from single image in one row to multiple images in single row
-        processed_data: pandas.DataFrame = self._inverse_transform_csv(processed_data_flatten)
+            # update the progress in redis
+            self.update_status_in_redis("in_progess", 80)
 
-        # save the final file to GCP cloud storage
-        self._save_processed_data_to_gcs(processed_data, upload_doc)
+            # finish the csv upload, rest of the data is written to gcs on close
+            with self.timings.time("csv_upload"):
+                processed_csv.close()
 
         # update the progress in redis
         self.update_status_in_redis("in_progess", 99)
 
+        # report the hit rate of already processed images
+        image_cache_stats = self.image_cache.report(self.total_images)
+        self.logr.info(f"Upload {self.upload_id} image cache stats: {image_cache_stats}")
+        if self.host_limiters is not None:
+            self.logr.info(f"Upload {self.upload_id} host concurrency limits: {self.host_limiters.limits()}")
+
         # finally update the database
-        self.upload_collection.find_one_and_update(
-            {"_id": ObjectId(self.upload_id)},
-            {"$set": {"status": "completed", "progress": 100, "updatedAt": datetime.now()}}
-        )
+        upload_state = {
+            "status": "completed",
+            "progress": 100,
+            "imageCache": image_cache_stats,
+            "encodingProfile": self.profile.name,
+            "derivatives": [profile.name for profile in self.derivatives],
+            "imageBytes": self._image_bytes_report(),
+            "updatedAt": datetime.now(),
+        }
+        if is_upload_timings_enabled():
+            upload_state["timings"] = self.timings.summary()
+
+        with self.timings.time("mongo_update"):
+            self._save_upload_state(upload_state)
 
         # delete the key from redis, as upload is completed, & user can get the actual upload status
-        self.redis_client.delete(self.upload_id)
+        # checkpoints are not needed anymore as well
+        with self.timings.time("redis_delete"):
+            self.redis_client.delete(self.upload_id)
+            self.checkpoint.clear()
 
-        # send the event to pub/sub is webhook url is there
+        # send the event to webhook queue (pub/sub or stream) if webhook url is there
         if upload_doc["webhookUrl"] is not None:
-            self.redis_client.publish("webhook", f"{upload_doc['_id']}|||{upload_doc['webhookUrl']}")
+            with self.timings.time("webhook_publish"):
+                publish_webhook(self.redis_client, f"{upload_doc['_id']}|||{upload_doc['webhookUrl']}")
 
-    def _get_original_data(self, upload_doc: UploadSchema) -> pandas.DataFrame:
+    def _fan_out(self) -> bool:
         """
-        This will download the original csv file from gcs 
-        parse the CSV to build dataframe
-        and delete the file from local storage
+        planner of fan-out mode, splits the not yet processed images of the upload in batches & publishes them
+        returns False (nothing is published) if upload is small enough to be processed by this worker
         """
+        if FanoutTracker(self.logr, self.redis_client, self.upload_id, new_plan_id()).is_upload_aggregated():
+            # redelivered after a plan of it finished the upload (checkpoints are cleared by then), nothing to do
+            self.logr.info(f"Upload {self.upload_id} is already aggregated, not planned again")
+            return True
 
-        original_file_path = self.gcp_bucket_mgr.download_csv(filename=upload_doc["fileName"])
+        with self.timings.time("mongo_find"):
+            upload_doc = self.upload_collection.find_one({"_id": ObjectId(self.upload_id)}, {"fileName": 1, "encodingProfile": 1, "derivatives": 1, "priority": 1})
+        if upload_doc is None:
+            raise Exception(f"Upload with id {self.upload_id} not found")
 
-        original_data = pandas.read_csv(original_file_path)
+        self._use_profile(upload_doc.get("encodingProfile"), upload_doc.get("derivatives"))
+        self.weight = get_upload_weight(upload_doc.get("priority"))
 
+        # update the progress in redis
+        self.update_status_in_redis("in_progess", 10)
+
+        # flattened chunks are kept while the upload can still turn out small enough to be processed here
+        # (a large one is fanned out, so its chunks are not held in memory)
+        distinct_urls: dict[str, None] = {}
+        planned_chunks: list[tuple[pandas.DataFrame, float]] | None = []
+        for original_data_flatten, read_fraction in self._get_flattened_data(upload_doc):
+            distinct_urls.update(dict.fromkeys(original_data_flatten["Input Image Urls"]))
+            if planned_chunks is not None:
+                planned_chunks.append((original_data_flatten, read_fraction))
+                if len(distinct_urls) >= get_fanout_min_images():
+                    planned_chunks = None
+
+        # images processed in an earlier attempt of this upload are not planned again
+        with self.timings.time("redis_checkpoint"):
+            checkpointed = self.checkpoint.load(list(distinct_urls))
+        pending_urls = [url for url in distinct_urls if url not in checkpointed]
+
+        if len(pending_urls) < get_fanout_min_images():
+            # csv is read again only if its chunks were not kept (mostly processed in an earlier attempt)
+            self.planned_chunks = planned_chunks
+            return False
+
+        batch_size = get_image_batch_size()
+        batches = [pending_urls[start:start + batch_size] for start in range(0, len(pending_urls), batch_size)]
+
+        # plan is recorded (& made the active one) before publishing, so batches can not complete it early
+        plan_id = new_plan_id()
+        FanoutTracker(self.logr, self.redis_client, self.upload_id, plan_id).start(len(batches))
+
+        # update the progress in redis, before publishing as batches report progress from here
+        self.update_status_in_redis("in_progess", 20)
+
+        with self.timings.time("kafka_publish"):
+            for batch_no, batch in enumerate(batches):
+                self.kafka_producer.send(
+                    IMAGE_BATCH_TOPIC,
+                    key=f"{self.upload_id}:{batch_no}".encode(),
+                    value=encode_image_batch(self.upload_id, plan_id, batch_no, batch, self.profile.name,
+                                             [profile.name for profile in self.derivatives], self.weight),
+                )
+            self.kafka_producer.flush()
+
+        self.logr.info(f"Upload {self.upload_id} split in {len(batches)} batches of upto {batch_size} images (plan {plan_id})")
+        return True
+
+    def process_image_batch(self, upload_id: str, plan_id: str, batch_no: int, urls: list[str], profile: str | None = None,
+                            derivatives: list[str] | None = None, weight: float | None = None):
+        """
+        This will process one image batch of a fanned out upload & checkpoint the result of its images
+        worker completing the last batch of the plan aggregates the upload
+        """
+        self._start(upload_id)
         try:
-            Path(original_file_path).unlink()
+            self._use_profile(profile, derivatives)
+            self.weight = get_upload_weight(weight)
+            self._process_batch(plan_id, batch_no, urls)
+        except RedeliverMessage:
+            raise
+        except TRANSIENT_ERRORS as e:
+            # batch is processed again once redelivered, its images checkpointed by now are not
+            raise RedeliverMessage(f"Batch {batch_no} of upload {upload_id} failed: {e}") from e
         except Exception as e:
-            # do not raise error for this
-            self.logger.error(f"Error in deleting file: {original_file_path}"+e)
+            # do not raise error
+            self.logr.exception(e)
+        finally:
+            self.derivative_upload_pool.shutdown()
+
+    def _process_batch(self, plan_id: str, batch_no: int, urls: list[str]):
+        tracker = FanoutTracker(self.logr, self.redis_client, self.upload_id, plan_id)
+        if not tracker.is_active():
+            self.logr.info(f"Upload {self.upload_id} plan {plan_id} is re-planned or already aggregated, batch {batch_no} is skipped")
+            tracker.clear()
+            return
+
+        # images already done by an earlier delivery of this batch
+        with self.timings.time("redis_checkpoint"):
+            checkpointed = self.checkpoint.load(urls)
+        pending_urls = [url for url in urls if url not in checkpointed]
+
+        def on_complete(index, result):
+            # errors are checkpointed as well, aggregator puts them in the output csv
+            self._checkpoint_result(pending_urls[index], result, record_failure=True)
+
+        with self._fair_share():
+            self._get_image_engine().run((ImageTask(url) for url in pending_urls), len(pending_urls), on_complete=on_complete)
+
+        with self.timings.time("redis_checkpoint"):
+            self.checkpoint.flush()
+            tracker.add_image_bytes(self.image_bytes)
 
-        return original_data
+        done, total = tracker.mark_done(batch_no)
+        if not total:
+            # aggregated while this batch was being processed
+            return
+
+        # each batch owns the equal part of 20-80 progress window
+        self.update_status_in_redis("in_progess", 20 + 60 * done / total)
+
+        if done >= total:
+            self._aggregate(tracker)
+
+    def _aggregate(self, tracker: FanoutTracker):
+        """ builds the output csv of fanned out upload from the checkpoints & finishes the upload """
+
+        # other worker is aggregating, if its batch finished at the same time (or the batch of an old plan did)
+        # or it died while aggregating & this is the redelivery of its batch (lock expires then)
+        # batch is redelivered after a while instead of holding the handler slot, by then either is over
+        if not tracker.acquire_aggregation():
+            raise RedeliverMessage(f"Upload {self.upload_id} is being aggregated by other worker")
+
+        try:
+            # stale plan (re-planned) or the upload is aggregated by now
+            if not tracker.is_active():
+                return
+
+            self.resume_failed = True
+            self.progress_floor = 80
+            # images were processed by the batches, so are their bytes
+            self.image_bytes = tracker.image_bytes() or self.image_bytes
+            self._process()
+            UPLOADS.inc(status="completed")
+
+            tracker.mark_aggregated()
+            tracker.clear()
+        finally:
+            tracker.release_aggregation()
+
+    def _checkpoint_result(self, url: str, result: str, record_failure: bool = False):
+        """ counts the result of processed image & checkpoints it """
+        if result.startswith(self.gcp_bucket_mgr.public_file_path):
+            IMAGES.inc(result="processed")
+            self.checkpoint.record(url, result)
+            log_image_event(self.logr, "Image processed", uploadId=self.upload_id, url=url, processedUrl=result)
+        else:
+            IMAGES.inc(result="failed")
+            if record_failure:
+                self.checkpoint.record_failure(url, result)
+            log_image_event(self.logr, "Image failed", uploadId=self.upload_id, url=url, error=result)
+
+    def _count_image_bytes(self, source_size: int, output: TranscodedImage):
+        output_size = len(output.data)
+        IMAGE_BYTES_IN.inc(source_size)
+        IMAGE_BYTES_OUT.inc(output_size)
+        if source_size:
+            IMAGE_COMPRESSION_RATIO.observe(output_size / source_size)
+        if output.passthrough:
+            IMAGE_PASSTHROUGHS.inc()
+
+        with self.image_bytes_lock:
+            self.image_bytes["in"] += source_size
+            self.image_bytes["out"] += output_size
+            self.image_bytes["passthrough"] += int(output.passthrough)
+
+    def _image_bytes_report(self) -> dict:
+        """ downloaded & processed bytes of the images processed in this upload, with the bytes saved """
+        with self.image_bytes_lock:
+            image_bytes = dict(self.image_bytes)
+
+        image_bytes["saved"] = image_bytes["in"] - image_bytes["out"]
+        return image_bytes
+
+    def _save_upload_state(self, state: dict):
+        """
+        this will update the upload doc, via write buffer if provided
+        waits till it is written (upto MONGO_WRITE_TIMEOUT), as redis status is deleted right after & user falls back to the db status
+        """
+        if self.mongo_writer is not None:
+            self.mongo_writer.update_one("uploads", {"_id": ObjectId(self.upload_id)}, {"$set": state}).result(timeout=get_mongo_write_timeout())
+        else:
+            self.upload_collection.update_one({"_id": ObjectId(self.upload_id)}, {"$set": state})
+
+    def _get_original_data(self, upload_doc: UploadSchema) -> Iterator[tuple[pandas.DataFrame, float]]:
+        """
+        This will stream the original csv file from gcs 
+        and parse the CSV to build dataframe (file never touches the local disk)
+
+        if CSV_CHUNK_SIZE is set, this yields the dataframe in batches of that many rows
+        along with each batch it yields the fraction of csv file read so far (used for progress)
+        """
+
+        with self.timings.time("csv_download"):
+            csv_stream, file_size = self.gcp_bucket_mgr.open_csv_download_stream(filename=upload_doc["fileName"])
+        chunk_size = get_csv_chunk_size()
+
+        with csv_stream:
+            if not chunk_size:
+                with self.timings.time("csv_download"):
+                    original_data = pandas.read_csv(csv_stream)
+                yield original_data, 1.0
+                return
+
+            with pandas.read_csv(csv_stream, chunksize=chunk_size) as reader:
+                while True:
+                    # only the reading is timed, not the processing of yielded chunk
+                    with self.timings.time("csv_download"):
+                        chunk = next(reader, None)
+                    if chunk is None:
+                        return
+                    yield chunk, min(csv_stream.tell() / (file_size or 1), 1.0)
+
+    def _get_flattened_data(self, upload_doc: UploadSchema) -> Iterator[tuple[pandas.DataFrame, float]]:
+        """ same as _get_original_data, but flattened by _transform_csv (chunks kept by fan-out planner are not read again) """
+        if self.planned_chunks is not None:
+            planned_chunks, self.planned_chunks = self.planned_chunks, None
+            yield from planned_chunks
+            return
+
+        for original_data, read_fraction in self._get_original_data(upload_doc):
+            # this will flatten the CSV for multiple images in single row to single image in one row
+            with self.timings.time("flatten"):
+                original_data_flatten = self._transform_csv(original_data)
+            yield original_data_flatten, read_fraction
 
     def _transform_csv(self, df: pandas.DataFrame) -> pandas.DataFrame:
         """
@@ -135,20 +533,18 @@ class ProcessUploadId:
         this will return the parsed dataframe
         """
 
-        rows = []
-
-        for index, row in df.iterrows():
-            image_urls = str(row["Input Image Urls"]).split(",")
-            for url in image_urls:
-                rows.append({
-                    "row_id": index + 1,
-                    "Serial Number": row["Serial Number"],
-                    "Product Name": row["Product Name"],
-                    "Input Image Urls": url,
-                    "Output Image Urls": "yet_to_process"
-                })
+        flatten = pandas.DataFrame({
+            # index is global for chunked reads as well, so row_id stays unique across chunks
+            "row_id": df.index + 1,
+            "Serial Number": df["Serial Number"],
+            "Product Name": df["Product Name"],
+            "Input Image Urls": df["Input Image Urls"].astype(str).str.split(","),
+        })
+        flatten = flatten.explode("Input Image Urls", ignore_index=True)
+        for column in self._output_columns():
+            flatten[column] = "yet_to_process"
 
-        return pandas.DataFrame(rows)
+        return flatten
 
     def _inverse_transform_csv(self, df: pandas.DataFrame) -> pandas.DataFrame:
         """
@@ -156,144 +552,422 @@ class ProcessUploadId:
         this will return the parsed dataframe
         """
 
-        grouped = df.groupby("row_id")
+        # rows of same row_id are contiguous, so first row of each group carries the product details
+        products = df.drop_duplicates("row_id").set_index("row_id")[["Serial Number", "Product Name"]]
 
-        rows = []
-        for row_id, group in grouped:
-            image_urls = ",".join(group["Input Image Urls"].astype(str))
-            output_urls = ",".join(group["Output Image Urls"].astype(str))
+        url_columns = ["Input Image Urls", *self._output_columns()]
+        grouped = df.astype(dict.fromkeys(url_columns, str)).groupby("row_id", sort=False)
+        urls = grouped[url_columns].agg(",".join)
 
-            rows.append({
-                "Serial Number": group["Serial Number"].iloc[0],
-                "Product Name": group["Product Name"].iloc[0],
-                "Input Image Urls": image_urls,
-                "Output Image Urls": output_urls
-            })
+        return products.join(urls).reset_index(drop=True)
 
-        return pandas.DataFrame(rows)
-
-    def _process_images_async(self, df: pandas.DataFrame) -> pandas.DataFrame:
+    def _process_images_async(self, df: pandas.DataFrame, progress_start: float = 20, progress_end: float = 80) -> pandas.DataFrame:
         """
-        This will process the images in parallel via multi-threading
+        This will process the images in parallel via staged pipeline (download -> transcode -> upload)
         this will return the parsed dataframe
-        this will also update the progress in redis
+        this will also update the progress in redis, from progress_start to progress_end
+        (by default 20 to 80, as few progress steps happended before & are still left after this)
+
+        each distinct url is processed only once per upload, duplicates reuse the result of first occurrence
         """
-        total_rows = len(df)
-        progress_start = 20  # Starting progress from 20 as few progress steps happended before as well
-        progress_end = 80    # Ending progress value at 80 as few progress steps are still left after thi
+        self.total_images += len(df)
+
+        # find the distinct urls which are not yet processed in this upload
+        codes, distinct_urls = pandas.factorize(df["Input Image Urls"])
+        pending_urls = [url for url in distinct_urls if url not in self.seen_images]
+        self.image_cache.add_duplicates(len(df) - len(pending_urls))
+        IMAGES.inc(len(df) - len(pending_urls), result="duplicate")
+
+        # images already processed in an earlier attempt of this upload (worker died & upload is redelivered)
+        with self.timings.time("redis_checkpoint"):
+            checkpointed = self.checkpoint.load(pending_urls, include_failed=self.resume_failed)
+        if checkpointed:
+            self.seen_images.update(checkpointed)
+            pending_urls = [url for url in pending_urls if url not in checkpointed]
+            IMAGES.inc(len(checkpointed), result="resumed")
+
+        total_rows = len(pending_urls)
         progress_range = progress_end - progress_start
-        worker_count = os.cpu_count()*2
 
         # Lock for thread-safe progress updates
         progress_lock = Lock()
+        completed_tasks = 0
 
-        # Shared counter using multiprocessing.Value
-        completed_tasks_counter = Value('i', 0)  # 'i' stands for integer type
-
-        results = [None] * total_rows
-
-        def process_and_store(index, url):
-            results[index] = self._process_and_upload(url)
+        def update_progress(index, result):
+            nonlocal completed_tasks
+            # failed images are not checkpointed, so they are tried again on redelivery
+            self._checkpoint_result(pending_urls[index], result)
 
             # Increment the completed task counter
             with progress_lock:
-                completed_tasks_counter.value += 1
-                # Calculate and update the progress
-                progress = progress_start + (progress_range * completed_tasks_counter.value) / total_rows
-                self.update_status_in_redis("in_progess", progress)
+                completed_tasks += 1
+                # Calculate the progress
+                progress = progress_start + (progress_range * completed_tasks) / total_rows
 
-        with ThreadPoolExecutor(max_workers=worker_count) as executor:
-            for index, row in df.iterrows():
-                executor.submit(process_and_store, index, row["Input Image Urls"])
+            # progress reporter coalesces these updates, so redis is not hit for every image
+            self.progress_reporter.update("in_progess", progress)
 
-        # add the coloumn in dataframe
-        df["Output Image Urls"] = results
+        with self._fair_share():
+            results = self._get_image_engine().run((ImageTask(url) for url in pending_urls), total_rows, on_complete=update_progress)
+        self.seen_images.update(zip(pending_urls, results))
+
+        with self.timings.time("redis_checkpoint"):
+            self.checkpoint.flush()
+
+        # add the coloumns in dataframe, one per derivative along with the main one
+        distinct_results = [self._split_result(self.seen_images[url]) for url in distinct_urls]
+        for column, column_results in zip(self._output_columns(), zip(*distinct_results)):
+            df[column] = numpy.array(column_results, dtype=object)[codes]
 
         # return the final output
         return df
 
-    def _process_and_upload(self, url):
+    def _output_columns(self) -> list[str]:
+        """ output csv columns of processed urls: main one, then one per derivative """
+        return ["Output Image Urls", *(f"Output Image Urls ({profile.name})" for profile in self.derivatives)]
+
+    def _split_result(self, result: str) -> list[str]:
+        """ result of an image -> result per output column, error of a failed image goes in every column """
+        columns = len(self.derivatives) + 1
+        if not result.startswith(self.gcp_bucket_mgr.public_file_path):
+            return [result] * columns
+
+        # checkpoint of an attempt with other derivatives can miss some of them
+        return (result.split(DERIVATIVE_SEPARATOR) + [""] * columns)[:columns]
+
+    def _get_image_engine(self) -> ImagePipeline | AsyncImageEngine:
         """
-        This will download the image from the given url, load it in memory
-        then it will process the image(reduce its quality)
-        and then upload it to the GCP cloud storage
-        And will return the url of the processed image
+        returns the engine (selected via IMAGE_ENGINE) which will run the per image stages
+        with adaptive concurrency, io workers (connections per host) go upto the max limit & the host limiters decide the in-flight requests
         """
+        max_limit = self.host_limiters.max_limit if self.host_limiters is not None else None
+
+        if get_image_engine() == "async":
+            return AsyncImageEngine(
+                self.logr,
+                download=self._download_stage_async,
+                transcode=self._transcode_stage,
+                upload=self._upload_stage_async,
+                concurrency_per_host=max_limit,
+            )
+
+        return ImagePipeline(
+            self.logr,
+            download=self._download_stage,
+            transcode=self._transcode_stage,
+            upload=self._upload_stage,
+            download_workers=max_limit,
+            upload_workers=max_limit,
+        )
+
+    @contextmanager
+    def _fair_share(self):
+        """ registers the upload in the image scheduler (if enabled) while its images are processed """
+        if self.image_scheduler is None:
+            yield
+            return
+
+        with self.image_scheduler.flow(self.upload_id, self.weight) as flow:
+            self.scheduler_flow = flow
+            try:
+                yield
+            finally:
+                self.scheduler_flow = None
+
+    def _download_turn(self, is_async: bool = False):
+        """ slot of the image scheduler for a download of this upload (or no-op if image scheduler is not enabled) """
+        if self.scheduler_flow is None:
+            return nullcontext()
+
+        return self.scheduler_flow.turn_async() if is_async else self.scheduler_flow.turn()
+
+    def _download_guard(self, url: str):
+        """ circuit breaker of url's host (or no-op if circuit breaker is not enabled), raises CircuitOpen if host is failing """
+        if self.host_breakers is None:
+            return nullcontext({"failed": None})
+
+        return self.host_breakers.guard(url)
+
+    def _download_slot(self, url: str, is_async: bool = False):
+        """ slot of the download limiter of url's host (or no-op if adaptive concurrency is not enabled) """
+        if self.host_limiters is None:
+            return nullcontext({"congested": None})
+
+        limiter = self.host_limiters.for_download(url)
+        return limiter.slot_async() if is_async else limiter.slot()
+
+    def _upload_slot(self, is_async: bool = False):
+        """ slot of the storage upload limiter (or no-op if adaptive concurrency is not enabled) """
+        if self.host_limiters is None:
+            return nullcontext({"congested": None})
 
+        limiter = self.host_limiters.for_upload()
+        return limiter.slot_async() if is_async else limiter.slot()
+
+    def _download_stage(self, task: ImageTask) -> ImageTask | Completed:
+        """
+        download stage of the pipeline
+        finishes the image early if it is already processed in some previous upload (by url or by content)
+        or if it failed recently (failure cache)
+        """
+        if self.image_cache.enabled:
+            with self.timings.time("redis_image_cache"):
+                processed_url = self.image_cache.get_by_url(task.url)
+            if processed_url is not None:
+                return Completed(processed_url)
+
+        if self.failed_images.enabled:
+            with self.timings.time("redis_failure_cache"):
+                error = self.failed_images.get(task.url)
+            if error is not None:
+                IMAGE_FAST_FAILURES.inc(reason="failure_cache")
+                return Completed(error)
+
+        with self.timings.time("image_download"), self._failure_cached(task.url):
+            spool = self._download_image(task.url, hash_content=self.image_cache.enabled)
+            task.data, task.digest, task.size = spool.finish(), spool.digest, spool.size
+
+        return self._find_cached_by_content(task)
+
+    async def _download_stage_async(self, session: aiohttp.ClientSession, task: ImageTask) -> ImageTask | Completed:
+        """ download stage of the async engine, same as _download_stage. redis lookups run in executor """
+        if self.image_cache.enabled:
+            with self.timings.time("redis_image_cache"):
+                processed_url = await asyncio.to_thread(self.image_cache.get_by_url, task.url)
+            if processed_url is not None:
+                return Completed(processed_url)
+
+        if self.failed_images.enabled:
+            with self.timings.time("redis_failure_cache"):
+                error = await asyncio.to_thread(self.failed_images.get, task.url)
+            if error is not None:
+                IMAGE_FAST_FAILURES.inc(reason="failure_cache")
+                return Completed(error)
+
+        with self.timings.time("image_download"):
+            async with self._failure_cached_async(task.url):
+                spool = await self._download_image_async(session, task.url, hash_content=self.image_cache.enabled)
+                # closing the spool file is blocking io
+                task.data = await asyncio.to_thread(spool.finish) if spool.spool_file is not None else spool.finish()
+                task.digest, task.size = spool.digest, spool.size
+
+        if self.image_cache.enabled:
+            return await asyncio.to_thread(self._find_cached_by_content, task)
+
+        return task
+
+    def _find_cached_by_content(self, task: ImageTask) -> ImageTask | Completed:
+        """ finishes the image early if same content is already processed in some previous upload """
+        if not self.image_cache.enabled:
+            return task
+
+        with self.timings.time("redis_image_cache"):
+            processed_url = self.image_cache.get_by_content(task.digest)
+            if processed_url is not None:
+                self.image_cache.put(task.url, None, processed_url)
+
+        if processed_url is not None:
+            release_image_data(task.data)
+            return Completed(processed_url)
+
+        return task
+
+    @contextmanager
+    def _failure_cached(self, url: str):
+        """
+        error raised in the with block is saved in the failure cache (if enabled), so url is not tried again for a while
+        open circuit is not about the url, so it is not cached
+        """
+        try:
+            yield
+        except CircuitOpen:
+            raise
+        except Exception as e:
+            if self.failed_images.enabled:
+                # timeout errors of aiohttp have empty message
+                with self.timings.time("redis_failure_cache"):
+                    self.failed_images.put(url, str(e) or e.__class__.__name__)
+            raise
+
+    @asynccontextmanager
+    async def _failure_cached_async(self, url: str):
+        """ same as _failure_cached, for the async engine (redis write runs in executor) """
         try:
-            # download original image, save in memory
-            raw_img_buffer = self._download_image(url)
-            if raw_img_buffer is None:
-                raise Exception("Failed to download image")
-
-            # process the image
-            processed_img_buffer = self._process_image(raw_img_buffer)
-            if processed_img_buffer is None:
-                raise Exception("Failed to process image")
-
-            # upload the image to GCp
-            new_url = self.gcp_bucket_mgr.upload_image(file_buffer=processed_img_buffer, filename=f"{uuid4()}.jpg")
-            if new_url is None:
-                raise Exception("Failed to upload image")
-
-            # return the new url
-            return new_url
+            yield
+        except CircuitOpen:
+            raise
         except Exception as e:
-            return str(e)
+            if self.failed_images.enabled:
+                with self.timings.time("redis_failure_cache"):
+                    await asyncio.to_thread(self.failed_images.put, url, str(e) or e.__class__.__name__)
+            raise
 
-    def _download_image(self, url: str):
+    def _transcode_stage(self, task: ImageTask) -> ImageTask:
+        """ transcode stage of the pipeline, raw bytes (or spool file) are released once processed """
+        try:
+            with self.timings.time("image_transcode"), self._failure_cached(task.url):
+                task.output, *task.derivatives = self._process_image(task.data)
+        finally:
+            release_image_data(task.data)
+            task.data = None
+
+        # derivatives are extra renditions, only the main one is counted against the downloaded bytes
+        self._count_image_bytes(task.size, task.output)
+
+        return task
+
+    def _upload_stage(self, task: ImageTask) -> str:
         """
-        download the image from the url, and return the image buffer
+        upload stage of the pipeline, also indexes the processed image in the cache
+        renditions of derivatives are uploaded in parallel (derivative upload pool) with the main one
         """
+        with self.timings.time("image_upload"):
+            derivative_uploads = [
+                self.derivative_upload_pool.submit(self._upload_image, image, task.url, profile.name)
+                for profile, image in zip(self.derivatives, task.derivatives)
+            ]
+            processed_url = DERIVATIVE_SEPARATOR.join(
+                [self._upload_image(task.output, task.url), *(upload.result() for upload in derivative_uploads)]
+            )
 
-        response = requests.get(url)
+        if self.image_cache.enabled:
+            with self.timings.time("redis_image_cache"):
+                self.image_cache.put(task.url, task.digest, processed_url)
+        return processed_url
+
+    async def _upload_stage_async(self, session: aiohttp.ClientSession, task: ImageTask) -> str:
+        """ upload stage of the async engine, same as _upload_stage """
+        with self.timings.time("image_upload"):
+            processed_urls = await asyncio.gather(
+                self._upload_image_async(session, task.output, task.url),
+                *(self._upload_image_async(session, image, task.url, profile.name)
+                  for profile, image in zip(self.derivatives, task.derivatives)),
+            )
+            processed_url = DERIVATIVE_SEPARATOR.join(processed_urls)
 
-        if response.status_code != 200:
-            raise Exception(f"Failed to download image. Reason: {response.reason}")
+        if self.image_cache.enabled:
+            with self.timings.time("redis_image_cache"):
+                await asyncio.to_thread(self.image_cache.put, task.url, task.digest, processed_url)
+        return processed_url
 
-        return BytesIO(response.content)
+    def _download_image(self, url: str, hash_content: bool = False) -> ImageSpool:
+        """
+        download the image from the url, and return the spool holding the image
+        body is streamed, image is rejected as soon as it is known to be above IMAGE_MAX_BYTES
+        turn of the image scheduler is taken only once the host has a free slot,
+        so a download waiting on a throttled host does not hold a turn other uploads could use
+        """
 
-    def _process_image(self, image_data: BytesIO):
+        with self._download_guard(url) as health, self._download_slot(url) as outcome, self._download_turn(), \
+                self.http_client.get(url, stream=True) as response:
+            # only a throttled or failing origin lowers its limit, not a missing/oversized image
+            outcome["congested"] = response.status_code == 429 or response.status_code >= 500
+            # any failed response counts against the host in circuit breaker
+            health["failed"] = response.status_code != 200
+            if response.status_code != 200:
+                raise Exception(f"Failed to download image. Reason: {response.reason}")
+
+            spool = ImageSpool(hash_content=hash_content)
+            check_content_length(response.headers.get("Content-Length"), spool.max_bytes)
+
+            try:
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    spool.write(chunk)
+            except Exception as e:
+                spool.discard()
+                # slow or broken body is the host's fault as well
+                if not isinstance(e, ImageTooLarge):
+                    health["failed"] = outcome["congested"] = True
+                raise
+
+        return spool
+
+    async def _download_image_async(self, session: aiohttp.ClientSession, url: str, hash_content: bool = False) -> ImageSpool:
         """
-        this will open the given image buffer and reduce the quality by 50%
-        and will return the processed image buffer
+        async version of _download_image, using the aiohttp session of async engine
         """
-        img = Image.open(image_data)
-        img_format = img.format
-        img = img.convert("RGB")
-        output_buffer = BytesIO()
-        img.save(output_buffer, format=img_format, quality=50)
-        output_buffer.seek(0)
-        return output_buffer
 
-    def _save_processed_data_to_gcs(self, processed_data: pandas.DataFrame, upload_doc: UploadSchema):
+        with self._download_guard(url) as health:
+            async with self._download_slot(url, is_async=True) as outcome, self._download_turn(is_async=True), \
+                    session.get(url) as response:
+                outcome["congested"] = response.status == 429 or response.status >= 500
+                health["failed"] = response.status != 200
+                if response.status != 200:
+                    raise Exception(f"Failed to download image. Reason: {response.reason}")
+
+                spool = ImageSpool(hash_content=hash_content)
+                check_content_length(response.content_length, spool.max_bytes)
+
+                try:
+                    async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                        # writes to the spool file (large images) are blocking io, so they run in executor
+                        if spool.writes_to_file(len(chunk)):
+                            await asyncio.to_thread(spool.write, chunk)
+                        else:
+                            spool.write(chunk)
+                except Exception as e:
+                    await asyncio.to_thread(spool.discard) if spool.spool_file is not None else spool.discard()
+                    if not isinstance(e, ImageTooLarge):
+                        health["failed"] = outcome["congested"] = True
+                    raise
+
+        return spool
+
+    def _process_image(self, image_data: bytes | str) -> list[TranscodedImage]:
         """
-            This will save the processed data to gcs
-            save the processed data to gcs
-            convert the dataframe to csv
-            upload the csv to gcs
+        this will re-encode the given image bytes (or spool file path) as per the encoding profile of upload & each derivative profile
+        and will return the processed images (main one first), image is decoded only once for all of them
+        decode/encode is cpu bound, so it is offloaded to the transcode process pool (if present) to avoid the GIL
         """
+        profiles = [self.profile, *self.derivatives]
+        if self.transcode_pool is not None:
+            processed_imgs = self.transcode_pool.submit(transcode_derivatives, image_data, profiles).result()
+        else:
+            processed_imgs = transcode_derivatives(image_data, profiles)
 
-        csv_buffer = BytesIO()
-        processed_data.to_csv(path_or_buf=csv_buffer, index=False)
-        csv_buffer.seek(0)
+        if not processed_imgs:
+            raise Exception("Failed to process image")
 
-        self.gcp_bucket_mgr.upload_csv(
-            file_buffer=csv_buffer,
-            # using the same name, because upload folder be different
-            filename=upload_doc["fileName"]
-        )
+        return processed_imgs
+
+    def _upload_image(self, image: TranscodedImage, url: str, derivative: str | None = None) -> str:
+        """ this will upload the processed image (of source url) to the GCP cloud storage and return its url """
+
+        with self._upload_slot():
+            new_url = self.gcp_bucket_mgr.upload_image(
+                file_buffer=BytesIO(image.data),
+                filename=self._image_filename(url, image.extension, derivative),
+                content_type=image.content_type,
+            )
+        if new_url is None:
+            raise Exception("Failed to upload image")
+
+        return new_url
+
+    async def _upload_image_async(self, session: aiohttp.ClientSession, image: TranscodedImage, url: str,
+                                  derivative: str | None = None) -> str:
+        """ async version of _upload_image, using the aiohttp session of async engine """
+
+        async with self._upload_slot(is_async=True):
+            return await self.gcp_bucket_mgr.upload_image_async(
+                session,
+                file_buffer=BytesIO(image.data),
+                filename=self._image_filename(url, image.extension, derivative),
+                content_type=image.content_type,
+            )
+
+    def _image_filename(self, url: str, extension: str, derivative: str | None = None) -> str:
+        """
+        name of the processed image object in gcs, rendition of a derivative has the derivative's name as suffix
+        it is derived from upload id & source url, so re-processing the image (on redelivery) overwrites the same object
+        """
+        suffix = f"-{derivative}" if derivative else ""
+        return f"{self.upload_id}/{url_digest(url)}{suffix}.{extension}"
 
     def update_status_in_redis(self, status: str, progress: float):
         """
-        update the status of the upload id in redis.
+        update the status of the upload id in redis, right away.
         this will not raise exception even in case of error
         """
-        try:
-            self.redis_client.set(
-                name=self.upload_id,
-                value=f"{status}:{progress}"
-            )
-        except Exception as e:
-            # do not raise error for this case
-            self.logr.critical("Error while updating progress in redis"+e)
+        with self.timings.time("redis_progress"):
+            self.progress_reporter.update(status, max(progress, self.progress_floor), force=True)
@@ -0,0 +1,106 @@
+from dataclasses import dataclass, fields
+from logging import Logger
+import json
+import os
+
+# output format of the profile: same as the source image, or one of these
+SOURCE_FORMAT = "SOURCE"
+OUTPUT_FORMATS = (SOURCE_FORMAT, "JPEG", "WEBP")
+
+
+@dataclass(frozen=True)
+class EncodingProfile:
+    """
+    how the images of an upload are re-encoded
+        - format: SOURCE (same as the source image), JPEG or WEBP
+        - quality: encoder quality, or the highest quality tried if target_bytes is set
+        - target_bytes: if set, quality is binary searched (down to min_quality) for the largest output within this size
+        - max_size: if set, images with longest side above it are downscaled to it (aspect ratio is kept)
+        - progressive & optimize: jpeg encoder flags (optimize is the slower, smaller method for webp)
+        - strip_metadata: exif & icc profile of the source are not copied to the output
+    If the output is not smaller than the source image, the source image is kept as it is (passthrough).
+    """
+    name: str
+    format: str = SOURCE_FORMAT
+    quality: int = 50
+    target_bytes: int | None = None
+    min_quality: int = 20
+    max_size: int | None = None
+    progressive: bool = False
+    optimize: bool = False
+    strip_metadata: bool = True
+
+    @property
+    def key(self) -> str:
+        """ identifies the processing params, processed images are cached against it """
+        return "-".join(f"{field.name}={getattr(self, field.name)}" for field in fields(self) if field.name != "name")
+
+
+# same as the processing before profiles were there: source format at quality 50
+DEFAULT_PROFILE = EncodingProfile(name="default")
+
+BUILTIN_PROFILES = {
+    profile.name: profile for profile in [
+        DEFAULT_PROFILE,
+        EncodingProfile(name="jpeg", format="JPEG", quality=75, progressive=True, optimize=True),
+        EncodingProfile(name="webp", format="WEBP", quality=75),
+        EncodingProfile(name="jpeg-200kb", format="JPEG", quality=85, target_bytes=200 * 1024, progressive=True, optimize=True),
+        EncodingProfile(name="webp-100kb", format="WEBP", quality=85, target_bytes=100 * 1024, optimize=True),
+        EncodingProfile(name="jpeg-2048", format="JPEG", quality=80, max_size=2048, progressive=True, optimize=True),
+        EncodingProfile(name="webp-1024", format="WEBP", quality=75, max_size=1024),
+        # meant as derivatives (IMAGE_DERIVATIVES), along with the full rendition of the upload's profile
+        EncodingProfile(name="thumbnail", format="WEBP", quality=70, max_size=256),
+        EncodingProfile(name="medium", format="WEBP", quality=75, max_size=1024),
+    ]
+}
+
+
+def get_encoding_profiles() -> dict[str, EncodingProfile]:
+    """
+    builtin profiles along with the ones defined in IMAGE_ENCODING_PROFILES (json: {name: {format, quality, ...}})
+    a profile defined in env overrides the builtin one of same name
+    """
+    profiles = dict(BUILTIN_PROFILES)
+
+    for name, options in json.loads(os.getenv("IMAGE_ENCODING_PROFILES") or "{}").items():
+        profile = EncodingProfile(name=name, **options)
+        if profile.format not in OUTPUT_FORMATS:
+            raise Exception(f"Encoding profile {name} has unsupported format {profile.format}")
+        profiles[name] = profile
+
+    return profiles
+
+
+def get_encoding_profile(logr: Logger, name: str | None) -> EncodingProfile:
+    """
+    returns the profile selected for the upload (encodingProfile of upload doc)
+    or IMAGE_ENCODING_PROFILE if upload did not select any, unknown profile falls back to default
+    """
+    name = name or os.getenv("IMAGE_ENCODING_PROFILE", DEFAULT_PROFILE.name)
+
+    profile = get_encoding_profiles().get(name)
+    if profile is None:
+        logr.warning(f"Encoding profile {name} not found, using {DEFAULT_PROFILE.name}")
+        return DEFAULT_PROFILE
+
+    return profile
+
+
+def get_derivative_profiles(logr: Logger, names: list[str] | None) -> list[EncodingProfile]:
+    """
+    returns the profiles of the derivatives (extra renditions of every image) selected for the upload
+    (derivatives of upload doc), or IMAGE_DERIVATIVES (comma separated profile names) if upload did not select any
+    unknown profiles are skipped, as well as the repeated ones
+    """
+    if names is None:
+        names = [name.strip() for name in os.getenv("IMAGE_DERIVATIVES", "").split(",") if name.strip()]
+
+    profiles = get_encoding_profiles()
+    derivatives = []
+    for name in dict.fromkeys(names):
+        if name not in profiles:
+            logr.warning(f"Derivative profile {name} not found, skipping it")
+            continue
+        derivatives.append(profiles[name])
+
+    return derivatives
@@ -0,0 +1,78 @@
+from logging import Logger
+from threading import Lock
+from redis import Redis
+import time
+import os
+
+
+class ProgressReporter:
+    """
+    This class keeps the status & progress of an upload in memory and writes it to redis
+    at most every flush_interval_ms or every flush_step percentage points, whichever comes first.
+    Forced updates (stage milestones) are always written.
+
+    Redis write happens outside the progress lock, and if another thread is already flushing
+    the non forced update is simply skipped (its value is picked by the next flush).
+    Progress never goes backwards within a status: a lower value (e.g. computed by one thread, reported after a higher one
+    of another thread) is dropped, so flushes are in order too.
+    Key is written with a ttl, value format stays "<status>:<progress>"
+    """
+
+    def __init__(self, logr: Logger, redis_client: Redis, upload_id: str,
+                 flush_interval_ms: int | None = None, flush_step: float | None = None, ttl: int | None = None):
+        self.logr = logr
+        self.redis_client = redis_client
+        self.upload_id = upload_id
+        self.flush_interval = (flush_interval_ms or int(os.getenv("PROGRESS_FLUSH_INTERVAL_MS", 500))) / 1000
+        self.flush_step = flush_step or float(os.getenv("PROGRESS_FLUSH_STEP", 1))
+        self.ttl = ttl or int(os.getenv("PROGRESS_TTL", 86400))
+
+        self.lock = Lock()
+        self.flush_lock = Lock()
+        self.status: str | None = None
+        self.progress = 0.0
+        self.flushed: tuple[str, float] | None = None
+        self.flushed_at = 0.0
+
+    def update(self, status: str, progress: float, force: bool = False):
+        """ record the latest status & progress, and write it to redis if due """
+        with self.lock:
+            if status == self.status and progress < self.progress:
+                return
+
+            self.status, self.progress = status, progress
+            due = force or self.flushed is None \
+                or self.flushed[0] != status \
+                or progress - self.flushed[1] >= self.flush_step \
+                or time.monotonic() - self.flushed_at >= self.flush_interval
+            if not due:
+                return
+
+        self.flush(block=force)
+
+    def flush(self, block: bool = True):
+        """
+        write the latest status & progress to redis, if not already written
+        this will not raise exception even in case of error
+        """
+        if not self.flush_lock.acquire(blocking=block):
+            return
+
+        try:
+            with self.lock:
+                latest = (self.status, self.progress)
+                if latest == self.flushed:
+                    return
+
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.set(name=self.upload_id, value=f"{latest[0]}:{latest[1]}", ex=self.ttl)
+            pipe.execute()
+
+            with self.lock:
+                self.flushed = latest
+                self.flushed_at = time.monotonic()
+        except Exception as e:
+            # do not raise error for this case
+            self.logr.critical(f"Error while updating progress in redis: {e}")
+        finally:
+            self.flush_lock.release()
@@ -0,0 +1,228 @@
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+from threading import Lock, Event
+from logging import Logger
+import asyncio
+import time
+import os
+
+from .metrics import IMAGE_SCHEDULER_WAIT, IMAGE_SCHEDULER_UPLOADS
+
+# weight of an upload which does not set its priority, & the bounds of a set one
+DEFAULT_WEIGHT = 1.0
+MIN_WEIGHT = 0.1
+MAX_WEIGHT = 100.0
+
+
+def is_image_scheduler_enabled() -> bool:
+    """ if enabled, image downloads of the concurrent uploads of a worker share its download slots fairly (weighted) """
+    return os.getenv("IMAGE_FAIR_SCHEDULER") == "enable"
+
+
+def get_upload_weight(priority) -> float:
+    """ weight of the upload in the scheduler, from its priority (priority of upload doc), default 1 """
+    try:
+        weight = float(priority) if priority is not None else DEFAULT_WEIGHT
+    except (TypeError, ValueError):
+        return DEFAULT_WEIGHT
+
+    return min(max(weight, MIN_WEIGHT), MAX_WEIGHT)
+
+
+class UploadFlow:
+    """ the images of one upload waiting for a slot, & its share (weight) of the slots """
+
+    def __init__(self, scheduler: "FairImageScheduler", key: str, weight: float):
+        self.scheduler = scheduler
+        self.key = key
+        self.weight = weight
+        # threads (Event) & coroutines ((loop, future)) waiting for a slot, in order
+        self.waiters: deque = deque()
+        self.deficit = 0.0
+        # if the flow got its quantum in the current round
+        self.credited = False
+        # no. of jobs (upload, or image batches of it) of this upload using the flow
+        self.users = 0
+
+    @contextmanager
+    def turn(self):
+        """ holds a slot for the with block, blocks till the scheduler gives this upload one """
+        waiter = Event()
+        waited_since = time.perf_counter()
+        if not self.scheduler.enqueue(self, waiter):
+            waiter.wait()
+        IMAGE_SCHEDULER_WAIT.observe(time.perf_counter() - waited_since)
+
+        try:
+            yield
+        finally:
+            self.scheduler.release()
+
+    @asynccontextmanager
+    async def turn_async(self):
+        """ same as turn, but waits for the slot without blocking the event loop """
+        loop = asyncio.get_running_loop()
+        waiter = (loop, loop.create_future())
+        waited_since = time.perf_counter()
+        if not self.scheduler.enqueue(self, waiter):
+            try:
+                # slot is handed over (already counted) by the scheduler
+                await waiter[1]
+            except asyncio.CancelledError:
+                self.scheduler.cancel(self, waiter)
+                raise
+        IMAGE_SCHEDULER_WAIT.observe(time.perf_counter() - waited_since)
+
+        try:
+            yield
+        finally:
+            self.scheduler.release()
+
+
+class FairImageScheduler:
+    """
+    This class shares a fixed no. of image download slots among the uploads processed concurrently by the worker,
+    via deficit round robin (DRR) over the uploads waiting for a slot:
+        - uploads with waiting images take turns, in each round an upload gets its weight (quantum) added to its deficit
+          & is given a slot per image (cost 1) while its deficit lasts, fractional weights carry over to the next rounds
+        - an upload with no image waiting leaves the round & loses its deficit, so it can not save up slots
+    A 10 image upload next to a 100k image one gets its share of the slots right away, so it finishes in seconds,
+    while a lone upload gets all the slots (no slot stays idle while an image is waiting), so big uploads lose no throughput.
+
+    Slots can be taken from threads (UploadFlow.turn) and from event loops (UploadFlow.turn_async), both share the same slots.
+    """
+
+    def __init__(self, logr: Logger, slots: int):
+        self.logr = logr
+        self.slots = max(slots, 1)
+
+        self.lock = Lock()
+        self.in_use = 0
+        self.flows: dict[str, UploadFlow] = {}
+        # flows with waiting images, head is being served
+        self.active: deque[UploadFlow] = deque()
+
+    @contextmanager
+    def flow(self, key: str, weight: float = DEFAULT_WEIGHT):
+        """
+        registers the upload (key) for the with block & yields its flow, jobs of the same upload share one flow
+        weight of the last job joining the flow is used
+        """
+        with self.lock:
+            flow = self.flows.get(key)
+            if flow is None:
+                flow = self.flows[key] = UploadFlow(self, key, weight)
+            flow.weight = weight
+            flow.users += 1
+            IMAGE_SCHEDULER_UPLOADS.set(len(self.flows))
+
+        try:
+            yield flow
+        finally:
+            with self.lock:
+                flow.users -= 1
+                if not flow.users:
+                    del self.flows[key]
+                IMAGE_SCHEDULER_UPLOADS.set(len(self.flows))
+
+    def enqueue(self, flow: UploadFlow, waiter) -> bool:
+        """ queues the waiter of the flow, returns True if it got the slot right away (nothing else is waiting) """
+        with self.lock:
+            if self.in_use < self.slots and not self.active:
+                self.in_use += 1
+                return True
+
+            if not flow.waiters:
+                # joins the round at the end, with no deficit
+                flow.deficit = 0.0
+                flow.credited = False
+                self.active.append(flow)
+            flow.waiters.append(waiter)
+
+            self._dispatch()
+            return False
+
+    def release(self):
+        """ frees the slot & gives it to the next waiting image, as per DRR """
+        with self.lock:
+            self.in_use -= 1
+            self._dispatch()
+
+    def cancel(self, flow: UploadFlow, waiter):
+        """ waiting coroutine is cancelled, the slot is given back if it was already handed over """
+        with self.lock:
+            if waiter in flow.waiters:
+                flow.waiters.remove(waiter)
+                return
+
+        future = waiter[1]
+        if future.done() and not future.cancelled():
+            self.release()
+
+    def _dispatch(self):
+        while self.in_use < self.slots:
+            waiter = self._next_waiter()
+            if waiter is None:
+                return
+
+            self.in_use += 1
+            if isinstance(waiter, Event):
+                waiter.set()
+                continue
+
+            loop, future = waiter
+            try:
+                loop.call_soon_threadsafe(self._hand_over, future)
+            except RuntimeError:
+                # loop is closed, slot goes to the next waiter
+                self.in_use -= 1
+
+    def _next_waiter(self):
+        """ waiter to be given the next slot: from the flow at head of the round, while its deficit lasts """
+        while self.active:
+            flow = self.active[0]
+            if not flow.waiters:
+                self.active.popleft()
+                flow.deficit = 0.0
+                continue
+
+            if not flow.credited:
+                flow.deficit += flow.weight
+                flow.credited = True
+
+            if flow.deficit >= 1:
+                flow.deficit -= 1
+                return flow.waiters.popleft()
+
+            # used up its turn, next upload's turn
+            flow.credited = False
+            self.active.rotate(-1)
+
+        return None
+
+    def _hand_over(self, future: asyncio.Future):
+        if future.cancelled():
+            self.release()
+            return
+
+        future.set_result(None)
+
+
+def initialize_image_scheduler(logr: Logger, slots: int) -> FairImageScheduler:
+    """ This will initialize the fair image scheduler and return it """
+    scheduler = FairImageScheduler(logr, slots)
+
+    logr.info(f"Fair image scheduler enabled, {slots} download slots shared by the concurrent uploads")
+
+    return scheduler
+
+
+def get_image_scheduler(logr: Logger, default_slots: int) -> FairImageScheduler | None:
+    """
+    returns the fair image scheduler configured via envs, None if it is not enabled
+    slots default to the download workers of one upload, so a lone upload runs as fast as without the scheduler
+    """
+    if not is_image_scheduler_enabled():
+        return None
+
+    return initialize_image_scheduler(logr, slots=int(os.getenv("IMAGE_SCHEDULER_SLOTS", default_slots)))
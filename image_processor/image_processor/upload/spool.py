@@ -0,0 +1,124 @@
+from pathlib import Path
+from io import BytesIO
+import tempfile
+import hashlib
+import time
+import os
+
+# downloaded image is read from the http response in parts of this size
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+def get_image_max_bytes() -> int:
+    """ images larger than this are rejected """
+    return int(os.getenv("IMAGE_MAX_BYTES", 50 * 1024 * 1024))
+
+
+def get_image_download_timeout() -> float:
+    """ images taking longer than this (seconds) to download are given up, 0 means no limit """
+    return float(os.getenv("IMAGE_DOWNLOAD_TIMEOUT", 60))
+
+
+def get_image_spool_threshold() -> int:
+    """ images larger than this are spooled to a temp file, instead of being kept in memory """
+    return int(os.getenv("IMAGE_SPOOL_THRESHOLD", 5 * 1024 * 1024))
+
+
+class ImageTooLarge(Exception):
+    def __init__(self, size: int, max_bytes: int):
+        # no comma in message, as the output column is comma separated
+        super().__init__(f"Image too large: {size} bytes (max allowed {max_bytes} bytes)")
+
+
+class ImageDownloadTimeout(Exception):
+    def __init__(self, timeout: float):
+        super().__init__(f"Image download timed out after {timeout:g} seconds")
+
+
+def check_content_length(content_length: str | int | None, max_bytes: int):
+    """ reject the image early (before reading the body), if the advertised size is already above the limit """
+    if content_length is not None and int(content_length) > max_bytes:
+        raise ImageTooLarge(int(content_length), max_bytes)
+
+
+def release_image_data(image_data: bytes | str | None):
+    """ deletes the spool file of the image, if it was spooled to disk """
+    if isinstance(image_data, str):
+        try:
+            Path(image_data).unlink()
+        except FileNotFoundError:
+            pass
+
+
+class ImageSpool:
+    """
+    This class collects the body of a downloaded image, part by part.
+    Body is kept in memory upto spool_threshold bytes, after that it is moved to a temp file.
+    Body larger than max_bytes is rejected with ImageTooLarge.
+    If hash_content is set, the sha256 of the body is computed along the way.
+    Body still being received timeout seconds after the spool was created is rejected with ImageDownloadTimeout
+    (read timeout of http client only bounds each read, so a slow trickle could go on forever).
+
+    finish() returns the image data: bytes if in memory, or the path of temp file if spooled
+    (a path is cheap to pass to the transcode process pool, and Pillow can open it directly).
+    """
+
+    def __init__(self, max_bytes: int | None = None, spool_threshold: int | None = None, hash_content: bool = False,
+                 timeout: float | None = None):
+        self.max_bytes = max_bytes or get_image_max_bytes()
+        self.timeout = timeout if timeout is not None else get_image_download_timeout()
+        self.started_at = time.monotonic()
+        self.spool_threshold = spool_threshold or get_image_spool_threshold()
+        self.hasher = hashlib.sha256() if hash_content else None
+        self.digest: str | None = None
+        self.size = 0
+        self.buffer = BytesIO()
+        self.spool_file = None
+
+    def write(self, chunk: bytes):
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            self.discard()
+            raise ImageTooLarge(self.size, self.max_bytes)
+
+        if self.timeout and time.monotonic() - self.started_at > self.timeout:
+            self.discard()
+            raise ImageDownloadTimeout(self.timeout)
+
+        if self.hasher is not None:
+            self.hasher.update(chunk)
+
+        if self.spool_file is None and self.size > self.spool_threshold:
+            self.spool_file = tempfile.NamedTemporaryFile(prefix="pixelriver-img-", dir=os.getenv("IMAGE_SPOOL_DIR"), delete=False)
+            self.spool_file.write(self.buffer.getbuffer())
+            self.buffer = BytesIO()
+
+        if self.spool_file is not None:
+            self.spool_file.write(chunk)
+        else:
+            self.buffer.write(chunk)
+
+    def writes_to_file(self, size: int) -> bool:
+        """ if writing size more bytes goes to the temp file (blocking io), so async callers can run it in a thread """
+        return self.spool_file is not None or self.size + size > self.spool_threshold
+
+    def finish(self) -> bytes | str:
+        if self.size == 0:
+            raise Exception("Failed to download image")
+
+        if self.hasher is not None:
+            self.digest = self.hasher.hexdigest()
+
+        if self.spool_file is not None:
+            self.spool_file.close()
+            return self.spool_file.name
+
+        return self.buffer.getvalue()
+
+    def discard(self):
+        """ drops whatever is collected so far """
+        self.buffer = BytesIO()
+        if self.spool_file is not None:
+            self.spool_file.close()
+            release_image_data(self.spool_file.name)
+            self.spool_file = None
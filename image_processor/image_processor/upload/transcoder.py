@@ -0,0 +1,290 @@
+from concurrent.futures import ProcessPoolExecutor, Future
+from multiprocessing import get_context, get_all_start_methods
+from logging import Logger
+from PIL import Image
+from dataclasses import dataclass
+from io import BytesIO
+import threading
+import os
+
+from .profiles import EncodingProfile, DEFAULT_PROFILE, SOURCE_FORMAT
+
+# formats where quality applies, re-encoding any other format in its own format (e.g. png) can not make it smaller
+LOSSY_FORMATS = ("JPEG", "MPO", "WEBP")
+
+# file extension & content type of the output formats
+FORMAT_EXTENSIONS = {"JPEG": "jpg", "WEBP": "webp", "PNG": "png", "GIF": "gif", "BMP": "bmp", "TIFF": "tiff"}
+
+
+@dataclass
+class TranscodedImage:
+    data: bytes
+    format: str
+    # source image is kept as it is, as re-encoding did not make it smaller
+    passthrough: bool = False
+
+    @property
+    def extension(self) -> str:
+        return FORMAT_EXTENSIONS.get(self.format, self.format.lower())
+
+    @property
+    def content_type(self) -> str:
+        return Image.MIME.get(self.format, "image/img")
+
+
+# output buffer of each thread (a process pool worker has one), reused for every encode instead of a new one per image
+_buffers = threading.local()
+
+
+def _output_buffer() -> BytesIO:
+    """ output buffer of the thread, rewound. it is not truncated (that frees its memory), so it holds stale bytes after the output """
+    buffer = getattr(_buffers, "output", None)
+    if buffer is None:
+        buffer = _buffers.output = BytesIO()
+    buffer.seek(0)
+    return buffer
+
+
+def _encode(img: Image.Image, img_format: str, profile: EncodingProfile, quality: int, metadata: dict, fast: bool = False) -> int:
+    """
+    encodes the image into the output buffer of the thread & returns the size of output (see _encoded_bytes)
+    fast encoding skips the optimizations, its output is not smaller than the normal one at the same quality
+    """
+    output_buffer = _output_buffer()
+    options = {"quality": quality, **metadata}
+    if img_format == "JPEG":
+        options.update(progressive=profile.progressive, optimize=profile.optimize and not fast)
+    elif img_format == "WEBP":
+        options.update(method=0 if fast else 6 if profile.optimize else 4)
+
+    img.save(output_buffer, format=img_format, **options)
+    return output_buffer.tell()
+
+
+def _encoded_bytes(size: int) -> bytes:
+    """ copies the last output (of given size) out of the output buffer of the thread """
+    with _buffers.output.getbuffer() as view:
+        return bytes(view[:size])
+
+
+def _encode_within(img: Image.Image, img_format: str, profile: EncodingProfile, metadata: dict) -> int:
+    """
+    binary search of the highest quality (min_quality..quality) whose output fits in target_bytes
+    search runs with fast encoding (much faster for webp), then the found quality is encoded normally
+    only the sizes are compared, so outputs of the search are never copied out of the buffer
+    """
+    low, high = profile.min_quality, profile.quality
+    best_quality = profile.min_quality
+    while low <= high:
+        quality = (low + high) // 2
+        if _encode(img, img_format, profile, quality, metadata, fast=True) <= profile.target_bytes:
+            best_quality, low = quality, quality + 1
+        else:
+            high = quality - 1
+
+    # if nothing fits, smallest one is the closest
+    return _encode(img, img_format, profile, best_quality, metadata)
+
+
+def _target_size(width: int, height: int, max_size: int | None) -> tuple[int, int] | None:
+    """ size of the output, if the longest side is above max_size. None if it is not to be downscaled """
+    if not max_size or max(width, height) <= max_size:
+        return None
+
+    scale = max_size / max(width, height)
+    return max(round(width * scale), 1), max(round(height * scale), 1)
+
+
+def _target_mode(img: Image.Image, img_format: str) -> str:
+    """ webp keeps the transparency, jpeg keeps the grayscale, everything else is encoded as RGB """
+    if img_format == "WEBP":
+        has_alpha = img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info)
+        return "RGBA" if has_alpha else "RGB"
+
+    return "L" if img.mode == "L" else "RGB"
+
+
+def _decode(img: Image.Image, size: tuple[int, int] | None):
+    """
+    decodes the opened image, jpeg is decoded straight at the nearest larger scale (1/2, 1/4, 1/8) of the size, via draft
+    size None decodes at full size
+    """
+    if img.format in ("JPEG", "MPO"):
+        img.draft(None, size)
+
+    img.load()
+
+
+def _render(img: Image.Image, mode: str, size: tuple[int, int] | None, reducing_gap: float = 3.0) -> Image.Image:
+    """
+    rendition of the decoded image in given mode & size, doing as little work as possible:
+        - image is reduced by an integer factor first, then resampled (reducing_gap)
+        - no conversion if it already is in the given mode
+    """
+    if size is not None and img.size != size:
+        img = img.resize(size, Image.Resampling.LANCZOS, reducing_gap=reducing_gap)
+
+    if img.mode != mode:
+        img = img.convert(mode)
+
+    return img
+
+
+def _source_bytes(image_data: bytes | str) -> bytes:
+    if isinstance(image_data, str):
+        with open(image_data, "rb") as source:
+            return source.read()
+
+    return image_data
+
+
+def transcode_image(image_data: bytes | str, profile: EncodingProfile = DEFAULT_PROFILE) -> TranscodedImage:
+    """
+    this will open the given image bytes (or image file path) and re-encode it as per the profile
+    if output is not smaller than the source, the source bytes are returned as they are (passthrough)
+
+    this is a module level function, so that it can be pickled and run inside the transcode process pool
+    """
+    return transcode_derivatives(image_data, [profile])[0]
+
+
+def transcode_derivatives(image_data: bytes | str, profiles: list[EncodingProfile]) -> list[TranscodedImage]:
+    """
+    this will re-encode the given image bytes (or image file path) as per each of the profiles, in the same order
+    image is decoded only once (at the scale of the largest rendition), each rendition is resized & encoded from it
+    a rendition which is not downscaled & is not smaller than the source is the source bytes as they are (passthrough)
+    """
+    # BytesIO over bytes shares their memory (no copy) as long as it is not written to
+    source = BytesIO(image_data) if not isinstance(image_data, str) else open(image_data, "rb")
+    with source:
+        try:
+            img = Image.open(source)
+        except Image.DecompressionBombError:
+            img = None
+
+        # only the header is read till now, so oversized images are rejected before decoding
+        max_pixels = Image.MAX_IMAGE_PIXELS
+        if img is None or img.width * img.height > max_pixels:
+            size = f"{img.width}x{img.height}" if img is not None else f"more than {max_pixels * 2}"
+            raise Exception(f"Image too large: {size} pixels (max allowed {max_pixels} pixels)")
+
+        source_format = img.format
+        source_size = source.seek(0, os.SEEK_END)
+
+        # (format, size) of each rendition, None where quality does not apply & it is not downscaled (kept without decoding)
+        plans = []
+        for profile in profiles:
+            img_format = source_format if profile.format == SOURCE_FORMAT else profile.format
+            target_size = _target_size(img.width, img.height, profile.max_size)
+            plans.append((img_format, target_size) if img_format in LOSSY_FORMATS or target_size is not None else None)
+
+        decoded_sizes = [plan[1] for plan in plans if plan is not None]
+        if not decoded_sizes:
+            source_bytes = _source_bytes(image_data)
+            return [TranscodedImage(source_bytes, source_format, passthrough=True) for _ in profiles]
+
+        # scale of the largest rendition, full size if any of them is not downscaled
+        draft_size = None if None in decoded_sizes else max(decoded_sizes)
+        info = dict(img.info)
+        _decode(img, draft_size)
+        # jpeg decoded at full size (for a full rendition) is reduced as coarsely as draft would have, for the smaller ones
+        reducing_gap = 1.0 if source_format in ("JPEG", "MPO") else 3.0
+
+        # largest rendition first, each one is resized from the previous (smallest larger) one instead of the full image
+        order = sorted((index for index, plan in enumerate(plans) if plan is not None),
+                       key=lambda index: plans[index][1] or img.size, reverse=True)
+
+        outputs: list[TranscodedImage | None] = [None] * len(profiles)
+        resized = img
+        for index in order:
+            profile, (img_format, target_size) = profiles[index], plans[index]
+            metadata = {}
+            if not profile.strip_metadata:
+                metadata = {key: info[key] for key in ("exif", "icc_profile") if info.get(key)}
+
+            resized = _render(resized, resized.mode, target_size, reducing_gap)
+            rendition = _render(resized, _target_mode(img, img_format), None)
+
+            if profile.target_bytes:
+                output_size = _encode_within(rendition, img_format, profile, metadata)
+            else:
+                output_size = _encode(rendition, img_format, profile, profile.quality, metadata)
+
+            # a downscaled rendition is kept even if larger, source does not have its size
+            if output_size < source_size or target_size is not None:
+                outputs[index] = TranscodedImage(_encoded_bytes(output_size), img_format)
+
+    source_bytes = _source_bytes(image_data) if None in outputs else None
+    return [output or TranscodedImage(source_bytes, source_format, passthrough=True) for output in outputs]
+
+
+def get_image_max_pixels() -> int:
+    """ images with more pixels than this are rejected before decoding (decompression bomb guard) """
+    return int(os.getenv("IMAGE_MAX_PIXELS", 50_000_000))
+
+
+def _set_image_max_pixels(max_pixels: int):
+    """ sets the pixel limit of Pillow (its decompression bomb check) in this process, transcode_derivatives checks against it """
+    Image.MAX_IMAGE_PIXELS = max_pixels
+
+
+def get_io_worker_count() -> int:
+    """ no. of threads used for the network bound work (image download & upload) """
+    return int(os.getenv("IMAGE_IO_WORKER_COUNT", os.cpu_count()*2))
+
+
+def get_transcode_worker_count() -> int:
+    """ no. of processes used for the cpu bound work (image decode & encode). 0 means transcode in the io threads """
+    return int(os.getenv("IMAGE_TRANSCODE_WORKER_COUNT", os.cpu_count()))
+
+
+def initialize_transcode_pool(logr: Logger) -> ProcessPoolExecutor | None:
+    """
+    This will initialize the process pool used for transcoding the images
+    this pool is persistent and shared by all the uploads processed by the consumer
+    returns None if transcoding in process pool is disabled
+
+    workers are forked from a fork server (spawned if not available), not from this process:
+    its threads (log listener, metrics server, startup & io threads) could hold a lock (e.g. of a logging handler)
+    at the time of fork, which would stay locked forever in the worker
+
+    IMAGE_MAX_PIXELS is read here & applied to this process (transcoding in io threads) as well as to each worker
+    """
+    max_pixels = get_image_max_pixels()
+    _set_image_max_pixels(max_pixels)
+
+    worker_count = get_transcode_worker_count()
+    if worker_count <= 0:
+        logr.info("Transcode process pool disabled, images will be transcoded in io threads")
+        return None
+
+    if "forkserver" in get_all_start_methods():
+        context = get_context("forkserver")
+        # fork server imports Pillow & the transcoder once, workers forked from it have them already
+        context.set_forkserver_preload([__name__])
+    else:
+        context = get_context("spawn")
+
+    # limit is passed to the workers, fork server may have been started with an older environment
+    pool = ProcessPoolExecutor(max_workers=worker_count, mp_context=context, initializer=_set_image_max_pixels,
+                               initargs=(max_pixels,))
+    logr.info(f"Transcode process pool initialized with {worker_count} workers")
+
+    return pool
+
+
+def _warm_up_worker(_: int) -> int:
+    """ runs in a transcode worker: loads the codecs (first encode of each format is slower) & returns the worker pid """
+    img = Image.new("RGB", (16, 16))
+    for img_format in ("JPEG", "WEBP", "PNG"):
+        img.save(BytesIO(), format=img_format)
+
+    return os.getpid()
+
+
+def prewarm_transcode_pool(pool: ProcessPoolExecutor) -> list[Future]:
+    """
+    starts the workers of the pool (they are started on first use otherwise) & loads the codecs in them
+    returns the futures to wait on
+    """
+    return [pool.submit(_warm_up_worker, task_no) for task_no in range(get_transcode_worker_count() * 2)]
@@ -0,0 +1,226 @@
+from logging import Logger
+from pymongo.database import Database
+from core.http_client import HttpClient
+from core.mongo import MongoWriteBuffer
+from dataclasses import dataclass, field
+from functools import partial
+from threading import Thread, Condition, Lock
+from queue import Queue
+from collections import deque
+from urllib.parse import urlparse
+from typing import Callable
+import itertools
+import random
+import heapq
+import time
+import os
+
+from .notifier import WebhookNotification
+from .metrics import WEBHOOKS_PENDING, WEBHOOK_RETRIES, WEBHOOK_DELIVERY_DURATION
+
+# marker put in the ready queue to tell the workers to stop
+_STOP = object()
+
+
+def get_webhook_worker_count() -> int:
+    """ no. of threads delivering the webhooks """
+    return int(os.getenv("WEBHOOK_WORKER_COUNT", 16))
+
+
+@dataclass
+class WebhookJob:
+    """ a webhook msg (<upload_id>|||<webhook_url>) along with its delivery state """
+    msg: str
+    # called once the webhook is done (delivered, or failed for good) & its response is saved
+    on_done: Callable[[], None] | None = None
+    # called instead of on_done if its response could not be saved, so the msg can be delivered again
+    on_failed: Callable[[], None] | None = None
+    attempt: int = 0
+    host: str = field(init=False)
+    submitted_at: float = field(init=False, default_factory=time.monotonic)
+
+    def __post_init__(self):
+        url = self.msg.split("|||")[-1]
+        self.host = urlparse(url).netloc
+
+
+class WebhookDispatcher:
+    """
+    This class delivers the webhooks concurrently via a bounded pool of worker threads.
+
+    - every request has a timeout
+    - failed deliveries (connection errors, timeouts, 5xx, 429) are retried with exponential backoff & jitter,
+      upto max_attempts. retries are scheduled, so a waiting retry does not hold a worker
+    - each webhook host can use at most per_host_limit workers at once, so one slow customer endpoint
+      can not take up the whole pool. jobs of a busy host wait in its own queue (not in the ready queue)
+      & the worker finishing a job of the host delivers the next waiting one
+    - if mongo_writer is provided, webhook responses are written in batches & a job is done once its response is written
+    """
+
+    def __init__(self, logr: Logger, mongo_db_client: Database, http_client: HttpClient,
+                 worker_count: int | None = None, max_attempts: int | None = None,
+                 retry_base_delay: float | None = None, retry_max_delay: float | None = None,
+                 per_host_limit: int | None = None, timeout: float | None = None, queue_size: int | None = None,
+                 mongo_writer: MongoWriteBuffer | None = None):
+        self.logr = logr
+        self.mongo_db_client = mongo_db_client
+        self.mongo_writer = mongo_writer
+        self.http_client = http_client
+        self.worker_count = worker_count or get_webhook_worker_count()
+        self.max_attempts = max_attempts or int(os.getenv("WEBHOOK_MAX_ATTEMPTS", 5))
+        self.retry_base_delay = retry_base_delay or float(os.getenv("WEBHOOK_RETRY_BASE_DELAY", 1))
+        self.retry_max_delay = retry_max_delay or float(os.getenv("WEBHOOK_RETRY_MAX_DELAY", 60))
+        self.per_host_limit = per_host_limit or int(os.getenv("WEBHOOK_PER_HOST_CONCURRENCY", 4))
+        self.timeout = timeout or float(os.getenv("WEBHOOK_TIMEOUT", 10))
+
+        # jobs ready to be delivered, submit() blocks when it is full
+        self.ready: Queue = Queue(maxsize=queue_size or int(os.getenv("WEBHOOK_QUEUE_SIZE", 1000)))
+
+        # jobs waiting for their retry time, (due_at, seq, job)
+        self.delayed: list[tuple[float, int, WebhookJob]] = []
+        self.delayed_cond = Condition()
+        self.seq = itertools.count()
+
+        # jobs submitted but not yet done (including the delayed ones)
+        self.pending = 0
+        self.pending_cond = Condition()
+
+        self.host_lock = Lock()
+        self.host_in_flight: dict[str, int] = {}
+        # jobs of the hosts at their limit, in submit order
+        self.host_waiting: dict[str, deque[WebhookJob]] = {}
+
+        self.stopped = False
+        self.workers = [Thread(target=self._worker, daemon=True) for _ in range(self.worker_count)]
+        self.scheduler = Thread(target=self._scheduler, daemon=True)
+
+    def start(self) -> "WebhookDispatcher":
+        for worker in self.workers:
+            worker.start()
+        self.scheduler.start()
+        self.logr.info(f"Webhook dispatcher started with {self.worker_count} workers")
+        return self
+
+    def submit(self, msg: str, on_done: Callable[[], None] | None = None, on_failed: Callable[[], None] | None = None):
+        """
+        queue the webhook msg for delivery, blocks if too many webhooks are already queued
+        on_done is called once the webhook is done (e.g. to ack the msg), on_failed if its response could not be saved
+        """
+        with self.pending_cond:
+            self.pending += 1
+        WEBHOOKS_PENDING.inc()
+        self.ready.put(WebhookJob(msg, on_done, on_failed))
+
+    def shutdown(self):
+        """ this will wait for all the submitted webhooks (including the scheduled retries) and stop the workers """
+        with self.pending_cond:
+            self.pending_cond.wait_for(lambda: self.pending == 0)
+
+        self.stopped = True
+        with self.delayed_cond:
+            self.delayed_cond.notify()
+        for _ in self.workers:
+            self.ready.put(_STOP)
+        for worker in self.workers:
+            worker.join()
+        self.scheduler.join()
+
+    def _worker(self):
+        while True:
+            job = self.ready.get()
+            if job is _STOP:
+                return
+
+            # job of a busy host waits for a slot of the host, it is delivered by the worker releasing one
+            if not self._acquire_host(job):
+                continue
+
+            while job is not None:
+                try:
+                    self._deliver(job)
+                except Exception as e:
+                    # do not kill the worker for this
+                    self.logr.exception(e)
+                    self._done(job)
+                finally:
+                    job = self._release_host(job.host)
+
+    def _deliver(self, job: WebhookJob):
+        job.attempt += 1
+        is_last_attempt = job.attempt >= self.max_attempts
+
+        notification = WebhookNotification(self.logr, self.mongo_db_client, self.http_client,
+                                           timeout=self.timeout, mongo_writer=self.mongo_writer)
+        if notification.send_notification(job.msg, is_last_attempt=is_last_attempt, on_saved=partial(self._done, job)):
+            return
+
+        WEBHOOK_RETRIES.inc()
+        delay = self._retry_delay(job.attempt)
+        self.logr.info(f"Webhook delivery failed (attempt {job.attempt}), retrying in {delay:.2f}s: {job.msg}")
+        self._schedule(job, delay)
+
+    def _retry_delay(self, attempt: int) -> float:
+        """ exponential backoff with jitter, so retries of many webhooks do not fire in sync """
+        delay = min(self.retry_max_delay, self.retry_base_delay * (2 ** (attempt - 1)))
+        return random.uniform(delay / 2, delay)
+
+    def _done(self, job: WebhookJob, saved: bool = True):
+        if not saved:
+            # msg is not acked but released, so it will be re-claimed & delivered again (stream transport)
+            self.logr.error(f"Webhook response could not be saved: {job.msg}")
+        callback = job.on_done if saved else job.on_failed
+        if callback is not None:
+            try:
+                callback()
+            except Exception as e:
+                # do not raise error
+                self.logr.exception(e)
+
+        WEBHOOKS_PENDING.dec()
+        WEBHOOK_DELIVERY_DURATION.observe(time.monotonic() - job.submitted_at)
+
+        with self.pending_cond:
+            self.pending -= 1
+            self.pending_cond.notify_all()
+
+    def _schedule(self, job: WebhookJob, delay: float):
+        with self.delayed_cond:
+            heapq.heappush(self.delayed, (time.monotonic() + delay, next(self.seq), job))
+            self.delayed_cond.notify()
+
+    def _scheduler(self):
+        """ moves the delayed jobs to ready queue once they are due """
+        while True:
+            with self.delayed_cond:
+                while not self.stopped and (not self.delayed or self.delayed[0][0] > time.monotonic()):
+                    timeout = self.delayed[0][0] - time.monotonic() if self.delayed else None
+                    self.delayed_cond.wait(timeout)
+                if self.stopped:
+                    return
+                _, _, job = heapq.heappop(self.delayed)
+
+            self.ready.put(job)
+
+    def _acquire_host(self, job: WebhookJob) -> bool:
+        """ takes a slot of the job's host, if it is at its limit the job is put in the host's waiting queue instead """
+        with self.host_lock:
+            if self.host_in_flight.get(job.host, 0) >= self.per_host_limit:
+                self.host_waiting.setdefault(job.host, deque()).append(job)
+                return False
+            self.host_in_flight[job.host] = self.host_in_flight.get(job.host, 0) + 1
+            return True
+
+    def _release_host(self, host: str) -> WebhookJob | None:
+        """ releases the slot of the host, or hands it over to the next waiting job of the host (which is returned) """
+        with self.host_lock:
+            waiting = self.host_waiting.get(host)
+            if waiting:
+                job = waiting.popleft()
+                if not waiting:
+                    del self.host_waiting[host]
+                return job
+
+            self.host_in_flight[host] -= 1
+            if self.host_in_flight[host] == 0:
+                del self.host_in_flight[host]
+            return None
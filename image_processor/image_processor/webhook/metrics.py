@@ -0,0 +1,18 @@
+from core.metrics import METRICS
+
+WEBHOOKS = METRICS.counter("pixelriver_webhooks_total", "Webhooks done, by result (delivered, failed, invalid)", ("result",))
+WEBHOOKS_PENDING = METRICS.gauge("pixelriver_webhooks_pending", "Webhooks submitted to dispatcher & not yet done (including the ones waiting for retry)")
+WEBHOOK_RETRIES = METRICS.counter("pixelriver_webhook_retries_total", "Webhook deliveries scheduled for retry")
+WEBHOOK_DELIVERY_DURATION = METRICS.histogram(
+    "pixelriver_webhook_delivery_duration_seconds",
+    "Time from submit to done of a webhook, including the queueing & retries",
+)
+
+WEBHOOK_REQUESTS = METRICS.counter("pixelriver_webhook_requests_total", "Webhook requests, by response status code (or error)", ("status",))
+WEBHOOK_REQUEST_DURATION = METRICS.histogram("pixelriver_webhook_request_duration_seconds", "Duration of each webhook request")
+
+STAGE_DURATION = METRICS.histogram(
+    "pixelriver_webhook_stage_duration_seconds",
+    "Duration of the redis/mongo calls of webhook subscriber",
+    ("stage",),
+)
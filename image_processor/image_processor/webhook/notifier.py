@@ -1,47 +1,100 @@
 from logging import Logger
 from pymongo.database import Database
 from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo.errors import PyMongoError
 from redis import Redis
 from datetime import datetime
+from core.http_client import HttpClient, RETRY_STATUS_CODES
+from core.mongo import MongoWriteBuffer
+from typing import Callable
 import requests
+import time
+
+from .metrics import WEBHOOKS, WEBHOOK_REQUESTS, WEBHOOK_REQUEST_DURATION, STAGE_DURATION
+
+# failures with these status codes (along with connection errors & timeouts) are worth retrying
+WEBHOOK_RETRY_STATUS_CODES = RETRY_STATUS_CODES + [429]
+# request errors worth retrying, others (e.g. InvalidURL, MissingSchema, InvalidSchema) fail the same way every time
+WEBHOOK_RETRY_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.RetryError,
+                        requests.exceptions.ChunkedEncodingError)
 
 
 class WebhookNotification:
     """ This class will send the notification to the webhook url """
 
-    def __init__(self, logr: Logger, mongo_db_client: Database):
+    def __init__(self, logr: Logger, mongo_db_client: Database, http_client: HttpClient, timeout: float | None = None,
+                 mongo_writer: MongoWriteBuffer | None = None):
         # set the services in object instance
         self.logr = logr
+        self.http_client = http_client
+        self.timeout = timeout
         self.mongo_db_client = mongo_db_client
         self.upload_collection = mongo_db_client.get_collection("uploads")
 
-    def send_notification(self, msg: str):
+        # if provided, webhook response is written via this (batched) instead of one write per webhook
+        self.mongo_writer = mongo_writer
+
+    def send_notification(self, msg: str, is_last_attempt: bool = True,
+                          on_saved: Callable[[bool], None] | None = None) -> bool:
         """
         This function will send the notification to the webhook url
         expects the msg to be <upload_id>|||<webhook_url> format
         where ||| is the seperator
+
+        returns False if the request failed with retryable error & caller can still retry it (is_last_attempt is False)
+        otherwise returns True (notification is done, with or without success)
+
+        when it returns True, on_saved is called once the outcome is written in database, with False if the write failed
+        (with write buffer this happens later, from the buffer's flush)
         """
 
         self.msg = msg
+        self.on_saved = on_saved
+        self.save_reported = False
         try:
-            self._notify()
+            return self._notify(is_last_attempt)
         except Exception as e:
-            # do not raise error
+            # do not raise error, invalid msg is done (acked & dropped, nothing to save), a failed save is already reported as such
             self.logr.exception(e)
+            WEBHOOKS.inc(result="invalid")
+            if not self.save_reported:
+                self._saved(True)
+            return True
 
-    def _notify(self):
+    def _notify(self, is_last_attempt: bool) -> bool:
         """
         this will:
             - parse the incoming msg
             - make the webhook request
-            - save the webhook response in database
+            - save the webhook response in database (unless it is going to be retried)
         """
         upload_id, url = self._parse_msg()
-        webhook_reponse = self._make_webhook_request(url)
+
+        try:
+            with WEBHOOK_REQUEST_DURATION.time():
+                response = self.http_client.get(url, timeout=self.timeout) if self.timeout else self.http_client.get(url)
+        except requests.RequestException as e:
+            WEBHOOK_REQUESTS.inc(status="error")
+            if isinstance(e, WEBHOOK_RETRY_ERRORS) and not is_last_attempt:
+                return False
+            webhook_reponse = f"Request failed: {e.__class__.__name__}"
+            WEBHOOKS.inc(result="failed")
+        else:
+            WEBHOOK_REQUESTS.inc(status=response.status_code)
+            if response.status_code in WEBHOOK_RETRY_STATUS_CODES and not is_last_attempt:
+                return False
+            webhook_reponse = self._format_webhook_response(response)
+            WEBHOOKS.inc(result="delivered" if response.ok else "failed")
+
         self._save_webhook_repsonse(upload_id, webhook_reponse)
+        return True
 
-    def _parse_msg(self) -> tuple[str, str]:
-        """ this function will parse the incoming msg and return the upload_id and webhook_url """
+    def _parse_msg(self) -> tuple[ObjectId, str]:
+        """
+        this function will parse the incoming msg and return the upload_id and webhook_url
+        upload_id is validated here, before the webhook is fired, so an invalid msg is dropped without any request
+        """
 
         messages = self.msg.split("|||")
         if len(messages) != 2:
@@ -52,23 +105,48 @@ class WebhookNotification:
         if upload_id is None or webhook_url is None:
             raise Exception("Invalid message format")
 
-        return upload_id, webhook_url
+        try:
+            return ObjectId(upload_id), webhook_url
+        except (InvalidId, TypeError):
+            raise Exception(f"Invalid upload id: {upload_id}")
 
-    def _make_webhook_request(self, url: str) -> str:
+    def _format_webhook_response(self, response: requests.Response) -> str:
         """
-        this function will make the webhook request and return the response 
-        this will return response in
+        this function will return the response of webhook request in
         "Respone Status Code:<response_code>, Response reason:<response_reason_only_in_case_of_non_200"
         """
 
-        response = requests.get(url)
         if response.status_code == 200:
             return f"Respone Status Code:{response.status_code}"
         else:
             return f"Respone Status Code:{response.status_code}, Response reason:{response.reason}"
 
-    def _save_webhook_repsonse(self, upload_id: str, response: str) -> None:
-        self.upload_collection.find_one_and_update(
-            {"_id": ObjectId(upload_id)},
-            {"$set": {"updatedAt": datetime.now(), "whkResponse": response}}
-        )
+    def _save_webhook_repsonse(self, upload_id: ObjectId, response: str) -> None:
+        update = {"$set": {"updatedAt": datetime.now(), "whkResponse": response}}
+
+        started_at = time.perf_counter()
+
+        def on_written(future):
+            # includes the time spent waiting in the write buffer
+            STAGE_DURATION.observe(time.perf_counter() - started_at, stage="mongo_save")
+            self._saved(future.exception() is None)
+
+        if self.mongo_writer is not None:
+            self.mongo_writer.update_one("uploads", {"_id": upload_id}, update).add_done_callback(on_written)
+            return
+
+        try:
+            self.upload_collection.update_one({"_id": upload_id}, update)
+        except PyMongoError as e:
+            # do not raise error, result is not acked so it is delivered again
+            self.logr.error(f"Failed to save webhook response of upload {upload_id}: {e}")
+            self._saved(False)
+            return
+
+        STAGE_DURATION.observe(time.perf_counter() - started_at, stage="mongo_save")
+        self._saved(True)
+
+    def _saved(self, ok: bool) -> None:
+        self.save_reported = True
+        if self.on_saved is not None:
+            self.on_saved(ok)
@@ -1,23 +1,61 @@
-from core.mongo import get_mongo_db
+from core.mongo import get_mongo_db, MongoWriteBuffer
 from core.redis import get_redis
 from core.logger import get_logger
-from .notifier import WebhookNotification
+from core.http_client import get_http_client
+from core.metrics import get_metrics_server
+from core.webhook_queue import get_webhook_transport, WebhookStreamConsumer, WEBHOOK_CHANNEL
+from .dispatcher import WebhookDispatcher, get_webhook_worker_count
+from .metrics import STAGE_DURATION
+from functools import partial
+from logging import Logger
+from redis import Redis
+import socket
+import os
 
 
 def initialize_webhook_subscriber():
     """
     This will initialize the webhook subscriber and process the each msg
-    send notification to the webhook url
+    send notification to the webhook url (via dispatcher, concurrently & with retries)
+    msgs are consumed from redis pub/sub or redis stream, as per WEBHOOK_TRANSPORT
     """
 
     # intialize various services
     logr = get_logger("webhook-subscriber")
-    redisClientForPubSub = get_redis(logr)
+    redisClient = get_redis(logr)
     mongoDbClient = get_mongo_db(logr)
+    metricsServer = get_metrics_server(logr)
+
+    # webhook responses are written in batches
+    mongoWriter = MongoWriteBuffer(logr, mongoDbClient)
+
+    # dispatcher does its own retries with backoff, so http client should not retry
+    httpClient = get_http_client(logr, pool_size=get_webhook_worker_count(), max_retries=0)
+    dispatcher = WebhookDispatcher(logr, mongoDbClient, httpClient, mongo_writer=mongoWriter).start()
+
+    try:
+        if get_webhook_transport() == "stream":
+            _consume_stream(logr, redisClient, dispatcher)
+        else:
+            _consume_pubsub(logr, redisClient, dispatcher)
+    except KeyboardInterrupt:
+        # let the queued webhooks (& their retries) finish
+        dispatcher.shutdown()
+        mongoWriter.close()
+        httpClient.close()
+        redisClient.close()
+        if metricsServer is not None:
+            metricsServer.shutdown()
+
+        print("Shutting down webhook gracefully...")
+
+
+def _consume_pubsub(logr: Logger, redisClientForPubSub: Redis, dispatcher: WebhookDispatcher):
+    """ consume the msgs from pub/sub channel, till interrupted """
 
     # subscribe to channel
     redisPubSub = redisClientForPubSub.pubsub()
-    redisPubSub.subscribe("webhook")
+    redisPubSub.subscribe(WEBHOOK_CHANNEL)
 
     logr.info("Webhook Subscriber started...")
     print("Webhook Subscriber started...")
@@ -27,12 +65,35 @@ def initialize_webhook_subscriber():
         for message in redisPubSub.listen():
             if message["type"] == 'message':
                 msg = message["data"].decode("utf-8")
-                WebhookNotification(logr, mongoDbClient).send_notification(msg)
-    except KeyboardInterrupt:
+                dispatcher.submit(msg)
+    finally:
         # unsubscribe to channel first
         redisPubSub.unsubscribe()
 
-        # then close the redis connection
+        # then close the pub/sub connection
         redisPubSub.close()
 
-        print("Shutting down webhook gracefully...")
+
+def _consume_stream(logr: Logger, redisClient: Redis, dispatcher: WebhookDispatcher):
+    """
+    consume the msgs from stream as one of the consumers of group, till interrupted
+    msg is acked once delivered & its response saved, released (to be re-claimed & delivered again) if the save failed
+    """
+
+    consumer_name = os.getenv("WEBHOOK_CONSUMER_NAME", f"{socket.gethostname()}-{os.getpid()}")
+    streamConsumer = WebhookStreamConsumer(logr, redisClient, consumer_name)
+
+    logr.info(f"Webhook Subscriber started as stream consumer {consumer_name}...")
+    print("Webhook Subscriber started...")
+
+    def ack(entry_id: str):
+        with STAGE_DURATION.time(stage="redis_ack"):
+            streamConsumer.ack(entry_id)
+
+    while True:
+        # includes the blocking wait for new msgs
+        with STAGE_DURATION.time(stage="redis_read"):
+            entries = streamConsumer.read()
+
+        for entry_id, msg in entries:
+            dispatcher.submit(msg, on_done=partial(ack, entry_id), on_failed=partial(streamConsumer.release, entry_id))